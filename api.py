@@ -1,14 +1,31 @@
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
-from google.appengine.api import taskqueue
 
 from models import User, Score
 from models import StringMessage, MakeMoveForm, \
     ScoreForms, UserForm, UserForms, InsertShipsForms
-from game_models import Game, GameForm, GameForms, NewGameForm
-from utils import get_by_urlsafe
+from game_models import Game, GameForm, GameForms, NewGameForm, ShipsRemainingForms, \
+    MoveForms, SetupGameForm
+from game_models import MEMCACHE_SHIPS_REMAINING, MEMCACHE_MOVE_COUNT
+from utils import get_by_urlsafe, get_by_urlsafe_async, fetch_page, fetch_page_async
+from tasks import schedule_move_email_async
+import tasks
+from fleet import fleet_masks, random_fleet
+from leaderboard import LEADERBOARD_SIZE, get_leaderboard, ranked_users
+import metrics
+
+# Number of times a move transaction is retried after contention on the game.
+MOVE_RETRIES = 3
+# Maximum number of seconds a get_game_moves request waits for a new move.
+MAX_MOVES_WAIT = 20
+
+
+class GameBusyException(endpoints.ConflictException):
+    """Conflict raised when a move's transaction still collides with other writes to the
+        game after every retry, as distinct from a move made against an older version."""
+
 
 # Fields for conference query options.
 SHIP_TYPES = [
@@ -21,6 +38,8 @@ SHIP_TYPES = [
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 
+SETUP_GAME_REQUEST = endpoints.ResourceContainer(SetupGameForm)
+
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1), )
 
@@ -28,6 +47,15 @@ MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1), )
 
+MOVES_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    since=messages.IntegerField(2, default=0),
+    wait=messages.IntegerField(3, default=0))
+
+REPLAY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    move=messages.IntegerField(2))
+
 GRID_ATTACKS_REQUEST = endpoints.ResourceContainer(
     user_number=messages.StringField(1),
     urlsafe_game_key=messages.StringField(2), )
@@ -40,7 +68,22 @@ USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2))
 
-MEMCACHE_USER_SHIPS_REMAINING = 'SHIPS_REMAINING'
+PAGE_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1),
+    page_token=messages.StringField(2))
+
+RANKING_REQUEST = endpoints.ResourceContainer(
+    order_by=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    page_token=messages.StringField(3))
+
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1))
+
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    page_token=messages.StringField(3))
 
 
 @endpoints.api(name='battleships', version='v1')
@@ -52,45 +95,108 @@ class BattleshipsAPI(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @metrics.instrument()
     def create_user(self, request):
-        """Create a User. Requires a unique username, which is compared with the 
-        pre-existing names stored in the database. If the name is already taken an 
-        exception will be raised
+        """Create a User. Requires a unique username, which is used as the key of the
+        User entity, and is checked for uniqueness within a transaction. If the name is
+        already taken an exception will be raised
         Args:
             request: the request object containing the chosen user name and email strings
         Returns:
             A StringMessage alerting the user that the user was successfully created
         Raises:
+            endpoints.BadRequestException
             endpoints.ConflictException
         """
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException('A user name is required!')
+        if User.get_by_name(request.user_name) or \
+                not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserForm,
+                      path='user/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @metrics.instrument()
+    def get_user_stats(self, request):
+        """Return a User's current wins, total played, win percentage and rating,
+            including the results of games that have not yet been folded into the User.
+        Args:
+            request: the request object containing the user name
+        Returns:
+            A UserForm with the user's current stats.
+        Raises:
+            endpoints.NotFoundException
+        """
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException('A User with that name does not exist!')
+        return user.to_stats_form()
+
+    @endpoints.method(request_message=RANKING_REQUEST,
+                      response_message=UserForms,
                       path='user/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @metrics.instrument()
     def get_user_rankings(self, request):
-        """Return all Users ranked by their win percentage.
+        """Return a page of the Users who have played a game, ranked by their win
+            percentage, or by their rating if order_by is 'rating'. Users with equal
+            values are ordered by name.
+        Args:
+            request: the request object, containing the optional order_by, limit and
+                page_token
+        Returns:
+            A UserForms object contaning the indivual UserForm objects for each user,
+            along with the next_page_token if there are more users.
+        Raises:
+            endpoints.BadRequestException
+        """
+        if request.order_by in (None, 'win_percentage'):
+            users = ranked_users()
+        elif request.order_by == 'rating':
+            users = User.query(User.has_played == True).order(-User.rating, User.key)
+        else:
+            raise endpoints.BadRequestException(
+                "order_by must be either 'win_percentage' or 'rating'")
+        users, next_page_token = fetch_page(users, request.limit, request.page_token)
+        return UserForms(items=[user.to_form() for user in users],
+                         next_page_token=next_page_token)
+
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=UserForms,
+                      path='user/leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @metrics.instrument()
+    def get_leaderboard(self, request):
+        """Return the top ranked Users, in the same order as get_user_rankings, from a
+            snapshot held in memcache that is updated as each game finishes.
         Args:
-            request: the request object
+            request: the request object, containing the optional limit, which defaults
+                to and is capped at 50.
         Returns:
-            A UserForms object contaning the indivual UserForm objects for each user
+            A UserForms object containing a UserForm for each of the top users.
+        Raises:
+            endpoints.BadRequestException
         """
-        users = User.query(User.total_played > 0).fetch()
-        users = sorted(users, key=lambda x: x.win_percentage, reverse=True)
-        return UserForms(items=[user.to_form() for user in users])
+        limit = LEADERBOARD_SIZE if request.limit is None else request.limit
+        if limit < 1:
+            raise endpoints.BadRequestException('The limit must be at least 1')
+        return UserForms(items=get_leaderboard(limit))
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @metrics.instrument()
+    @ndb.synctasklet
     def new_game(self, request):
         """Creates new game with the requested user 1 and user 2 names. Checks the 
             datastore to ensure players with those names specified exist. If an 
@@ -104,25 +210,75 @@ class BattleshipsAPI(remote.Service):
         Raises:
             endpoints.NotFoundException:
         """
-        user_1 = User.query(User.name == request.user_1).get()
-        user_2 = User.query(User.name == request.user_2).get()
-        if not user_1 and user_2:
+        # look up both users at once.
+        user_1, user_2 = yield (User.get_by_name_async(request.user_1),
+                                User.get_by_name_async(request.user_2))
+        if not user_1 or not user_2:
+            raise endpoints.NotFoundException(
+                'One of users with that name does not exist!')
+
+        game = Game.new_game(user_1.key, user_2.key,
+                             user_1_name=user_1.name, user_2_name=user_2.name)
+
+        raise ndb.Return(game.to_form())
+
+    @endpoints.method(request_message=SETUP_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='game/setup',
+                      name='setup_game',
+                      http_method='POST')
+    @metrics.instrument()
+    @ndb.synctasklet
+    def setup_game(self, request):
+        """Creates a new game with both users ships already inserted, as new_game followed
+            by insert_user_1_ships and insert_user_2_ships would, but with both fleets
+            validated before the game is written once. Each fleet is either given as
+            ship forms, or randomly generated if its random_fleet is set.
+        Args:
+            request: contains the user 1 and user 2 input names, and the InsertShipsForms
+                of each user's ships.
+        Returns:
+            returns a gameform representation of the created game, using the game instance
+            to_form() method.
+        Raises:
+            endpoints.BadRequestException
+            endpoints.NotFoundException
+        """
+        # check both fleets before reading anything from the datastore.
+        try:
+            ships_1 = self._requested_ships(request.user_1_ships)
+            ships_2 = self._requested_ships(request.user_2_ships)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        # a game set up without a fleet could never be won by the other user.
+        if not ships_1 or not ships_2:
+            raise endpoints.BadRequestException(
+                'Each user must give their ships or request a random fleet!')
+
+        user_1, user_2 = yield (User.get_by_name_async(request.user_1),
+                                User.get_by_name_async(request.user_2))
+        if not user_1 or not user_2:
             raise endpoints.NotFoundException(
                 'One of users with that name does not exist!')
 
-        game = Game.new_game(user_1.key, user_2.key)
+        game = Game.new_game(user_1.key, user_2.key,
+                             user_1_name=user_1.name, user_2_name=user_2.name,
+                             ships_1=ships_1, ships_2=ships_2)
+        yield game.cache_ships_remaining_async()
 
-        return game.to_form()
+        raise ndb.Return(game.to_form())
 
     @endpoints.method(request_message=INSERT_SHIPS_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/user_1_ships',
                       name='user_1_ships',
                       http_method='PUT')
+    @metrics.instrument()
     def insert_user_1_ships(self, request):
         """Inserts user 1 ships into the Game entity grid 1 field. Takes in multiple
             Message objects through a GameForms request object. Makes use of the
             _format_ship_inserts(ships) and game class insert_user_ships(ships) methods.
+            If random_fleet is set instead of any ships, a random fleet is generated.
             Raises an exception if no game is found, a player has already inserted ships
             or the ship insert data is invalid.
         Args:
@@ -141,9 +297,10 @@ class BattleshipsAPI(remote.Service):
             if game.total_ship_cells(grid=1) == 0:
                 # check validity of input ship data. Insert into game if valid.
                 try:
-                    ship_data = self._format_ship_inserts(request.ships)
+                    ship_data = self._requested_ships(request)
                     game.insert_user_ships(ship_data)
                     game.put()
+                    game.cache_ships_remaining()
                 # raise exception with error message if the data is not valid.
                 except Exception as e:
                     msg = e
@@ -159,10 +316,12 @@ class BattleshipsAPI(remote.Service):
                       path='game/{urlsafe_game_key}/user_2_ships',
                       name='user_2_ships',
                       http_method='PUT')
+    @metrics.instrument()
     def insert_user_2_ships(self, request):
         """Inserts user 2 ships into the Game entity grid 2 field. Takes in multiple
             Message objects through a GameForms request object. Makes use of the
             _format_ship_inserts(ships) and game class insert_user_ships(ships) methods.
+            If random_fleet is set instead of any ships, a random fleet is generated.
             Raises an exception if no game is found, a player has already inserted ships
             or the ship insert data is invalid.
         Args:
@@ -181,9 +340,10 @@ class BattleshipsAPI(remote.Service):
             if game.total_ship_cells(grid=2) == 0:
                 # check validity of input ship data. Insert into game if valid.
                 try:
-                    ship_data = self._format_ship_inserts(request.ships)
+                    ship_data = self._requested_ships(request)
                     game.insert_user_ships(ship_data, user='user_2')
                     game.put()
+                    game.cache_ships_remaining()
                 # raise exception with error message if the data is not valid.
                 except Exception as e:
                     msg = e
@@ -194,6 +354,20 @@ class BattleshipsAPI(remote.Service):
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    def _requested_ships(self, request):
+        """Returns the ships requested by an insert ships request, or the InsertShipsForms
+            of a setup game request, in the format taken by Game.insert_user_ships, either
+            formatted from the given ships, or a randomly generated fleet if random_fleet
+            is set.
+        Raises:
+            ValueError: ships were given along with random_fleet, or are invalid.
+        """
+        if request.random_fleet:
+            if request.ships:
+                raise ValueError('Ships cannot be given when a random fleet is requested!')
+            return random_fleet()
+        return self._format_ship_inserts(request.ships)
+
     def _format_ship_inserts(self, ships):
         """Parse, check validity and format ship insert data into an appropriate dict.
             Raises an exception if the ship type within the ships dict is incorrect, or
@@ -237,88 +411,23 @@ class BattleshipsAPI(remote.Service):
                 # default to vertical orientation if horizontal not given.
                 vertical = True
 
-            # check the validity of the given ship data using _ship_insert_posn_valid helper.
-            check_ship, msg = self._ship_insert_posn_valid(ship_type, start_row,
-                                                           start_col, vertical)
+            formatted_ships[ship_type] = [start_row, start_col, vertical]
 
-            # format the ship dict as appropriate if the ship data is valid.
-            if check_ship:
-                formatted_ships[ship_type] = [start_row, start_col, vertical]
-
-            else:
-                raise ValueError("There was a problem with a ship insert. {0}".format(msg))
+        # check every ship fits on the grid, and that no ships overlap, using the
+        # precomputed placement table.
+        try:
+            fleet_masks(formatted_ships)
+        except ValueError as e:
+            raise ValueError("There was a problem with a ship insert. {0}".format(e))
 
         return formatted_ships
 
-    def _ship_insert_posn_valid(self, ship_type, first_row_int, first_col_int, vertical=True):
-        """Checks the validatity of the ships starting co-ordinates and characteristics.
-           Returns a tuple, consisting of a retval and a message. retval is True to indicate
-           valid position data, and is false when not, along with a message indicating why.
-           Raises an exception if vertical is not True or False.
-        Args:
-            ship_type: The type of ship the user wants to insert. Must be of type str and
-                        equal to either 'aircraft carrier', 'battleship', 'destroyer', 
-                        'submarine' or 'battleship'
-            first_row_int: An integer between 0-9, representing the first row the ship
-                            shall occupy
-            first_col_int: An integer between 0-9, representing the first column the ship
-                            shall occupy
-            vertical: Must be of type boolean and equal to True or False. True by default
-        Returns:
-            A tuple, consisting of two objects: retval and message:
-                - The retval is equal to True if the data is valid, and false if not
-                - The message gives an indication as to the problem if retval is false
-        Raises:
-            ValueError
-        """
-        if ship_type == 'aircraft carrier':
-            limit, size = 5, 5
-        elif ship_type == 'battleship':
-            limit, size = 6, 4
-        elif ship_type == 'submarine':
-            limit, size = 7, 3
-        elif ship_type == 'destroyer':
-            limit, size = 7, 3
-        elif ship_type == 'patrol boat':
-            limit, size = 8, 2
-        else:
-            retval = False
-            message = ("The input ship type {0} is not valid! Please use either "
-                       "'aircraft carrier', 'battleship', 'submarine', 'destroyer' or "
-                       "'patrol boat'!".format(ship_type))
-            return retval, message
-
-        if vertical:
-            # verify that the ship will fit into the battle grid based on input.
-            if int(first_row_int) < limit:
-                retval, message = True, None
-                return retval, message
-            # if not set retval false and message for out of bounds input location.
-            else:
-                retval = False
-                message = "{0} is size {1} and cannot fit there!".format(ship_type, size)
-                return retval, message
-
-        elif not vertical:
-            # verify that horizontal location is within the grid limits.
-            if int(first_col_int) < limit:
-                retval, message = True, None
-                return retval, message
-            # if not raise ValueError for out of bounds input horizontal location.
-            else:
-                retval = False
-                message = "{0} is size {1} and cannot fit there!".format(ship_type, size)
-                return retval, message
-
-        else:
-            # raise exception for incorrect vertical keyword if not true or false.
-            raise ValueError("The 'vertical' keyword must be True or False!")
-
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @metrics.instrument()
     def get_game(self, request):
         """Return the current game state using the urlsafe_game_key. Raises an exception
             if the game cannot be found based on the urlsafe_game_key.
@@ -336,34 +445,56 @@ class BattleshipsAPI(remote.Service):
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='user/games',
                       name='get_user_games',
                       http_method='GET')
+    @metrics.instrument()
+    @ndb.synctasklet
     def get_user_games(self, request):
-        """Return all a selected User's active games. If no user is found
-            within the database an endpoints exception is raised
+        """Return a page of a selected User's active games, ordered by game key. If no
+            user is found within the database an endpoints exception is raised
         Args:
-            request: request object containing user name and email input data
+            request: request object containing user name, and the optional limit and
+                page_token
         Returns:
-            GameForms message with all the queried user games as GameForm messages
+            GameForms message with the queried user games as GameForm messages, along
+            with the next_page_token if there are more games.
         Raises:
             endpoints.BadRequestException
         """
-        user = User.query(User.name == request.user_name).get()
+        if not request.user_name:
+            raise endpoints.BadRequestException('User not found!')
+
+        def user_games(user_key):
+            return Game.query(ndb.OR(Game.user_1 == user_key,
+                                     Game.user_2 == user_key)).\
+                filter(Game.game_over == False).order(Game.key)
+
+        # users are keyed by name, so the page of games is queried while the user is
+        # looked up.
+        user_key = ndb.Key(User, request.user_name)
+        user, (games, next_page_token) = yield (
+            User.get_by_name_async(request.user_name),
+            fetch_page_async(user_games(user_key), request.limit, request.page_token))
         if not user:
             raise endpoints.BadRequestException('User not found!')
-        games = Game.query(ndb.OR(Game.user_1 == user.key,
-                                  Game.user_2 == user.key)).\
-            filter(Game.game_over == False)
-        return GameForms(items=[game.to_form() for game in games])
+        if user.key != user_key:
+            # users not yet re-keyed by name are queried again by their key.
+            games, next_page_token = yield fetch_page_async(
+                user_games(user.key), request.limit, request.page_token)
+        forms = Game.to_forms(games)
+        forms.next_page_token = next_page_token
+        raise ndb.Return(forms)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @metrics.instrument()
+    @ndb.synctasklet
     def cancel_game(self, request):
         """Delete a game. Game must not have already ended in order to be deleted. Raises
             an endpoints exception if either the game is over or the game is not found.
@@ -375,13 +506,18 @@ class BattleshipsAPI(remote.Service):
             endpoints.BadRequestException: game is already over.
             endpoints.NotFoundException: game not found.
         """
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield get_by_urlsafe_async(request.urlsafe_game_key, Game)
 
         # check to ensure the game is not already over.
         if game and not game.game_over:
-            game.key.delete()
-            return StringMessage(message='Game with key: {} deleted.'.
-                                 format(request.urlsafe_game_key))
+            # delete the game, its move log and its memcache entries at once.
+            urlsafe_key = game.key.urlsafe()
+            ctx = ndb.get_context()
+            yield (ndb.delete_multi_async([game.key] + game.move_chunk_keys()),
+                   ctx.memcache_delete(MEMCACHE_SHIPS_REMAINING.format(urlsafe_key)),
+                   ctx.memcache_delete(MEMCACHE_MOVE_COUNT.format(urlsafe_key)))
+            raise ndb.Return(StringMessage(message='Game with key: {} deleted.'.
+                                           format(request.urlsafe_game_key)))
 
         elif game and game.game_over:
             raise endpoints.BadRequestException('Game is already over!')
@@ -394,6 +530,8 @@ class BattleshipsAPI(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @metrics.instrument()
+    @ndb.synctasklet
     def make_move(self, request):
         """Makes a move by updating the users attack on the opponents battlegrid. Returns a game 
             state with message based on outcome. Ends the game using the game method end_game() 
@@ -407,8 +545,12 @@ class BattleshipsAPI(remote.Service):
         Raises:
             endpoints.NotFoundException
             endpoints.BadRequestException
+            endpoints.ConflictException: another move was made in the game first.
+            GameBusyException: the move could not be committed within MOVE_RETRIES.
         """
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        # look up the game and the user making the move at once.
+        game, user = yield (get_by_urlsafe_async(request.urlsafe_game_key, Game),
+                            User.get_by_name_async(request.user_name))
 
         if not game:
             raise endpoints.NotFoundException('Game not found')
@@ -423,7 +565,8 @@ class BattleshipsAPI(remote.Service):
                                                 'prior to beginning the game.')
 
         # ensure the correct user is making a move.
-        user = User.query(User.name == request.user_name).get()
+        if not user:
+            raise endpoints.NotFoundException('A User with that name does not exist!')
         if user.key != game.next_move:
             raise endpoints.BadRequestException('It\'s not your turn!')
 
@@ -445,57 +588,103 @@ class BattleshipsAPI(remote.Service):
             raise endpoints.BadRequestException('That grid cell is already destroyed! '
                                                 'Try picking another!')
 
-        # check whether the move was a hit or miss.
-        target_hit = game.destroy_cell(row_loc, col_loc, grid=target_grid)
+        # reject moves made against an older version of the game than the current one.
+        if request.version is not None and request.version != game.version:
+            raise endpoints.ConflictException('The game has changed since version {0}! '
+                                              'Refresh the game and try again.'.
+                                              format(request.version))
 
-        # Append a move to the relevant history dict key dependent on user and hit status.
-        history_msg = 'Ship hit!' if target_hit else 'No ship hit!'
-        history_entry = (row_loc, col_loc, history_msg)
-        game.history['grid_2' if user_1 else 'grid_1'].append(history_entry)
+        # apply the move to the game as read above within a transaction, which is
+        # rejected if another move has been committed since.
+        try:
+            game, target_hit = self._commit_move(game.key, game.version, target_grid,
+                                                 row_loc, col_loc)
+        except datastore_errors.TransactionFailedError:
+            raise GameBusyException('The game is busy! Try your move again.')
 
-        # set next move within the game.
-        game.next_move = game.user_2 if user_1 else game.user_1
-
-        # check for any winners, end game and report winner if true.
-        winner_p1, winner_p2 = game.check_winner()
-        if winner_p1:
-            game.end_game(game.user_1)
-            game.put()
-            return StringMessage(message='The game is over! {0} has won the match!'.
-                                 format(game.user_1.get().name))
-
-        if winner_p2:
-            game.end_game(game.user_2)
-            game.put()
-            return StringMessage(message='The game is over! {0} has won the match!'.
-                                 format(game.user_2.get().name))
-
-        else:
-            # Send reminder email
-            taskqueue.add(url='/tasks/send_move_email',
-                          params=dict(user_key=game.next_move.urlsafe(), game_key=game.key.urlsafe()))
+        if game.game_over:
+            raise ndb.Return(StringMessage(message='The game is over! {0} has won the '
+                                                   'match!'.format(game.user_name(game.winner))))
 
-            # update memcache with user ships remaining
-            taskqueue.add(url='/tasks/cache_ships_remaining',
-                          params=None)
+        # read the move log and update the memcache entry of the games ships remaining.
+        moves, _ = yield game.get_moves_async(), game.cache_ships_remaining_async()
 
         target_hit_msg = 'You hit a ship! Well done!'
         target_miss_msg = 'No ship hit! Better luck next time!'
 
         # create a message to notify the player that they hit or missed.
+        history = game.get_state().history(moves)
         ret_msg = ("{0} You have now made the following moves: {1}. "
                    "{2} is up next!".format(target_hit_msg if target_hit else target_miss_msg,
-                                            game.history['grid_2' if user_1 else 'grid_1'],
-                                            game.next_move.get().name))
+                                            history['grid_2' if user_1 else 'grid_1'],
+                                            game.user_name(game.next_move)))
+        raise ndb.Return(StringMessage(message=ret_msg))
 
-        game.put()
-        return StringMessage(message=ret_msg)
+    @staticmethod
+    @tasks.transactional(xg=True, retries=MOVE_RETRIES)
+    def _commit_move(game_key, version, target_grid, row_int, col_int):
+        """Applies a validated move to a game within a transaction. The game is read
+            again within the transaction, and the move is only applied if its version is
+            unchanged since the move was validated, so of two concurrent moves only the
+            first to commit is applied and the other is rejected without retrying. The
+            game, the turn email and, if the move wins the game, its Score and User
+            results are committed together.
+        Args:
+            game_key: The key of the Game the move is made in.
+            version: The version of the game the move was validated against.
+            target_grid: The grid under attack, 1 or 2.
+            row_int (int): the row of the attacked cell.
+            col_int (int): the column of the attacked cell.
+        Returns:
+            A tuple of the updated Game, and True if a ship was hit, else False.
+        Raises:
+            endpoints.ConflictException: another move has been made since the version.
+        """
+        game = game_key.get()
+        if game.version != version:
+            raise endpoints.ConflictException('Another move was made in this game first! '
+                                              'Refresh the game and try again.')
+
+        # check whether the move was a hit or miss.
+        target_hit = game.destroy_cell(row_int, col_int, grid=target_grid)
+
+        # Append the move to the game move log, from which the history dict is built.
+        game.record_move(target_grid, row_int, col_int)
+
+        # set next move within the game.
+        game.next_move = game.user_1 if target_grid == 1 else game.user_2
+
+        # check for any winners, and end game if true.
+        winner_p1, winner_p2 = game.check_winner()
+        if winner_p1:
+            game.end_game(game.user_1)
+        elif winner_p2:
+            game.end_game(game.user_2)
+        else:
+            # save the move and schedule the turn email for the next user.
+            BattleshipsAPI._save_move(game)
+        return game, target_hit
+
+    @staticmethod
+    def _save_move(game):
+        """Puts a game after a move, and schedules the turn email for the next user. At
+            most one turn email per user is enqueued within the coalescing window,
+            covering every game in which it is their turn, however many moves are made.
+        Args:
+            game: The Game entity the move was made in.
+        """
+        futures = [game.put_async(), schedule_move_email_async(game.next_move, game.key)]
+        # the put and task add are sent together, and both finish before the commit.
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @metrics.instrument()
     def get_game_history(self, request):
         """Return a Game's move history. The history is represented as a dict
             with two values: grid_1 and grid_2. Each grid has a sequence
@@ -513,11 +702,78 @@ class BattleshipsAPI(remote.Service):
             raise endpoints.NotFoundException('Game not found')
         return StringMessage(message=str(game.history))
 
+    @endpoints.method(request_message=MOVES_REQUEST,
+                      response_message=MoveForms,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='get_game_moves',
+                      http_method='GET')
+    @metrics.instrument()
+    def get_game_moves(self, request):
+        """Return the moves of a Game made after a sequence number, so a client polling a
+            game only receives the moves it has not seen. Moves are numbered from 1 in
+            the order they were made. If wait is given and there are no newer moves, the
+            request waits up to wait seconds for one, checking only a memcache entry of
+            the game's move count rather than reading the game.
+        Args:
+            request: request object containing urlsafe_game_key, and the optional since
+                     (the last_seq of the previous response, 0 by default) and wait
+                     (seconds, up to 20)
+        Returns:
+            A MoveForms containing the newer moves, the sequence number of the last move
+            and whether the game is over.
+        Raises:
+            endpoints.BadRequestException
+            endpoints.NotFoundException
+        """
+        if request.since < 0 or request.wait < 0:
+            raise endpoints.BadRequestException('since and wait must not be negative!')
+        cached = True
+        if request.wait:
+            cached = Game.wait_for_moves(request.urlsafe_game_key, request.since,
+                                         min(request.wait, MAX_MOVES_WAIT))
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found')
+        if not cached:
+            # restore the move count entry, eg after memcache was flushed.
+            game.cache_move_count()
+        return game.to_move_forms(since=request.since)
+
+    @endpoints.method(request_message=REPLAY_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/replay',
+                      name='get_game_replay',
+                      http_method='GET')
+    @metrics.instrument()
+    def get_game_replay(self, request):
+        """Return a Game as it stood after a number of its moves, rebuilt from the ships
+            placed and the move log, eg to audit a disputed move.
+        Args:
+            request: request object containing urlsafe_game_key and the optional move,
+                     the number of moves to replay, where 0 is the game before the first
+                     move. Defaults to every move made.
+        Returns:
+            A GameForm of the game after the selected move.
+        Raises:
+            endpoints.BadRequestException
+            endpoints.NotFoundException
+        """
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found')
+        move_count = game.get_state().move_count
+        move = move_count if request.move is None else request.move
+        if not 0 <= move <= move_count:
+            raise endpoints.BadRequestException('The move must be between 0 and '
+                                                '{0}!'.format(move_count))
+        return game.at_move(move).to_form()
+
     @endpoints.method(request_message=GRID_ATTACKS_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/attacks',
                       name='get_game_attacks',
                       http_method='GET')
+    @metrics.instrument()
     def get_game_attacks(self, request):
         """Return a Game's grid attacks for both player 1 and player 2
         Args:
@@ -544,74 +800,81 @@ class BattleshipsAPI(remote.Service):
         msg = ("The enemy grid is currently like so: {0}".format(shipfree_grid))
         return StringMessage(message=msg)
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @metrics.instrument()
     def get_scores(self, request):
-        """Return all scores records for the game from Datastore. The results
-            are unordered.
+        """Return a page of scores records for the game from Datastore, most recent
+            first.
         Args: 
-            request: the request object
+            request: the request object, containing the optional limit and page_token
         Returns:
-            ScoreForms object, containing the individual score records from Datastore
+            ScoreForms object, containing the individual score records from Datastore,
+            along with the next_page_token if there are more scores.
+        Raises:
+            endpoints.BadRequestException
         """
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        scores = Score.query().order(-Score.date, Score.key)
+        scores, next_page_token = fetch_page(scores, request.limit, request.page_token)
+        forms = Score.to_forms(scores)
+        forms.next_page_token = next_page_token
+        return forms
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @metrics.instrument()
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores
+        """Returns a page of an individual User's scores, ordered by score key
         Args:
-            request: the request object
+            request: the request object, containing the user name, and the optional
+                limit and page_token
         Returns:
-            A ScoreForms object, containing the users individual ScoreForm messages
+            A ScoreForms object, containing the users individual ScoreForm messages,
+            along with the next_page_token if there are more scores.
         Raises:
+            endpoints.BadRequestException
             endpoints.NotFoundException
         """
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
         scores = Score.query(ndb.OR(Score.winner == user.key,
-                                    Score.loser == user.key))
-        return ScoreForms(items=[score.to_form() for score in scores])
-
-    @endpoints.method(response_message=StringMessage,
+                                    Score.loser == user.key)).order(Score.key)
+        scores, next_page_token = fetch_page(scores, request.limit, request.page_token)
+        forms = Score.to_forms(scores)
+        forms.next_page_token = next_page_token
+        return forms
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ShipsRemainingForms,
                       path='games/ships_remaining',
                       name='get_ships_remaining',
                       http_method='GET')
+    @metrics.instrument()
     def get_ships_remaining(self, request):
-        """Get the cached ships remaining for each current game
+        """Get a page of the ships remaining for each game in progress. The games are
+            paged with a keys only query, and each games entry is read from memcache,
+            where it is written after every move.
         Args:
-            request: the request object
+            request: the request object, containing the optional limit and page_token
         Returns:
-            A StringMessage object, containing the stored memcache entry or an empty
-            string if no message exists.
-        """
-        return StringMessage(message=memcache.get(MEMCACHE_USER_SHIPS_REMAINING) or '')
-
-    @staticmethod
-    def _cache_ships_remaining():
-        """Populates memcache with the number of ships remaining for both users
-           of the current Games still in progress
+            A ShipsRemainingForms object containing a ShipsRemainingForm for each game,
+            along with the next_page_token if there are more games.
+        Raises:
+            endpoints.BadRequestException
         """
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            ship_game_data = []
-            for game in games:
-                websafe_game_key = game.key.urlsafe()
-                ships_1, ships_2 = game.total_ships(grid=1), game.total_ships(grid=2)
-                user_1, user_2 = game.user_1.get().name, game.user_2.get().name
-                msg = ("Game key {0}, user 1 is {1} with {2} ships, user 2 is {3} "
-                       "with {4} ships.".format(websafe_game_key, user_1, ships_1, user_2, ships_2))
-                ship_game_data.append(msg)
-            memcache.set(MEMCACHE_USER_SHIPS_REMAINING,
-                         'The current games in progress, along with the number of ships '
-                         'each user has is: {0}'.format('::'.join(ship_game_data)))
+        games = Game.query(Game.game_over == False).order(Game.key)
+        game_keys, next_page_token = fetch_page(games, request.limit, request.page_token,
+                                                keys_only=True)
+        return ShipsRemainingForms(items=Game.ships_remaining_forms(game_keys),
+                                   next_page_token=next_page_token)
 
 
 api = endpoints.api_server([BattleshipsAPI])
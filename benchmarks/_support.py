@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Shared setup of the benchmarks which call the API against the App Engine SDK's local
+# service stubs. Importing this module puts the SDK, found through the APPENGINE_SDK
+# environment variable, on the path, so it is imported before any App Engine module.
+import collections
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.environ.get('APPENGINE_SDK', ''))
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+# Datastore calls whose request is the entities written, and whose response holds the
+# entities read.
+WRITE_CALLS = frozenset(['Put'])
+READ_CALLS = frozenset(['Get', 'RunQuery', 'Next'])
+
+
+def setup_testbed(root_path=ROOT):
+    """Activates a testbed with every stub used by the API and task handlers, with a
+        strongly consistent datastore.
+    Args:
+        root_path (str): The tree whose queue.yaml configures the task queue stub.
+    Returns:
+        The active testbed, to be deactivated by the caller.
+    """
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=root_path)
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    return bed
+
+
+class RpcCounts(object):
+    """The RPCs made while an RpcMeter was started.
+    Attributes:
+        calls: A Counter of the RPCs made to each call, keyed by '{service}.{call}'.
+        read_bytes: The datastore entity bytes read.
+        write_bytes: The datastore entity bytes written.
+    """
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.read_bytes = 0
+        self.write_bytes = 0
+
+    @property
+    def total(self):
+        """The number of RPCs made to every service."""
+        return sum(self.calls.itervalues())
+
+    def services(self):
+        """Returns a Counter of the RPCs made to each service."""
+        services = collections.Counter()
+        for call, count in self.calls.iteritems():
+            services[call.split('.', 1)[0]] += count
+        return services
+
+
+class RpcMeter(object):
+    """Counts the RPCs made to each service and call by the thread which called start(),
+        until it calls stop(), along with the datastore entity bytes read and written.
+        Every counted RPC is optionally charged a fixed latency, as the stubs answer in
+        microseconds. An RPC's latency runs from when it is made, and its result is not
+        returned until the latency has passed, so RPCs made together, such as those of
+        ndb tasklets yielded at once, overlap as they would on App Engine, while RPCs
+        which wait on each other's results add up.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.local = threading.local()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_meter', self.pre_call)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpc_meter', self.post_call)
+
+    def start(self):
+        self.local.counts = RpcCounts()
+        # the time each RPC in flight completes, keyed by the id of its response.
+        self.local.deadlines = {}
+
+    def stop(self):
+        counts, self.local.counts = self.local.counts, None
+        return counts
+
+    def measure(self, func, *args):
+        """Calls func, returning the RpcCounts of the RPCs it made and the elapsed time."""
+        self.start()
+        start = time.time()
+        try:
+            func(*args)
+        finally:
+            elapsed = time.time() - start
+            counts = self.stop()
+        return counts, elapsed
+
+    def pre_call(self, service, call, request, response):
+        counts = getattr(self.local, 'counts', None)
+        if counts is None:
+            return
+        counts.calls['{0}.{1}'.format(service, call)] += 1
+        if service == 'datastore_v3' and call in WRITE_CALLS:
+            counts.write_bytes += request.ByteSize()
+        if self.latency:
+            self.local.deadlines[id(response)] = time.time() + self.latency
+
+    def post_call(self, service, call, request, response):
+        counts = getattr(self.local, 'counts', None)
+        if counts is None:
+            return
+        if service == 'datastore_v3' and call in READ_CALLS:
+            counts.read_bytes += response.ByteSize()
+        deadline = self.local.deadlines.pop(id(response), None)
+        if deadline is not None:
+            time.sleep(max(deadline - time.time(), 0))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Per-endpoint latency harness, calling the BattleshipsAPI endpoints against the local
+# App Engine service stubs and reporting the mean latency and RPCs of each endpoint.
+# Each RPC is charged a fixed simulated latency (5ms by default), as the stubs answer
+# in microseconds. The latency runs from when an RPC is made, so RPCs made together
+# overlap in flight as they would on App Engine, and only RPCs which wait on each other
+# add up.
+# To compare before and after a change, run the harness against a checkout of each:
+#     git worktree add /tmp/before <commit>
+#     APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_api_latency.py /tmp/before
+#     APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_api_latency.py
+# The tree defaults to this repository. Set RPC_LATENCY_MS to change the simulated latency.
+import collections
+import itertools
+import os
+import sys
+
+from _support import ROOT, RpcMeter, setup_testbed
+
+TREE = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else ROOT)
+RPC_LATENCY = float(os.environ.get('RPC_LATENCY_MS', 5)) / 1000
+sys.path.insert(0, TREE)
+
+from google.appengine.ext import ndb
+
+import api
+from models import InsertShipsForm
+
+FLEET = [
+    ('aircraft carrier', 0, 0),
+    ('battleship', 1, 0),
+    ('submarine', 2, 0),
+    ('destroyer', 3, 0),
+    ('patrol boat', 4, 0),
+]
+NAMES = ('user {0}'.format(num) for num in itertools.count())
+
+
+def request(container, **fields):
+    return container.combined_message_class(**fields)
+
+
+def create_user(service):
+    name = next(NAMES)
+    service.create_user(request(api.USER_REQUEST, user_name=name,
+                                email='{0}@example.com'.format(name.replace(' ', ''))))
+    return name
+
+
+def create_game(service):
+    """Returns the urlsafe key and user names of a new game with both fleets inserted."""
+    user_1, user_2 = create_user(service), create_user(service)
+    form = service.new_game(request(api.NEW_GAME_REQUEST, user_1=user_1, user_2=user_2))
+    ships = [InsertShipsForm(ship_type=ship_type, start_row=row, start_column=col,
+                             orientation='horizontal') for ship_type, row, col in FLEET]
+    service.insert_user_1_ships(request(api.INSERT_SHIPS_REQUEST,
+                                        urlsafe_game_key=form.urlsafe_key, ships=ships))
+    service.insert_user_2_ships(request(api.INSERT_SHIPS_REQUEST,
+                                        urlsafe_game_key=form.urlsafe_key, ships=ships))
+    return form.urlsafe_key, user_1, user_2
+
+
+# Each scenario returns a function making a single request to the endpoint, after
+# carrying out any setup it needs.
+def bench_create_user(service):
+    name = next(NAMES)
+    return lambda: service.create_user(request(api.USER_REQUEST, user_name=name,
+                                               email='bench@example.com'))
+
+
+def bench_new_game(service):
+    user_1, user_2 = create_user(service), create_user(service)
+    return lambda: service.new_game(request(api.NEW_GAME_REQUEST, user_1=user_1,
+                                            user_2=user_2))
+
+
+def bench_make_move(service):
+    game_key, user_1, _ = create_game(service)
+    return lambda: service.make_move(request(api.MAKE_MOVE_REQUEST, urlsafe_game_key=game_key,
+                                             user_name=user_1, target_row=9, target_col=9))
+
+
+def bench_get_game(service):
+    game_key, _, _ = create_game(service)
+    return lambda: service.get_game(request(api.GET_GAME_REQUEST, urlsafe_game_key=game_key))
+
+
+def bench_get_user_games(service):
+    _, user_1, _ = create_game(service)
+    return lambda: service.get_user_games(request(api.USER_PAGE_REQUEST, user_name=user_1))
+
+
+def bench_get_game_moves(service):
+    game_key, user_1, user_2 = create_game(service)
+    for num, user in enumerate((user_1, user_2) * 10):
+        service.make_move(request(api.MAKE_MOVE_REQUEST, urlsafe_game_key=game_key,
+                                  user_name=user, target_row=9 - num // 10,
+                                  target_col=num % 10))
+    # every move, including those archived into the game's move log chunks.
+    return lambda: service.get_game_moves(request(api.MOVES_REQUEST,
+                                                  urlsafe_game_key=game_key))
+
+
+def bench_cancel_game(service):
+    game_key, _, _ = create_game(service)
+    return lambda: service.cancel_game(request(api.GET_GAME_REQUEST,
+                                               urlsafe_game_key=game_key))
+
+
+SCENARIOS = collections.OrderedDict([
+    ('create_user', bench_create_user),
+    ('new_game', bench_new_game),
+    ('make_move', bench_make_move),
+    ('get_game', bench_get_game),
+    ('get_user_games', bench_get_user_games),
+    ('get_game_moves', bench_get_game_moves),
+    ('cancel_game', bench_cancel_game),
+])
+
+
+def main(trials=20):
+    bed = setup_testbed(root_path=TREE)
+    try:
+        service = api.BattleshipsAPI()
+        meter = RpcMeter(RPC_LATENCY)
+        print 'tree: {0}, simulated RPC latency: {1:.1f}ms'.format(TREE, RPC_LATENCY * 1000)
+        print '{0:<14} {1:>10} {2:>10}'.format('endpoint', 'mean ms', 'RPCs')
+        for name, scenario in SCENARIOS.iteritems():
+            if not hasattr(service, name):
+                # the endpoint was added after the tree being measured.
+                continue
+            elapsed, rpcs = 0.0, 0
+            for _ in range(trials):
+                call = scenario(service)
+                # start every request with an empty in-context cache, as a new request would.
+                ndb.get_context().clear_cache()
+                counts, call_elapsed = meter.measure(call)
+                elapsed += call_elapsed
+                rpcs += counts.total
+            print '{0:<14} {1:>10.2f} {2:>10.1f}'.format(name, elapsed / trials * 1000,
+                                                        float(rpcs) / trials)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Benchmark counting the datastore RPCs and time taken to finish a game, comparing the
+# previous end_game, which stored the game, score and each user with separate serial
+# RPCs before make_move stored the game again, against the current single transaction,
+# which reads both users and their stats shards with one batch get, and writes the game,
+# score and shards with puts made together. The RPCs of a whole final make_move request
+# are also reported. Uses the local datastore stub, so times show RPC overhead only;
+# set RPC_LATENCY_MS to charge every RPC a simulated latency, so the times show how many
+# round trips are made one after another.
+# Requires the App Engine Python SDK, found through the APPENGINE_SDK environment
+# variable. Run from the repository root with:
+#     APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_end_game.py
+import collections
+import os
+import sys
+from datetime import date
+
+from _support import ROOT, RpcMeter, setup_testbed
+
+RPC_LATENCY = float(os.environ.get('RPC_LATENCY_MS', 0)) / 1000
+sys.path.insert(0, ROOT)
+
+from google.appengine.ext import ndb
+
+from api import BattleshipsAPI, MAKE_MOVE_REQUEST
+from game_models import Game
+from models import Score, User
+
+FLEET = {
+    'aircraft carrier': [0, 0, False],
+    'battleship': [1, 0, False],
+    'submarine': [2, 0, False],
+    'destroyer': [3, 0, False],
+    'patrol boat': [4, 0, False],
+}
+# The last intact ship cell of grid 2, attacked by the final move.
+FINAL_CELL = (4, 1)
+
+
+def setup_final_move(suffix):
+    """Returns a game where user 1 needs one more hit on grid 2 to win."""
+    user_1 = User.create('bench user 1 {0}'.format(suffix), 'user1@example.com')
+    user_2 = User.create('bench user 2 {0}'.format(suffix), 'user2@example.com')
+    game = Game.new_game(user_1.key, user_2.key, user_1.name, user_2.name)
+    game.insert_user_ships(FLEET)
+    game.insert_user_ships(FLEET, user='user_2')
+    for cells in game.board(grid=2).ship_locations().values():
+        for row, col in cells:
+            if (row, col) != FINAL_CELL:
+                game.destroy_cell(row, col, grid=2)
+    game.put()
+    ndb.get_context().clear_cache()
+    return game.key
+
+
+def legacy_end_game(game, winner):
+    """The previous end_game, followed by the second game put made by make_move."""
+    game.winner = winner
+    game.game_over = True
+    game.put()
+    loser = game.user_2 if winner == game.user_1 else game.user_1
+    Score(date=date.today(), winner=winner, loser=loser,
+          winner_name=game.user_name(winner), loser_name=game.user_name(loser)).put()
+    winner_user = winner.get()
+    winner_user.wins += 1
+    winner_user.total_played += 1
+    winner_user.put()
+    loser_user = loser.get()
+    loser_user.total_played += 1
+    loser_user.put()
+    game.put()
+
+
+def previous_end_game(game_key):
+    game = game_key.get()
+    legacy_end_game(game, game.user_1)
+
+
+def current_end_game(game_key):
+    game = game_key.get()
+    game.end_game(game.user_1)
+
+
+def final_move(game_key):
+    game = game_key.get()
+    request = MAKE_MOVE_REQUEST.combined_message_class(
+        urlsafe_game_key=game_key.urlsafe(), user_name=game.user_1_name,
+        target_row=FINAL_CELL[0], target_col=FINAL_CELL[1])
+    BattleshipsAPI().make_move(request)
+
+
+def main(trials=20):
+    bed = setup_testbed()
+    try:
+        meter = RpcMeter(RPC_LATENCY)
+        results = collections.OrderedDict()
+        for name, func in (('previous end_game', previous_end_game),
+                           ('current end_game', current_end_game),
+                           ('final make_move', final_move)):
+            counts, elapsed = collections.Counter(), 0.0
+            for trial in range(trials):
+                game_key = setup_final_move('{0} {1}'.format(name, trial))
+                trial_counts, trial_elapsed = meter.measure(func, game_key)
+                counts.update(trial_counts.calls)
+                elapsed += trial_elapsed
+            results[name] = (counts, elapsed / trials)
+
+        for name, (counts, elapsed) in results.iteritems():
+            datastore = sum(count for call, count in counts.iteritems()
+                            if call.startswith('datastore_v3.'))
+            print '{0}: {1:.1f} datastore RPCs, {2:.2f}ms'.format(
+                name, float(datastore) / trials, elapsed * 1000)
+            for call, count in sorted(counts.iteritems()):
+                print '    {0:<32} {1:>6.1f}'.format(call, float(count) / trials)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
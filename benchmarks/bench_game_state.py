@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Benchmark comparing the stored size and encode/decode time of a game's state as the
+# six pickled properties and history stored by the previous Game model, against the
+# single versioned GameState blob, for games with 0, 50 and 200 moves. The archived
+# column is the size of the GameState once its move log is archived into chunks, which
+# is what each move writes to the Game.
+# Run from the repository root with: python benchmarks/bench_game_state.py
+import os
+import cPickle as pickle
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from board import GRID_SIZE
+from game_state import GameState
+
+# (ship type, size, first row, first col, vertical)
+FLEET = [
+    ('aircraft carrier', 5, 0, 0, True),
+    ('battleship', 4, 0, 2, False),
+    ('submarine', 3, 5, 5, True),
+    ('destroyer', 3, 9, 4, False),
+    ('patrol boat', 2, 3, 8, True),
+]
+
+
+def build_game(num_moves, seed=0):
+    """Returns a GameState with the standard fleet placed on both grids, and num_moves
+        attacks made alternately on grid 2 and grid 1 in a seeded random order.
+    """
+    state = GameState()
+    for grid in (1, 2):
+        for ship_type, size, row, col, vertical in FLEET:
+            for offset in range(size):
+                if vertical:
+                    state.board(grid).place(row + offset, col, ship_type=ship_type)
+                else:
+                    state.board(grid).place(row, col + offset, ship_type=ship_type)
+    rand = random.Random(seed)
+    targets = dict((grid, rand.sample(range(GRID_SIZE * GRID_SIZE), GRID_SIZE * GRID_SIZE))
+                   for grid in (1, 2))
+    for move_num in range(num_moves):
+        grid = 2 if move_num % 2 == 0 else 1
+        row, col = divmod(targets[grid].pop(), GRID_SIZE)
+        state.board(grid).shoot(row, col)
+        state.record_move(grid, row, col)
+    return state
+
+
+def legacy_values(state):
+    """Returns the values of the pickled properties stored by the previous Game model."""
+    return [state.board_1.to_grid(), state.board_2.to_grid(),
+            state.ships(1), state.ships(2),
+            state.board_1.ship_locations(), state.board_2.ship_locations(),
+            state.history()]
+
+
+def legacy_encode(values):
+    # ndb.PickleProperty stores pickle.dumps(value, pickle.HIGHEST_PROTOCOL); cPickle is
+    # used here so the baseline is not slowed by the pure python pickler.
+    return [pickle.dumps(value, pickle.HIGHEST_PROTOCOL) for value in values]
+
+
+def legacy_decode(blobs):
+    return [pickle.loads(blob) for blob in blobs]
+
+
+def main(number=2000):
+    print '{0:>6} {1:>12} {2:>12} {3:>12} {4:>12} {5:>12} {6:>12} {7:>12}'.format(
+        'moves', 'pickle B', 'state B', 'archived B', 'pickle enc', 'state enc',
+        'pickle dec', 'state dec')
+    for num_moves in (0, 50, 200):
+        state = build_game(num_moves)
+        values = legacy_values(state)
+        blobs = legacy_encode(values)
+        data = state.encode()
+        assert GameState.decode(data) == state
+        archived = GameState.decode(data)
+        archived.archive_moves()
+
+        def time_us(func, arg):
+            return min(timeit.repeat(lambda: func(arg), number=number, repeat=3)) / number * 1e6
+
+        print ('{0:>6} {1:>12} {2:>12} {3:>12} {4:>10.1f}us {5:>10.1f}us {6:>10.1f}us '
+               '{7:>10.1f}us').format(
+            num_moves, sum(len(blob) for blob in blobs), len(data), len(archived.encode()),
+            time_us(legacy_encode, values), time_us(GameState.encode, state),
+            time_us(legacy_decode, blobs), time_us(GameState.decode, data))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# End-to-end load benchmark, playing complete games through the BattleshipsAPI endpoint
+# methods against the App Engine SDK's local in-process service stubs (datastore,
+# memcache, task queue and mail). Every game is generated from the seed: each player's
+# fleet placement and order of attacks are drawn from a random.Random seeded with the
+# run seed and game number, so a run makes the same requests whatever the concurrency.
+# Games are played by a pool of threads, and for each endpoint the p50, p95 and p99
+# latency, RPCs per request to all services and to each service (datastore, memcache,
+# task queue and mail), and datastore entity bytes read and written per request are
+# written as JSON, with sorted keys so the reports of two commits diff cleanly:
+#     APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_load.py \
+#         --games 50 --concurrency 8 --seed 1 --output before.json
+# Set --rpc-latency-ms to charge every RPC a simulated latency, as the stubs answer in
+# microseconds, and --combined-setup to start each game with a single setup_game request
+# instead of new_game followed by both insert ships requests.
+import argparse
+import collections
+import itertools
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+from _support import ROOT, RpcCounts, RpcMeter, setup_testbed
+
+sys.path.insert(0, ROOT)
+
+from google.appengine.ext import ndb
+
+import api
+from board import GRID_SIZE
+from fleet import random_fleet
+from models import InsertShipsForm, InsertShipsForms
+
+GAME_OVER_MSG = 'The game is over!'
+
+
+class LoadRun(object):
+    """Plays seeded games through the API, recording the outcome of every request."""
+
+    def __init__(self, seed, meter, combined_setup=False):
+        self.seed = seed
+        self.meter = meter
+        self.combined_setup = combined_setup
+        self.service = api.BattleshipsAPI()
+        self.samples = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def call(self, name, container, **fields):
+        """Calls an endpoint method as a new request would, with an empty in-context
+            cache, and records its latency, RPCs and bytes."""
+        request = container.combined_message_class(**fields)
+        ndb.get_context().clear_cache()
+        self.meter.start()
+        start = time.time()
+        try:
+            return getattr(self.service, name)(request)
+        finally:
+            elapsed = time.time() - start
+            counts = self.meter.stop()
+            with self.lock:
+                self.samples[name].append((elapsed, counts))
+
+    @staticmethod
+    def fleet(rand):
+        """Returns InsertShipsForms of a random fleet placement without overlaps."""
+        return [InsertShipsForm(ship_type=ship_type, start_row=row, start_column=col,
+                                orientation='vertical' if vertical else 'horizontal')
+                for ship_type, (row, col, vertical) in sorted(random_fleet(rand).iteritems())]
+
+    def play(self, game_num):
+        """Plays a complete game, generated from the seed and game number."""
+        rand = random.Random(self.seed * 1000003 + game_num)
+        names = ['load {0} {1} {2}'.format(self.seed, game_num, player) for player in (1, 2)]
+        for name in names:
+            self.call('create_user', api.USER_REQUEST, user_name=name,
+                      email='{0}@example.com'.format(name.replace(' ', '.')))
+        if self.combined_setup:
+            game_key = self.call('setup_game', api.SETUP_GAME_REQUEST, user_1=names[0],
+                                 user_2=names[1],
+                                 user_1_ships=InsertShipsForms(ships=self.fleet(rand)),
+                                 user_2_ships=InsertShipsForms(ships=self.fleet(rand))
+                                 ).urlsafe_key
+        else:
+            game_key = self.call('new_game', api.NEW_GAME_REQUEST, user_1=names[0],
+                                 user_2=names[1]).urlsafe_key
+            self.call('insert_user_1_ships', api.INSERT_SHIPS_REQUEST,
+                      urlsafe_game_key=game_key, ships=self.fleet(rand))
+            self.call('insert_user_2_ships', api.INSERT_SHIPS_REQUEST,
+                      urlsafe_game_key=game_key, ships=self.fleet(rand))
+
+        targets = [rand.sample(range(GRID_SIZE * GRID_SIZE), GRID_SIZE * GRID_SIZE)
+                   for _ in names]
+        for move_num in itertools.count():
+            player = move_num % 2
+            row, col = divmod(targets[player].pop(), GRID_SIZE)
+            message = self.call('make_move', api.MAKE_MOVE_REQUEST, urlsafe_game_key=game_key,
+                                user_name=names[player], target_row=row,
+                                target_col=col).message
+            # the waiting player polls the game and its new moves after every move.
+            self.call('get_game', api.GET_GAME_REQUEST, urlsafe_game_key=game_key)
+            self.call('get_game_moves', api.MOVES_REQUEST, urlsafe_game_key=game_key,
+                      since=move_num)
+            if message.startswith(GAME_OVER_MSG):
+                break
+
+        for name in names:
+            self.call('get_user_games', api.USER_PAGE_REQUEST, user_name=name)
+        self.call('get_scores', api.PAGE_REQUEST, limit=10)
+        self.call('get_user_rankings', api.RANKING_REQUEST, limit=10)
+
+    def run(self, num_games, concurrency):
+        """Plays num_games games across concurrency threads, returning the elapsed time."""
+        game_nums = iter(range(num_games))
+        next_lock = threading.Lock()
+        errors = []
+
+        def worker():
+            while True:
+                with next_lock:
+                    game_num = next(game_nums, None)
+                if game_num is None:
+                    return
+                try:
+                    self.play(game_num)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return time.time() - start
+
+
+def percentile(values, pct):
+    """Returns the nearest rank percentile of a sorted list of values."""
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def report(run, elapsed, config):
+    endpoints = {}
+    for name, samples in sorted(run.samples.iteritems()):
+        latencies = sorted(sample[0] * 1000 for sample in samples)
+        count = len(samples)
+        totals = RpcCounts()
+        for _, counts in samples:
+            totals.calls.update(counts.calls)
+            totals.read_bytes += counts.read_bytes
+            totals.write_bytes += counts.write_bytes
+        endpoints[name] = {
+            'requests': count,
+            'mean_ms': round(sum(latencies) / count, 3),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'rpcs_per_request': round(float(totals.total) / count, 3),
+            'service_rpcs_per_request': dict(
+                (service, round(float(rpcs) / count, 3))
+                for service, rpcs in totals.services().iteritems()),
+            'read_bytes_per_request': round(float(totals.read_bytes) / count, 1),
+            'write_bytes_per_request': round(float(totals.write_bytes) / count, 1),
+        }
+    requests = sum(endpoint['requests'] for endpoint in endpoints.values())
+    return {'config': config, 'endpoints': endpoints,
+            'totals': {'requests': requests, 'elapsed_s': round(elapsed, 3),
+                       'requests_per_s': round(requests / elapsed, 1)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='End-to-end load benchmark of the BattleshipsAPI endpoints.')
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rpc-latency-ms', type=float, default=0.0)
+    parser.add_argument('--combined-setup', action='store_true',
+                        help='start games with setup_game')
+    parser.add_argument('--output', help='file to write the JSON report to, '
+                                         'instead of standard output')
+    args = parser.parse_args()
+
+    bed = setup_testbed()
+    try:
+        run = LoadRun(args.seed, RpcMeter(args.rpc_latency_ms / 1000), args.combined_setup)
+        elapsed = run.run(args.games, args.concurrency)
+        config = dict(games=args.games, concurrency=args.concurrency, seed=args.seed,
+                      rpc_latency_ms=args.rpc_latency_ms, combined_setup=args.combined_setup)
+        result = json.dumps(report(run, elapsed, config), indent=2, sort_keys=True,
+                            separators=(',', ': '))
+    finally:
+        bed.deactivate()
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(result + '\n')
+    else:
+        print result
+
+
+if __name__ == '__main__':
+    main()
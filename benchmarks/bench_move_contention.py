@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Concurrency benchmark firing parallel make_move requests at the same game, against the
+# local datastore stub, reporting how many moves commit, how many are rejected as
+# conflicts, and how many are rejected as busy after exhausting their retries. Every
+# round, each thread attempts a move for the player whose turn it is, so exactly one
+# move per round should commit.
+# Requires the App Engine Python SDK, found through the APPENGINE_SDK environment
+# variable. Run from the repository root with:
+#     APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_move_contention.py
+import sys
+import threading
+import time
+
+from _support import ROOT, setup_testbed
+
+sys.path.insert(0, ROOT)
+
+import endpoints
+
+from api import BattleshipsAPI, GameBusyException, MAKE_MOVE_REQUEST
+from board import GRID_SIZE
+from game_models import Game
+from models import User
+
+# Each fleet is placed within rows 0 - 4, so moves on rows 5 - 9 never end the game.
+FLEET = {
+    'aircraft carrier': [0, 0, False],
+    'battleship': [1, 0, False],
+    'submarine': [2, 0, False],
+    'destroyer': [3, 0, False],
+    'patrol boat': [4, 0, False],
+}
+FREE_CELLS = [(row, col) for row in range(5, GRID_SIZE) for col in range(GRID_SIZE)]
+
+
+def setup_game():
+    """Creates two users and a game between them with both fleets inserted."""
+    user_1 = User.create('bench user 1', 'user1@example.com')
+    user_2 = User.create('bench user 2', 'user2@example.com')
+    game = Game.new_game(user_1.key, user_2.key, user_1.name, user_2.name)
+    game.insert_user_ships(FLEET)
+    game.insert_user_ships(FLEET, user='user_2')
+    game.put()
+    return game.key
+
+
+def attempt_move(api, game_key, user_name, cell, outcomes, lock):
+    """Makes a single move request, recording its outcome and latency."""
+    request = MAKE_MOVE_REQUEST.combined_message_class(
+        urlsafe_game_key=game_key.urlsafe(), user_name=user_name,
+        target_row=cell[0], target_col=cell[1])
+    start = time.time()
+    try:
+        api.make_move(request)
+        outcome = 'committed'
+    except GameBusyException:
+        # the transaction's retries were exhausted.
+        outcome = 'busy'
+    except endpoints.ConflictException:
+        outcome = 'conflict'
+    except endpoints.BadRequestException:
+        # the move was validated after another move had already committed.
+        outcome = 'not your turn'
+    with lock:
+        outcomes.setdefault(outcome, []).append(time.time() - start)
+
+
+def run(num_threads, rounds):
+    """Plays rounds of moves, with num_threads parallel attempts per round.
+    Returns:
+        A dict of outcome to the list of latencies of the requests with that outcome,
+        and the elapsed time in seconds.
+    """
+    bed = setup_testbed()
+    try:
+        game_key = setup_game()
+        api = BattleshipsAPI()
+        outcomes, lock = {}, threading.Lock()
+        cells = {1: list(FREE_CELLS), 2: list(FREE_CELLS)}
+        initial_version = game_key.get(use_cache=False).version
+        start = time.time()
+        for _ in range(rounds):
+            game = game_key.get(use_cache=False)
+            target_grid = 2 if game.next_move == game.user_1 else 1
+            user_name = game.user_name(game.next_move)
+            # every attempt targets a different cell, so none fail validation.
+            attempts = [cells[target_grid].pop() for _ in range(num_threads)]
+            threads = [threading.Thread(target=attempt_move,
+                                        args=(api, game_key, user_name, cell, outcomes, lock))
+                       for cell in attempts]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.time() - start
+        game = game_key.get(use_cache=False)
+        assert game.version - initial_version == len(outcomes.get('committed', ())), \
+            'lost update'
+        return outcomes, elapsed
+    finally:
+        bed.deactivate()
+
+
+def main(rounds=8):
+    print '{0:>8} {1:>9} {2:>9} {3:>10} {4:>9} {5:>9} {6:>12} {7:>9} {8:>10}'.format(
+        'threads', 'attempts', 'commits', 'conflicts', 'turn', 'busy', 'commit rate',
+        'mean ms', 'commits/s')
+    for num_threads in (1, 2, 4, 8):
+        outcomes, elapsed = run(num_threads, min(rounds, len(FREE_CELLS) // num_threads))
+        counts = dict((outcome, len(latencies)) for outcome, latencies in outcomes.iteritems())
+        attempts = sum(counts.values())
+        latencies = [latency for values in outcomes.values() for latency in values]
+        print '{0:>8} {1:>9} {2:>9} {3:>10} {4:>9} {5:>9} {6:>11.1f}% {7:>9.1f} {8:>10.1f}'.format(
+            num_threads, attempts, counts.get('committed', 0), counts.get('conflict', 0),
+            counts.get('not your turn', 0), counts.get('busy', 0),
+            100.0 * counts.get('committed', 0) / attempts,
+            1000.0 * sum(latencies) / len(latencies), counts.get('committed', 0) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
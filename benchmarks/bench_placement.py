@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Microbenchmark of fleet validation and placement, comparing the previous per-ship
+# if/elif bounds check followed by placing each cell in turn, which never detected
+# overlapping ships, against validating the whole fleet with the precomputed placement
+# table and placing each ship's mask. Also reports how many random fleets per second
+# fleet.random_fleets generates.
+# Run from the repository root with: python benchmarks/bench_placement.py
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from board import Board, GRID_SIZE
+from fleet import SHIP_SIZES, fleet_masks, random_fleets, ship_mask
+
+LEGACY_LIMITS = {'aircraft carrier': 5, 'battleship': 6, 'submarine': 7, 'destroyer': 7,
+                 'patrol boat': 8}
+
+
+def legacy_fleets(num_fleets, seed=0):
+    """Returns fleets of non-overlapping ships in the format taken by insert_user_ships,
+        placed within the previous start limits so both methods accept them."""
+    rand = random.Random(seed)
+    fleets = []
+    while len(fleets) < num_fleets:
+        fleet, taken = {}, 0
+        for ship_type, size in SHIP_SIZES.iteritems():
+            vertical = rand.random() < 0.5
+            along = rand.randrange(LEGACY_LIMITS[ship_type])
+            across = rand.randrange(GRID_SIZE)
+            row, col = (along, across) if vertical else (across, along)
+            mask = ship_mask(size, row, col, vertical)
+            if taken & mask:
+                break
+            taken |= mask
+            fleet[ship_type] = [row, col, vertical]
+        else:
+            fleets.append(fleet)
+    return fleets
+
+
+def legacy_place(fleet):
+    board = Board()
+    for ship_type, (row, col, vertical) in fleet.iteritems():
+        if ship_type == 'aircraft carrier':
+            limit, size = 5, 5
+        elif ship_type == 'battleship':
+            limit, size = 6, 4
+        elif ship_type == 'submarine':
+            limit, size = 7, 3
+        elif ship_type == 'destroyer':
+            limit, size = 7, 3
+        elif ship_type == 'patrol boat':
+            limit, size = 8, 2
+        else:
+            raise ValueError(ship_type)
+        if (row if vertical else col) >= limit:
+            raise ValueError(ship_type)
+        for offset in range(size):
+            if vertical:
+                board.place(row + offset, col, ship_type=ship_type)
+            else:
+                board.place(row, col + offset, ship_type=ship_type)
+    return board
+
+
+def table_place(fleet):
+    board = Board()
+    board.place_fleet(fleet_masks(fleet))
+    return board
+
+
+def main(num_fleets=5000):
+    fleets = legacy_fleets(num_fleets)
+    for fleet in fleets[:100]:
+        assert legacy_place(fleet) == table_place(fleet)
+
+    for name, func in (('if/elif + per cell', legacy_place),
+                       ('placement table', table_place)):
+        elapsed = min(timeit.repeat(lambda: [func(fleet) for fleet in fleets],
+                                    number=1, repeat=3))
+        print '{0:<20} {1:>8.2f}us per fleet'.format(name, elapsed / num_fleets * 1e6)
+
+    for fleet in random_fleets(100, seed=0):
+        table_place(fleet)
+    elapsed = min(timeit.repeat(lambda: random_fleets(num_fleets, seed=0), number=1, repeat=3))
+    print '{0:<20} {1:>8.0f} fleets/s'.format('random fleets', num_fleets / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Benchmark of the reminder cron, comparing the previous handler, which queried the games
+# of every user with an email in turn, against the single scan over games in progress
+# grouped by player. Reports the datastore RPCs, emails sent and time taken for a set of
+# users of whom only some have games in progress. The scan's send_reminders tasks are
+# run from the local task queue stub and included in its totals.
+# Requires the App Engine Python SDK, found through the APPENGINE_SDK environment
+# variable. Run from the repository root with:
+#     APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_reminders.py
+import logging
+import sys
+
+from _support import ROOT, RpcMeter, setup_testbed
+
+sys.path.insert(0, ROOT)
+
+from google.appengine.ext import ndb, testbed
+
+import main
+from game_models import Game
+from models import User
+
+
+def setup_users(num_users, active_every):
+    """Creates num_users users, where every active_every'th pair of users shares a game
+    in progress, and the rest have no games."""
+    users = [User(key=ndb.Key(User, 'user {0}'.format(num)), name='user {0}'.format(num),
+                  email='user{0}@example.com'.format(num)) for num in range(num_users)]
+    ndb.put_multi(users)
+    games = [Game.new_game(users[num].key, users[num + 1].key, users[num].name,
+                           users[num + 1].name)
+             for num in range(0, num_users - 1, 2 * active_every)]
+    return len(games)
+
+
+def legacy_reminders():
+    """The previous SendReminderEmail handler, building each email without sending it."""
+    sent = 0
+    for user in User.query(User.email != None):
+        games = Game.query(ndb.OR(Game.user_1 == user.key,
+                                  Game.user_2 == user.key)). \
+            filter(Game.game_over == False)
+        if games.count() > 0:
+            body = 'Hello {}, you have {} games in progress. Their keys are: {}'.format(
+                user.name, games.count(), ', '.join(game.key.urlsafe() for game in games))
+            logging.debug(body)
+            sent += 1
+    return sent
+
+
+def scan_reminders(bed):
+    """Runs the reminder scan and every task it enqueues, returning the emails sent."""
+    stub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    mail_stub = bed.get_stub(testbed.MAIL_SERVICE_NAME)
+    sent_before = len(mail_stub.get_sent_messages())
+    main.app.get_response('/crons/send_reminder')
+    while True:
+        pending = stub.get_filtered_tasks()
+        for queue_name in ('default', 'mail'):
+            stub.FlushQueue(queue_name)
+        if not pending:
+            break
+        for task in pending:
+            main.app.get_response(task.url, method=task.method, body=task.payload)
+    return len(mail_stub.get_sent_messages()) - sent_before
+
+
+def main_bench(num_users=1000, active_every=4):
+    bed = setup_testbed()
+    try:
+        num_games = setup_users(num_users, active_every)
+        meter = RpcMeter()
+        print '{0} users, {1} games in progress'.format(num_users, num_games)
+        for name, func in (('per user queries', legacy_reminders),
+                           ('single scan', lambda: scan_reminders(bed))):
+            sent = []
+            counts, elapsed = meter.measure(lambda: sent.append(func()))
+            print '{0:<18} {1:>6} emails {2:>8} datastore RPCs {3:>8.2f}s'.format(
+                name, sent[0], counts.services()['datastore_v3'], elapsed)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main_bench()
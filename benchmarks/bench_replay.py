@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Benchmark of the replay engine. Reports how many archived 200 move games a batch
+# replay builds per second, and the time taken to rebuild a game at a random move using
+# the replay's checkpoints, against replaying every move from the placed boards.
+# Run from the repository root with: python benchmarks/bench_replay.py
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_game_state import build_game
+from board import Board
+from game_state import GameState
+from replay import replay_games
+
+
+def full_replay(state, moves, move):
+    """Rebuilds the state after the first move moves by shooting every move in turn on
+        freshly placed boards, as replaying through Game.destroy_cell would."""
+    boards = [Board(ships=board.ships, fleet=board.fleet)
+              for board in (state.board_1, state.board_2)]
+    for grid, row, col in moves[:move]:
+        boards[grid - 1].shoot(row, col)
+    return GameState(board_1=boards[0], board_2=boards[1], moves=moves[:move])
+
+
+def main(num_games=2000, num_moves=200, lookups=2000):
+    games = []
+    for seed in range(num_games):
+        state = build_game(num_moves, seed=seed)
+        moves = list(state.moves)
+        state.archive_moves()
+        games.append((state, moves))
+
+    start = time.time()
+    replays = replay_games(games)
+    elapsed = time.time() - start
+    print 'batch replay: {0} games of {1} moves in {2:.2f}s, {3:.0f} games/s'.format(
+        num_games, num_moves, elapsed, num_games / elapsed)
+
+    rand = random.Random(0)
+    targets = [(rand.randrange(num_games), rand.randint(0, num_moves))
+               for _ in range(lookups)]
+    for index, move in targets[:100]:
+        assert replays[index].state_at(move) == full_replay(games[index][0],
+                                                            games[index][1], move)
+
+    def checkpointed():
+        for index, move in targets:
+            replays[index].state_at(move)
+
+    def from_start():
+        for index, move in targets:
+            full_replay(games[index][0], games[index][1], move)
+
+    for name, func in (('checkpointed state_at', checkpointed),
+                       ('replay from move 0', from_start)):
+        per_lookup = min(timeit.repeat(func, number=1, repeat=3)) / lookups * 1e6
+        print '{0:<24} {1:>8.1f}us per lookup'.format(name, per_lookup)
+
+
+if __name__ == '__main__':
+    main()
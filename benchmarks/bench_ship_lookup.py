@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Microbenchmark comparing how a hit cell's ship is found during Game.destroy_cell:
+# the previous scan over every ship's location list, a 100 entry cell index built from
+# the fleet masks when a board is first hit, and the current test of the cell's bit
+# against each ship's fleet mask, for the standard fleet and for larger synthetic fleets
+# on the same 10 x 10 grid. A move request decodes the game's boards afresh, so the
+# index would be built again for every hit.
+# Run from the repository root with: python benchmarks/bench_ship_lookup.py
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from board import Board, GRID_CELLS, GRID_SIZE
+
+SHIP_SIZES = [5, 4, 3, 3, 2]
+
+
+def fleet_cells(num_ships):
+    """Returns a list of (ship type, row, col) tuples for a fleet of num_ships ships,
+        laid out horizontally from the top left of the grid without overlapping.
+    """
+    cells, row, col = [], 0, 0
+    for ship_num in range(num_ships):
+        size = SHIP_SIZES[ship_num % len(SHIP_SIZES)]
+        if col + size > GRID_SIZE:
+            row, col = row + 1, 0
+        if row >= GRID_SIZE:
+            raise ValueError('A fleet of {0} ships does not fit on the grid'.format(num_ships))
+        cells.extend(('ship {0}'.format(ship_num), row, col + offset) for offset in range(size))
+        col += size + 1
+    return cells
+
+
+def scan_setup(cells):
+    """Builds the 2-D grid, ships and loc_ships dicts stored by the previous Game model."""
+    grid = [['-' for _ in range(GRID_SIZE)] for _ in range(GRID_SIZE)]
+    ships, loc_ships = {}, {}
+    for ship_type, row, col in cells:
+        grid[row][col] = '+'
+        ships[ship_type] = 1
+        loc_ships.setdefault(ship_type, []).append((row, col))
+    return ships, (grid, loc_ships)
+
+
+def scan_destroy(ships, state, row_int, col_int):
+    """The previous destroy_cell path: a 2-D grid update followed by the
+        update_ship_loc_values('unknown', ..., remove=True) scan.
+    """
+    grid, loc_ships = state
+    if grid[row_int][col_int] == '+':
+        if grid[row_int][col_int] != 'X':
+            grid[row_int][col_int] = 'X'
+        for ship, locations in loc_ships.iteritems():
+            if (row_int, col_int) in locations:
+                loc_ships[ship].remove((row_int, col_int))
+                if len(loc_ships[ship]) == 0:
+                    ships[ship] -= 1
+                return
+        raise ValueError("Those co-ordinates are not in the ship loc dict!")
+
+
+def mask_setup(cells):
+    """Builds a Board with the fleet mask of each ship, along with the ships dict."""
+    ships, board = {}, Board()
+    for ship_type, row, col in cells:
+        ships[ship_type] = 1
+        board.place(row, col, ship_type=ship_type)
+    return ships, board
+
+
+def mask_destroy(ships, board, row_int, col_int):
+    """The current destroy_cell path: a bitboard shot followed by the fleet mask scan."""
+    if board.shoot(row_int, col_int):
+        ship = board.ship_at(row_int, col_int)
+        if board.sunk(ship):
+            ships[ship] -= 1
+
+
+def cell_index(board):
+    """Returns the ship type placed on each of the 100 cells of a board, or None."""
+    index = [None] * GRID_CELLS
+    for ship_type, mask in board.fleet.iteritems():
+        while mask:
+            low_bit = mask & -mask
+            index[low_bit.bit_length() - 1] = ship_type
+            mask ^= low_bit
+    return index
+
+
+def index_destroy(ships, board, row_int, col_int):
+    """A bitboard shot followed by a lookup in a cell index built for the hit, as the
+        board decoded by each move request would build it."""
+    if board.shoot(row_int, col_int):
+        ship = cell_index(board)[row_int * GRID_SIZE + col_int]
+        if board.sunk(ship):
+            ships[ship] -= 1
+
+
+def time_hits(setup, destroy, cells, trials):
+    """Returns the mean time in microseconds to destroy a single ship cell, hitting
+        every cell of the fleet in a random order on freshly built state each trial.
+    """
+    rand = random.Random(0)
+    order = [(row, col) for _, row, col in cells]
+    elapsed = 0.0
+    for _ in range(trials):
+        rand.shuffle(order)
+        ships, state = setup(cells)
+        start = time.time()
+        for row, col in order:
+            destroy(ships, state, row, col)
+        elapsed += time.time() - start
+    return elapsed / (trials * len(order)) * 1e6
+
+
+def main(trials=5000):
+    print '{0:>6} {1:>6} {2:>14} {3:>14} {4:>14}'.format(
+        'ships', 'cells', 'scan us/hit', 'index us/hit', 'mask us/hit')
+    for num_ships in (5, 10, 20):
+        cells = fleet_cells(num_ships)
+        scan = time_hits(scan_setup, scan_destroy, cells, trials)
+        index = time_hits(mask_setup, index_destroy, cells, trials)
+        mask = time_hits(mask_setup, mask_destroy, cells, trials)
+        print '{0:>6} {1:>6} {2:>14.3f} {3:>14.3f} {4:>14.3f}'.format(
+            num_ships, len(cells), scan, index, mask)
+
+
+if __name__ == '__main__':
+    main()
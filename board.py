@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# This contains the bitboard representation of a single players battle grid
+# for use with the Battleships API Game model.
+import binascii
+
+GRID_SIZE = 10
+GRID_CELLS = GRID_SIZE * GRID_SIZE
+
+# Number of bytes used to store a single 100 bit mask.
+MASK_BYTES = 13
+
+# Single character codes used to store the ship occupying each cell.
+SHIP_CODES = {
+    'aircraft carrier': 'A',
+    'battleship': 'B',
+    'submarine': 'S',
+    'destroyer': 'D',
+    'patrol boat': 'P'
+}
+CODE_SHIPS = dict((code, ship) for ship, code in SHIP_CODES.iteritems())
+EMPTY_CODE = '-'
+
+
+def cell_bit(row_int, col_int):
+    """Returns the single bit mask corresponding to a grid cell.
+    Args:
+        row_int (int): the row of the chosen cell, as an integer.
+        col_int (int): the column of the chosen cell, as an integer.
+    Returns:
+        An integer with only the bit for the selected cell set.
+    Raises:
+        ValueError: the co-ordinates are outside of the grid.
+    """
+    if not (0 <= row_int < GRID_SIZE and 0 <= col_int < GRID_SIZE):
+        raise ValueError("Rows and columns must be between 0 and {0}".format(GRID_SIZE - 1))
+    return 1 << (row_int * GRID_SIZE + col_int)
+
+
+def popcount(mask):
+    """Returns the number of set bits within a mask as an integer."""
+    return bin(mask).count('1')
+
+
+def mask_locations(mask):
+    """Returns the cells set within a mask as a list of (row, col) tuples, ordered
+        by row and then by column.
+    Args:
+        mask (int): the bitmask to expand.
+    Returns:
+        A list of tuples in the format: [(row_number, column_number), ..]
+    """
+    locations = []
+    while mask:
+        low_bit = mask & -mask
+        cell = low_bit.bit_length() - 1
+        locations.append(divmod(cell, GRID_SIZE))
+        mask ^= low_bit
+    return locations
+
+
+def pack_mask(mask):
+    """Packs a 100 bit mask into a fixed width byte string."""
+    return binascii.unhexlify('%0*x' % (MASK_BYTES * 2, mask))
+
+
+def unpack_mask(data):
+    """Unpacks a fixed width byte string created by pack_mask into an integer."""
+    return int(binascii.hexlify(data), 16)
+
+
+class Board(object):
+    """A single players battle grid, held as a pair of integer bitmasks. Each cell
+        (row, col) corresponds to bit (row * 10 + col) of each mask.
+    Attributes:
+        ships: A bitmask of every cell that a ship has been placed on.
+        shots: A bitmask of every cell that has been attacked.
+        fleet: A dict of ship type to the bitmask of cells that ship was placed on, so
+            a hit cell's ship is found by testing its bit against each ship's mask.
+    """
+
+    def __init__(self, ships=0, shots=0, index=None, fleet=None):
+        self.ships = ships
+        self.shots = shots
+        self.fleet = dict(fleet or {})
+        # index is the ship type placed on each cell, as stored by Board.pack().
+        for cell, ship_type in enumerate(index or ()):
+            if ship_type is not None:
+                self.fleet[ship_type] = self.fleet.get(ship_type, 0) | (1 << cell)
+
+    def __eq__(self, other):
+        return (isinstance(other, Board) and self.ships == other.ships and
+                self.shots == other.shots and self.fleet == other.fleet)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Board(ships={0:#x}, shots={1:#x})'.format(self.ships, self.shots)
+
+    @property
+    def intact(self):
+        """The bitmask of ship cells that have not yet been destroyed."""
+        return self.ships & ~self.shots
+
+    def status(self, row_int, col_int):
+        """Returns '+' for an intact ship cell, 'X' for a destroyed cell, else '-'."""
+        bit = cell_bit(row_int, col_int)
+        if self.shots & bit:
+            return 'X'
+        if self.ships & bit:
+            return '+'
+        return '-'
+
+    def place(self, row_int, col_int, ship_type=None):
+        """Marks the selected cell as occupied by a ship, adding it to the fleet mask of
+            the ship type if one is given.
+        """
+        bit = cell_bit(row_int, col_int)
+        self.ships |= bit
+        if ship_type is not None:
+            self.fleet[ship_type] = self.fleet.get(ship_type, 0) | bit
+
+    def place_fleet(self, fleet):
+        """Places a fleet of ships, given as a dict of ship type to the bitmask of the
+            cells it covers. No ship is placed unless every ship can be.
+        Raises:
+            ValueError: a ship overlaps a ship already on the board, or its ship type
+                has already been placed.
+        """
+        for ship_type, mask in fleet.iteritems():
+            if ship_type in self.fleet or self.ships & mask:
+                raise ValueError("The {0} overlaps a ship already on the grid!".format(ship_type))
+        for ship_type, mask in fleet.iteritems():
+            self.ships |= mask
+            self.fleet[ship_type] = mask
+
+    def ship_at(self, row_int, col_int):
+        """Returns the ship type occupying the selected cell, or None if there is none."""
+        bit = cell_bit(row_int, col_int)
+        for ship_type, mask in self.fleet.iteritems():
+            if mask & bit:
+                return ship_type
+        return None
+
+    def sunk(self, ship_type):
+        """Returns True if every cell of the selected ship type has been destroyed."""
+        return not self.fleet.get(ship_type, 0) & ~self.shots
+
+    def ship_locations(self):
+        """Returns the intact cells of each ship type, in the format:
+            {'ship_type': [(row, col), ..], ..}
+        """
+        return dict((ship_type, mask_locations(self.fleet.get(ship_type, 0) & ~self.shots))
+                    for ship_type in SHIP_CODES)
+
+    def shoot(self, row_int, col_int):
+        """Marks the selected cell as destroyed.
+        Returns:
+            True if the cell was occupied by a ship, else False.
+        Raises:
+            ValueError: the cell has already been destroyed.
+        """
+        bit = cell_bit(row_int, col_int)
+        if self.shots & bit:
+            raise ValueError("The selected grid cell is already destroyed!")
+        self.shots |= bit
+        return bool(self.ships & bit)
+
+    def intact_cells(self):
+        """Returns the number of ship cells still intact as an integer."""
+        return popcount(self.intact)
+
+    def destroyed_cells(self):
+        """Returns the number of destroyed cells as an integer."""
+        return popcount(self.shots)
+
+    def destroyed_locations(self):
+        """Returns the destroyed cells in the format [[row, col], ..]."""
+        return [list(loc) for loc in mask_locations(self.shots)]
+
+    def to_grid(self):
+        """Returns the board as a 2-D list of '-', '+' and 'X' strings, matching the
+            grid format stored by earlier versions of the Game model.
+        """
+        return [[self.status(row, col) for col in range(GRID_SIZE)]
+                for row in range(GRID_SIZE)]
+
+    @classmethod
+    def from_grid(cls, grid, hits=()):
+        """Builds a Board from a legacy 2-D list grid. Since a destroyed ship cell and a
+            missed shot are both stored as 'X', the cells recorded as hits within the
+            games history are required to restore the ships mask.
+        Args:
+            grid: A 2-D list of '-', '+' and 'X' strings.
+            hits: A sequence of (row, col) tuples that were recorded as ship hits.
+        Returns:
+            The equivalent Board object.
+        """
+        board = cls()
+        for row_num, row in enumerate(grid):
+            for col_num, cell in enumerate(row):
+                if cell == '+':
+                    board.place(row_num, col_num)
+                elif cell == 'X':
+                    board.shots |= cell_bit(row_num, col_num)
+        for row_num, col_num in hits:
+            board.place(row_num, col_num)
+        return board
+
+    def pack(self):
+        """Returns the board as a fixed width byte string: the ships and shots masks,
+            followed by a single ship code per cell. This is the format stored by the
+            board_1 and board_2 Game properties before game_state.GameState was added.
+        """
+        codes = [EMPTY_CODE] * GRID_CELLS
+        for ship_type, mask in self.fleet.iteritems():
+            for row_int, col_int in mask_locations(mask):
+                codes[row_int * GRID_SIZE + col_int] = SHIP_CODES[ship_type]
+        return pack_mask(self.ships) + pack_mask(self.shots) + ''.join(codes)
+
+    @classmethod
+    def unpack(cls, data):
+        """Returns a Board from a byte string created by Board.pack(). Boards packed
+            before the cell codes were added are returned with an empty fleet.
+        """
+        codes = data[2 * MASK_BYTES:]
+        return cls(ships=unpack_mask(data[:MASK_BYTES]),
+                   shots=unpack_mask(data[MASK_BYTES:2 * MASK_BYTES]),
+                   index=[CODE_SHIPS.get(code) for code in codes])
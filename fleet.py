@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# This contains the fleet placement table. Every legal placement of each ship type, in
+# either orientation, is precomputed as a board bitmask when the module is loaded, so a
+# ship's placement is validated by a single table lookup, and a whole fleet's overlaps
+# by ANDing its masks together. Random fleets are drawn from the same table.
+import collections
+import random
+
+from board import GRID_SIZE, GRID_CELLS
+
+# The size of each ship type, in the order ships are listed to users.
+SHIP_SIZES = collections.OrderedDict([
+    ('aircraft carrier', 5),
+    ('battleship', 4),
+    ('submarine', 3),
+    ('destroyer', 3),
+    ('patrol boat', 2),
+])
+
+
+def ship_mask(size, row_int, col_int, vertical=True):
+    """Returns the bitmask of the cells covered by a ship, or 0 if it does not fit.
+    Args:
+        size (int): The number of cells the ship covers.
+        row_int (int): The first row of the ship, its uppermost cell if vertical.
+        col_int (int): The first column of the ship, its left-most cell if horizontal.
+        vertical (Boolean): True for vertical, False for horizontal. True by default.
+    Returns:
+        The mask of every cell of the ship, or 0 if any cell would be outside the grid.
+    """
+    if not (0 <= row_int < GRID_SIZE and 0 <= col_int < GRID_SIZE):
+        return 0
+    if (row_int if vertical else col_int) + size > GRID_SIZE:
+        return 0
+    step = GRID_SIZE if vertical else 1
+    first = row_int * GRID_SIZE + col_int
+    mask = 0
+    for offset in range(size):
+        mask |= 1 << (first + offset * step)
+    return mask
+
+
+def _placement_table(size):
+    """Returns the horizontal and vertical tables of a ship size, each holding the mask
+        of the ship placed from every cell of the grid, or 0 where it does not fit."""
+    return tuple(tuple(ship_mask(size, cell // GRID_SIZE, cell % GRID_SIZE, vertical)
+                       for cell in range(GRID_CELLS))
+                 for vertical in (False, True))
+
+
+# PLACEMENTS[ship_type][vertical][row * GRID_SIZE + col] is the mask of the ship placed
+# with its first cell at (row, col), or 0 if it does not fit there.
+PLACEMENTS = dict((ship_type, _placement_table(size))
+                  for ship_type, size in SHIP_SIZES.iteritems())
+
+# LEGAL_PLACEMENTS[ship_type] lists every placement of the ship which fits on the grid,
+# as (mask, row, col, vertical) tuples.
+LEGAL_PLACEMENTS = dict(
+    (ship_type, tuple((mask, cell // GRID_SIZE, cell % GRID_SIZE, vertical)
+                      for vertical in (False, True)
+                      for cell, mask in enumerate(table[vertical]) if mask))
+    for ship_type, table in PLACEMENTS.iteritems())
+
+
+def placement_mask(ship_type, row_int, col_int, vertical=True):
+    """Returns the bitmask of the cells covered by a ship, from the placement table.
+    Args:
+        ship_type (str): The type of ship, one of the keys of SHIP_SIZES.
+        row_int (int): The first row of the ship, its uppermost cell if vertical.
+        col_int (int): The first column of the ship, its left-most cell if horizontal.
+        vertical (Boolean): True for vertical, False for horizontal. True by default.
+    Raises:
+        ValueError: the ship type is not valid, or the ship does not fit on the grid.
+    """
+    table = PLACEMENTS.get(ship_type)
+    if table is None:
+        raise ValueError("The input ship type {0} is not valid! Please use either "
+                         "'aircraft carrier', 'battleship', 'submarine', 'destroyer' or "
+                         "'patrol boat'!".format(ship_type))
+    mask = 0
+    if 0 <= row_int < GRID_SIZE and 0 <= col_int < GRID_SIZE:
+        mask = table[bool(vertical)][row_int * GRID_SIZE + col_int]
+    if not mask:
+        raise ValueError("{0} is size {1} and cannot fit there!".format(
+            ship_type, SHIP_SIZES[ship_type]))
+    return mask
+
+
+def fleet_masks(ships):
+    """Validates the placement of a fleet, returning the bitmask of each of its ships.
+    Args:
+        ships (dict): The placement of each ship, in the format:
+            {'ship_type': [row, col, vertical=True/False], ..}
+    Returns:
+        A dict of ship type to the bitmask of the cells it covers.
+    Raises:
+        ValueError: a ship type is not valid, a ship does not fit on the grid, or two
+            ships overlap.
+    """
+    masks = {}
+    taken = 0
+    for ship_type, (row_int, col_int, vertical) in sorted(ships.iteritems()):
+        mask = placement_mask(ship_type, row_int, col_int, vertical)
+        if taken & mask:
+            raise ValueError("The {0} overlaps another ship!".format(ship_type))
+        taken |= mask
+        masks[ship_type] = mask
+    return masks
+
+
+def random_fleet(rand=random):
+    """Returns a random placement of the whole fleet, chosen uniformly from every legal
+        fleet. Each ship is drawn from all of its placements, and the fleet is drawn
+        again if two ships overlap, which happens for around 3 in 5 draws.
+    Args:
+        rand: The random.Random instance to draw from, the random module by default.
+    Returns:
+        The placement of each ship, in the format taken by Game.insert_user_ships:
+        {'ship_type': [row, col, vertical=True/False], ..}
+    """
+    while True:
+        ships = {}
+        taken = 0
+        for ship_type in SHIP_SIZES:
+            mask, row_int, col_int, vertical = rand.choice(LEGAL_PLACEMENTS[ship_type])
+            if taken & mask:
+                break
+            taken |= mask
+            ships[ship_type] = [row_int, col_int, vertical]
+        else:
+            return ships
+
+
+def random_fleets(count, seed=None):
+    """Returns count random fleets, as generated by random_fleet, for simulations.
+    Args:
+        count (int): The number of fleets to generate.
+        seed: The seed of the fleets, so the same seed returns the same fleets. None to
+            seed from the system.
+    Returns:
+        A list of the placements of each fleet, in the format returned by random_fleet.
+    """
+    rand = random.Random(seed)
+    return [random_fleet(rand) for _ in xrange(count)]
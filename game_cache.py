@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# This contains the memcache cache of Game entities, which holds each game's encoded
+# entity along with its version. Entries are locked before a game is stored and
+# replaced once the write commits, so a game is never served older than its last
+# committed version.
+import collections
+import sys
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+# Memcache key of a cached game, formatted with the urlsafe game key. Each entry is a
+# (version, encoded entity) tuple, or (version, None) while that version is written.
+MEMCACHE_GAME = 'GAME:{0}'
+# Seconds a lock is held for if the write it protects never completes.
+LOCK_EXPIRY = 30
+CAS_RETRIES = 3
+
+# Memcache key prefix of the counters shared by every instance.
+MEMCACHE_STATS_PREFIX = 'GAME_CACHE_STATS:'
+STATS = ('hits', 'misses', 'bypasses', 'evictions')
+# Number of events counted by an instance before its counts are added to memcache.
+STATS_FLUSH_EVENTS = 50
+STATS_FLUSH_SECONDS = 10
+# Number of game keys an instance remembers caching, to recognise evicted entries.
+RECENT_KEYS = 10000
+
+# Guards the counters and recent keys, which are shared by concurrent requests.
+_lock = threading.Lock()
+_pending = collections.Counter()
+_last_flush = [time.time()]
+_recent = collections.OrderedDict()
+
+
+def _count(stat):
+    with _lock:
+        _pending[stat] += 1
+        due = (sum(_pending.values()) >= STATS_FLUSH_EVENTS or
+               time.time() - _last_flush[0] >= STATS_FLUSH_SECONDS)
+    if due:
+        flush_stats()
+
+
+def flush_stats():
+    """Adds the counts made by this instance to the counters held in memcache."""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    if pending:
+        memcache.offset_multi(pending, key_prefix=MEMCACHE_STATS_PREFIX, initial_value=0)
+
+
+def stats():
+    """Returns the cache hits, misses, bypasses and evictions counted by every instance,
+        in the format: {'hits': int, 'misses': int, 'bypasses': int, 'evictions': int}
+        A bypass is a read made while the game was being written, which is served from
+        the datastore. An eviction is a miss on a game this instance had cached.
+    """
+    flush_stats()
+    counts = memcache.get_multi(STATS, key_prefix=MEMCACHE_STATS_PREFIX)
+    return dict((stat, int(counts.get(stat, 0))) for stat in STATS)
+
+
+def _remember(key):
+    with _lock:
+        _recent.pop(key, None)
+        _recent[key] = True
+        if len(_recent) > RECENT_KEYS:
+            _recent.popitem(last=False)
+
+
+def _was_cached(key):
+    """Returns True if this instance has cached the game with the given key."""
+    with _lock:
+        return key in _recent
+
+
+def _encode(entity):
+    return entity._to_pb().SerializePartialToString()
+
+
+def _decode(data):
+    return ndb.ModelAdapter().pb_to_entity(entity_pb.EntityProto(data))
+
+
+@ndb.tasklet
+def get_async(key):
+    """Returns a Future of the game with the given key, read from the cache, or from the
+        datastore if it is not cached or is being written. Games read from the
+        datastore are added to the cache, unless an entry has been stored since. Within
+        a transaction the game is always read from the datastore.
+    Args:
+        key: The ndb.Key of the game.
+    """
+    if ndb.in_transaction():
+        entity = yield key.get_async()
+        raise ndb.Return(entity)
+    ctx = ndb.get_context()
+    cache_key = MEMCACHE_GAME.format(key.urlsafe())
+    entry = yield ctx.memcache_get(cache_key)
+    if entry is not None and entry[1] is not None:
+        _count('hits')
+        raise ndb.Return(_decode(entry[1]))
+
+    entity = yield key.get_async()
+    if entry is not None:
+        _count('bypasses')
+    else:
+        _count('evictions' if _was_cached(key) else 'misses')
+        if entity is not None:
+            # add only succeeds if no lock or newer version has been stored since.
+            yield ctx.memcache_add(cache_key, (entity.version, _encode(entity)))
+            _remember(key)
+    raise ndb.Return(entity)
+
+
+def lock(entity):
+    """Marks the cached entry of a game as being written, so reads are served from the
+        datastore until the new version is stored. Called before the game is put."""
+    memcache.set(MEMCACHE_GAME.format(entity.key.urlsafe()), (entity.version, None),
+                 time=LOCK_EXPIRY)
+
+
+def store(key, version, data):
+    """Replaces the cached entry of a game with a newly committed version, unless a
+        later version has already been stored or locked.
+    Args:
+        key: The ndb.Key of the game.
+        version: The committed version of the game.
+        data: The encoded game, as returned by _encode.
+    """
+    client = memcache.Client()
+    cache_key = MEMCACHE_GAME.format(key.urlsafe())
+    for _ in range(CAS_RETRIES):
+        entry = client.gets(cache_key)
+        if entry is None:
+            if client.add(cache_key, (version, data)):
+                break
+        elif entry[0] > version:
+            return
+        elif client.cas(cache_key, (version, data)):
+            break
+    else:
+        # the entry could not be replaced, so remove it rather than leave it stale.
+        client.delete(cache_key)
+        return
+    _remember(key)
+
+
+def stored(entity):
+    """Stores a game in the cache once the current transaction commits, or immediately
+        if there is none. Called after the game has been put."""
+    key, version, data = entity.key, entity.version, _encode(entity)
+    ndb.get_context().call_on_commit(lambda: store(key, version, data))
+
+
+def evict(key):
+    """Locks the cached entry of a game against every version, so it is read from the
+        datastore until the lock expires. Called before the game is deleted, so a read
+        made before the delete cannot add the game back to the cache afterwards."""
+    memcache.set(MEMCACHE_GAME.format(key.urlsafe()), (sys.maxint, None), time=LOCK_EXPIRY)
+    with _lock:
+        _recent.pop(key, None)
@@ -1,78 +1,139 @@
 #!/usr/bin/env python
 # This contains the Game model classes and GameForm message classes for use
 # with the Battleships API.  
+import itertools
+import time
 from datetime import date
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
-from models import User, Score
+from board import Board
+from fleet import fleet_masks, random_fleet, ship_mask
+import game_cache
+from game_state import GameState, MOVE_CHUNK_SIZE, encode_moves, decode_moves
+from replay import Replay
+import tasks
+from models import User, UserStatsShard, Score
 from models import StringMessage, MakeMoveForm, \
     ScoreForms, UserForm, UserForms, InsertShipsForms
 
+# Memcache key of the ships remaining entry of a single game in progress, formatted with
+# the urlsafe game key.
+MEMCACHE_SHIPS_REMAINING = 'SHIPS_REMAINING:{0}'
+# Memcache key of the (move count, game over) entry of a game, formatted with the urlsafe
+# game key, which clients long-polling the move log wait on instead of reading the game.
+MEMCACHE_MOVE_COUNT = 'MOVE_COUNT:{0}'
+# Seconds between checks of the move count entry while waiting for a move.
+MOVE_POLL_INTERVAL = 0.5
+
+
+class BoardProperty(ndb.BlobProperty):
+    """Stores a board.Board object as its packed (ships, shots) bitmask pair."""
+
+    def _validate(self, value):
+        if not isinstance(value, Board):
+            raise TypeError('Expected a Board, got {0!r}'.format(value))
+
+    def _to_base_type(self, value):
+        return value.pack()
+
+    def _from_base_type(self, value):
+        return Board.unpack(value)
+
+
+class GameStateProperty(ndb.BlobProperty):
+    """Stores a game_state.GameState object using its compact versioned encoding. The
+        stored bytes are only decoded when the property is first accessed.
+    """
+
+    def _validate(self, value):
+        if not isinstance(value, GameState):
+            raise TypeError('Expected a GameState, got {0!r}'.format(value))
+
+    def _to_base_type(self, value):
+        return value.encode()
+
+    def _from_base_type(self, value):
+        return GameState.decode(value)
+
 
 class Game(ndb.Model):
     """Game object for storing each game within the database.
     Attributes:
-        grid_1: A 2-D list representing user 1's 100 square grid. Stored as an
-            NDB PickleProperty.
-        grid_2: A 2-D list representing user 2's 100 square grid. Stored as an
-            NDB PickleProperty.
-        ships_1: A Python dict of the current ships on grid 1. NDB PickleProperty.
-        ships_2: A Python dict of the current ships on grid 2. NDB PickleProperty.
-        loc_ships_1: A python dict with the locations of current ships throughout grid 1, 
-            stored as an NDB PickleProperty.
-        loc_ships_2: A python dict with the locations of current ships throughout grid 2,
-            stored as an NDB PickleProperty.
+        state: A game_state.GameState holding both users boards, fleets and the move
+            log, stored as a single versioned binary GameStateProperty.
         next_move: The username who is to make a move next.
         user_1: The key corresponding to user 1's User key.
         user_2: The key corresponding to user 2's User key.
+        user_1_name: The name of user 1, stored when the game is created so it can be
+            displayed without fetching the User.
+        user_2_name: The name of user 2, stored when the game is created.
         game_over: Boolean True if the game is over, False if still in progress.
         winner: Stores the key corresponding to the winners User key when game ends.
-        history: A dict that stores the history of moves throughout the game for both
-            grid 1 and grid 2. Each grid is a dict key, and their values corresponding
-            to a sequence of tuples detailing the move, like so: [row, column, hit or miss]
+        players: The keys of user 1 and user 2, computed when the game is saved, so that
+            the games of every player can be scanned in player order.
+        version: The number of times the game has been saved, incremented by every put
+            so a move validated against an older version of the game can be rejected,
+            and so cached copies of the game can be ordered.
+        legacy_*: The properties stored by games created before the GameState was
+            introduced: pickled 2-D list grids, packed boards, and pickled ships,
+            ship locations and history dicts. They are converted into a GameState when
+            the game is first read, and cleared when the game is next saved.
+    Games are cached by game_cache rather than ndb's own memcache caching: the cached
+    copy is locked while a game is written, and replaced once the write commits.
     """
-    grid_1 = ndb.PickleProperty(required=True)
-    grid_2 = ndb.PickleProperty(required=True)
-    ships_1 = ndb.PickleProperty(required=True)  # dict of user 1's current ships
-    ships_2 = ndb.PickleProperty(required=True)
-    loc_ships_1 = ndb.PickleProperty(required=True)  # locations of user 1's ships
-    loc_ships_2 = ndb.PickleProperty(required=True)
+    state = GameStateProperty()
     next_move = ndb.KeyProperty(required=True)  # The User's whose turn it is
     user_1 = ndb.KeyProperty(required=True, kind='User')
     user_2 = ndb.KeyProperty(required=True, kind='User')
+    user_1_name = ndb.StringProperty(indexed=False)
+    user_2_name = ndb.StringProperty(indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     winner = ndb.KeyProperty()
-    history = ndb.PickleProperty(required=True)
+    players = ndb.ComputedProperty(lambda self: [self.user_1, self.user_2], repeated=True)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    legacy_grid_1 = ndb.PickleProperty('grid_1')
+    legacy_grid_2 = ndb.PickleProperty('grid_2')
+    legacy_board_1 = BoardProperty('board_1')
+    legacy_board_2 = BoardProperty('board_2')
+    legacy_ships_1 = ndb.PickleProperty('ships_1')
+    legacy_ships_2 = ndb.PickleProperty('ships_2')
+    legacy_loc_ships_1 = ndb.PickleProperty('loc_ships_1')
+    legacy_loc_ships_2 = ndb.PickleProperty('loc_ships_2')
+    legacy_history = ndb.PickleProperty('history')
+
+    _use_memcache = False
 
     @classmethod
-    def new_game(cls, user_1, user_2):
-        """Creates and returns a new game using two input username args as strings.
+    def new_game(cls, user_1, user_2, user_1_name=None, user_2_name=None, ships_1=None,
+                 ships_2=None):
+        """Creates and returns a new game using two input User keys. If fleets are given
+            they are placed before the game is stored, so a fully set up game is written
+            with a single put.
         Args:
-            user_1 (str): The username of user_1.
-            user_2 (str): The username of user_2.
+            user_1: The User key of user_1.
+            user_2: The User key of user_2.
+            user_1_name (str): The username of user_1, stored on the game.
+            user_2_name (str): The username of user_2, stored on the game.
+            ships_1 (dict): Optional. The ships of user_1, in the format taken by
+                insert_user_ships.
+            ships_2 (dict): Optional. The ships of user_2, in the same format.
         Returns:
             The created game object.
+        Raises:
+            ValueError: a fleet is invalid, in which case the game is not stored.
         """
         game = Game(user_1=user_1,
                     user_2=user_2,
+                    user_1_name=user_1_name,
+                    user_2_name=user_2_name,
                     next_move=user_1)
-        # create an empty 10 x 10 grid and update grid 1 and 2.
-        rows = [y for y in range(10)]
-        columns = [x for x in range(10)]
-        new_board = [['-' for row in rows] for col in columns]
-        game.grid_1 = game.grid_2 = new_board
-        # create a dict object with default 0 ships of each type.
-        empty_ships = {'aircraft carrier': 0, 'battleship': 0,
-                       'submarine': 0, 'destroyer': 0,
-                       'patrol boat': 0}
-        # set user 1 and user 2 ships to the default
-        game.ships_1 = game.ships_2 = empty_ships
-        empty_locs = {'aircraft carrier': [], 'battleship': [],
-                      'submarine': [], 'destroyer': [],
-                      'patrol boat': []}
-        game.loc_ships_1 = game.loc_ships_2 = empty_locs
-        # Set initial empty history dict for game.
-        game.history = {'grid_1': [], 'grid_2': []}
+        # create empty 10 x 10 boards for grid 1 and 2, and an empty move log.
+        game.state = GameState()
+        if ships_1:
+            game.insert_user_ships(ships_1)
+        if ships_2:
+            game.insert_user_ships(ships_2, user='user_2')
         game.put()
         return game
 
@@ -83,11 +144,202 @@ class Game(ndb.Model):
         Returns:
             An integer corresponding to the sum of the number of ships currently on the grid.
         """
-        if grid is 1:
-            # Sum of the ships dict values.
-            return sum(self.ships_1.values())
-        else:
-            return sum(self.ships_2.values())
+        return sum(self.get_state().ships(grid).values())
+
+    @property
+    def grid_1(self):
+        """User 1's grid rendered as a 2-D list of '-', '+' and 'X' strings."""
+        return self.board(grid=1).to_grid()
+
+    @property
+    def grid_2(self):
+        """User 2's grid rendered as a 2-D list of '-', '+' and 'X' strings."""
+        return self.board(grid=2).to_grid()
+
+    @property
+    def ships_1(self):
+        """A dict of the number of each ship type still afloat on grid 1."""
+        return self.get_state().ships(grid=1)
+
+    @property
+    def ships_2(self):
+        """A dict of the number of each ship type still afloat on grid 2."""
+        return self.get_state().ships(grid=2)
+
+    @property
+    def loc_ships_1(self):
+        """A dict with the locations of the intact ship cells of each ship on grid 1."""
+        return self.board(grid=1).ship_locations()
+
+    @property
+    def loc_ships_2(self):
+        """A dict with the locations of the intact ship cells of each ship on grid 2."""
+        return self.board(grid=2).ship_locations()
+
+    @property
+    def history(self):
+        """A dict that stores the history of moves throughout the game for both grid 1
+            and grid 2. Each grid is a dict key, and their values corresponding to a
+            sequence of tuples detailing the move, like so: [row, column, hit or miss]
+        """
+        return self.get_state().history(self.get_moves())
+
+    def get_moves(self, since=0):
+        """Returns the moves made after the first since moves, reading any archived
+            chunks of the move log they include.
+        Args:
+            since (int): The number of moves to skip, 0 by default.
+        Returns:
+            A list of (grid, row, col) tuples in the order the moves were made.
+        """
+        return self.get_moves_async(since).get_result()
+
+    @ndb.tasklet
+    def get_moves_async(self, since=0):
+        """Asynchronous version of get_moves, returning a Future. The archived chunks
+            needed are read with one batch get, so no query is made."""
+        state = self.get_state()
+        if since >= state.archived:
+            raise ndb.Return(state.moves[since - state.archived:])
+        first = since // MOVE_CHUNK_SIZE + 1
+        chunks = yield ndb.get_multi_async(self.move_chunk_keys(first=first))
+        moves = []
+        for chunk in chunks:
+            moves.extend(decode_moves(chunk.moves))
+        raise ndb.Return(moves[since - (first - 1) * MOVE_CHUNK_SIZE:] + state.moves)
+
+    def move_chunk_keys(self, first=1):
+        """Returns the keys of the archived MoveChunks of the game, from chunk first."""
+        return [MoveChunk.chunk_key(self.key, number)
+                for number in range(first, self.get_state().archived // MOVE_CHUNK_SIZE + 1)]
+
+    def replay(self):
+        """Returns a replay.Replay of the game, which rebuilds it as it stood after any
+            move.
+        Raises:
+            ValueError: the move log does not match the boards.
+        """
+        return Replay(self.get_state(), self.get_moves())
+
+    @classmethod
+    def replays(cls, games):
+        """Returns a replay.Replay of each of a sequence of games, reading the archived
+            move log chunks of every game with a single batch get.
+        Args:
+            games: An iterable of Game entities.
+        Returns:
+            A list of Replay objects, in the order of the games.
+        """
+        games = list(games)
+        chunk_keys = [game.move_chunk_keys() for game in games]
+        chunks = iter(ndb.get_multi([key for keys in chunk_keys for key in keys]))
+        replays = []
+        for game, keys in zip(games, chunk_keys):
+            moves = []
+            for chunk in itertools.islice(chunks, len(keys)):
+                moves.extend(decode_moves(chunk.moves))
+            replays.append(Replay(game.get_state(), moves + game.get_state().moves))
+        return replays
+
+    def at_move(self, move, replay=None):
+        """Returns an unsaved copy of the game as it stood after its first move moves.
+            Users alternate turns from user 1, so the next move is found from the number
+            of moves made, and the game is only over after its final move.
+        Args:
+            move (int): The number of moves to replay, where 0 is the game as placed.
+            replay: An optional replay.Replay of the game, built if not given.
+        Returns:
+            A Game entity, which must not be put.
+        Raises:
+            ValueError: the move is outside of the game.
+        """
+        replay = replay or self.replay()
+        game = Game(key=self.key, **self.to_dict(exclude=['players']))
+        game.state = replay.state_at(move)
+        if move < len(replay):
+            game.game_over, game.winner = False, None
+            game.next_move = self.user_1 if move % 2 == 0 else self.user_2
+        return game
+
+    def get_state(self):
+        """Returns the GameState of the game. Games stored before the GameState was
+            introduced are converted from their legacy properties on first access.
+        Returns:
+            The game_state.GameState object for the game.
+        """
+        if self.state is None:
+            self.state = GameState.from_legacy(
+                self.legacy_history,
+                grids=(self.legacy_grid_1, self.legacy_grid_2),
+                boards=(self.legacy_board_1, self.legacy_board_2),
+                loc_ships=(self.legacy_loc_ships_1, self.legacy_loc_ships_2))
+        return self.state
+
+    def board(self, grid=1):
+        """Returns the Board object for the selected grid.
+        Args:
+            grid: Set to either 1 or 2, to indicate which grid is selected. 1 by default.
+        Returns:
+            The board.Board object for the selected grid.
+        """
+        return self.get_state().board(grid)
+
+    def record_move(self, grid, row_int, col_int):
+        """Appends an attack on the selected grid to the games move log.
+        Args:
+            grid (int): The grid that was attacked, either 1 or 2.
+            row_int (int): the row of the attacked cell, as an integer.
+            col_int (int): the column of the attacked cell, as an integer.
+        """
+        self.get_state().record_move(grid, row_int, col_int)
+
+    def _pre_put_hook(self):
+        """Ensure games stored in the legacy format are converted to a GameState, and
+            their legacy properties cleared, before the game is stored. Increments the
+            version of the game and locks its cached copy until the put commits.
+        """
+        self.get_state()
+        self.legacy_grid_1 = self.legacy_grid_2 = None
+        self.legacy_board_1 = self.legacy_board_2 = None
+        self.legacy_ships_1 = self.legacy_ships_2 = None
+        self.legacy_loc_ships_1 = self.legacy_loc_ships_2 = None
+        self.legacy_history = None
+        if self.key is not None and self.key.id() is not None:
+            self._archive_moves()
+        self.version += 1
+        if self.key is not None and self.key.id() is not None:
+            game_cache.lock(self)
+
+    def _archive_moves(self):
+        """Stores every complete chunk of the move log as a MoveChunk, and removes it from
+            the game's state, so the game written by each move stays the same size
+            however long the game runs. Chunks are never rewritten, and storing one again
+            after a failed game put stores the same moves."""
+        chunks = self.get_state().archive_moves()
+        if chunks:
+            ndb.put_multi([MoveChunk(key=MoveChunk.chunk_key(self.key, number),
+                                     moves=encode_moves(moves))
+                           for number, moves in chunks])
+
+    def _post_put_hook(self, future):
+        """Replace the cached copy of the game once the put has committed."""
+        if future.get_exception() is None:
+            game_cache.stored(self)
+            entry = self.move_count_entry()
+            cache_key = MEMCACHE_MOVE_COUNT.format(self.key.urlsafe())
+            ndb.get_context().call_on_commit(lambda: memcache.set(cache_key, entry))
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        game_cache.evict(key)
+
+    @classmethod
+    def get_cached_async(cls, key):
+        """Returns a Future of the Game with the given key, read through the game cache.
+        Args:
+            key: The ndb.Key of the Game.
+        """
+        return game_cache.get_async(key)
 
     def total_ship_cells(self, grid=1):
         """Returns the number of cells still intact with '+' as an integer.
@@ -96,14 +348,7 @@ class Game(ndb.Model):
         Returns:
             An integer corresponding to the total ship cells on the selected grid.
         """
-        # set a ship cell counter to zero as default.
-        ship_count = 0
-        # set the ship grid accordingly.
-        ship_grid = "grid_1" if grid == 1 else 'grid_2'
-        # count the number of '+'s within each row.
-        for row in getattr(self, ship_grid):
-            ship_count += row.count('+')
-        return ship_count
+        return self.board(grid=grid).intact_cells()
 
     def total_destroyed_cells(self, grid=1):
         """Returns the total number of cells that are destroyed ('X') as an integer.
@@ -112,12 +357,7 @@ class Game(ndb.Model):
         Returns:
             An integer corresponding to the number of destroyed cells in the selected grid.
         """
-        # set the ship grid from the grid arg.
-        ship_grid = "grid_1" if grid == 1 else 'grid_2'
-        destroy_count = 0
-        for row in getattr(self, ship_grid):
-            destroy_count += row.count('X')
-        return destroy_count
+        return self.board(grid=grid).destroyed_cells()
 
     def destroyed_locations(self, grid=1):
         """Returns the locations of cells that are destroyed as a sequence
@@ -129,20 +369,12 @@ class Game(ndb.Model):
             A sequence of tuples that indicate the destroyed locations on the chosen grid, in the
             format: [(row_number, column_number), ..]
         """
-        ship_grid = "grid_1" if grid == 1 else 'grid_2'
-        row_loc, col_loc = [], []
-        for row_num, row in enumerate(getattr(self, ship_grid)):
-            for col_num, i in enumerate(row):
-                if i == 'X':
-                    row_loc.append(row_num)
-                    col_loc.append(col_num)
-        locations = [list(x) for x in zip(row_loc, col_loc)]
-        return locations
+        return self.board(grid=grid).destroyed_locations()
 
     def insert_user_ships(self, ships_dict_array, user='user_1'):
-        """Places user 1's ships throughout grid 1 within the selected cell co-ordinates 
-            and orientation (vert or horizontal). The relevant data is passed forward 
-            into the class function place_ship.
+        """Places a user's ships onto their grid within the selected cell co-ordinates
+            and orientation (vert or horizontal). The whole fleet is validated against
+            the fleet.PLACEMENTS table, including overlaps, before any ship is placed.
         Args:
             ships_dict_array (dict): a python dictionary with keys corresponding to 
                 battleship ship types, and values in the form of a list with values
@@ -150,32 +382,26 @@ class Game(ndb.Model):
                 {'ship_type' : [row, col, vertical=True/False]}
             user: Should be equal to either 'user_1' or 'user_2'. 'user_1' by default.
         Raises:
-            ValueError: the dict key does not match a valid ship type.
+            ValueError: a ship type is not valid, a ship does not fit on the grid, or
+                ships overlap each other or ships already on the grid.
         """
-        ship_grid = "ships_2" if user == 'user_2' else 'ships_1'
         grid = 2 if user == 'user_2' else 1
-        # iterate through dict object using iteritems()
-        for ship, data in ships_dict_array.iteritems():
-            if ship == 'aircraft carrier':
-                # place ship object onto the grid dependent on inputs.
-                self.place_ship(ship, 5, data[0], data[1], vertical=data[2], grid=grid)
-                # add the ship to the ships dict for that user.
-                getattr(self, ship_grid)[ship] += 1
-            elif ship == 'battleship':
-                self.place_ship(ship, 4, data[0], data[1], vertical=data[2], grid=grid)
-                getattr(self, ship_grid)[ship] += 1
-            elif ship == 'submarine':
-                self.place_ship(ship, 3, data[0], data[1], vertical=data[2], grid=grid)
-                getattr(self, ship_grid)[ship] += 1
-            elif ship == 'destroyer':
-                self.place_ship(ship, 3, data[0], data[1], vertical=data[2], grid=grid)
-                getattr(self, ship_grid)[ship] += 1
-            elif ship == 'patrol boat':
-                self.place_ship(ship, 2, data[0], data[1], vertical=data[2], grid=grid)
-                getattr(self, ship_grid)[ship] += 1
-            else:
-                raise ValueError("The dict key does not match any ship types.")
-        return
+        self.board(grid=grid).place_fleet(fleet_masks(ships_dict_array))
+
+    def insert_random_ships(self, user='user_1', rand=None):
+        """Places a randomly generated fleet onto a user's grid, using fleet.random_fleet.
+        Args:
+            user: Should be equal to either 'user_1' or 'user_2'. 'user_1' by default.
+            rand: The random.Random instance to draw the fleet from, the random module
+                by default.
+        Returns:
+            The placement of each ship, in the format taken by insert_user_ships.
+        Raises:
+            ValueError: ships have already been placed on the grid.
+        """
+        ships = random_fleet(rand) if rand else random_fleet()
+        self.insert_user_ships(ships, user=user)
+        return ships
 
     def place_ship(self, ship_type, size, first_row_int, first_col_int, vertical=True, grid=1):
         """Places a ship of chosen size into the grid at the chosen co-ordinates.
@@ -189,24 +415,18 @@ class Game(ndb.Model):
             vertical (Boolean): Boolean True for vertical, False for horizontal. If horizontal, the ship
                 starting point is the left-most co-ordinate, and expands out to the right.
             grid (int): The grid the ship is to be placed into, either 1 or 2. 1 by default.
+        Raises:
+            ValueError: the ship does not fit on the grid, or overlaps another ship.
         """
-        if vertical:
-            for row in range(first_row_int, first_row_int + size):
-                self.update_cell(row, first_col_int, grid=grid)
-                # Add the ship locations to the relevant loc_ships dict
-                self.update_ship_loc_values(ship_type, row, first_col_int, grid=grid)
-            return
-
-        if not vertical:
-            for col in range(first_col_int, first_col_int + size):
-                self.update_cell(first_row_int, col, grid=grid)
-                # Add the ship locations to the relevant loc_ships dict
-                self.update_ship_loc_values(ship_type, first_row_int, col, grid=grid)
-            return
+        mask = ship_mask(size, first_row_int, first_col_int, vertical)
+        if not mask:
+            raise ValueError("{0} is size {1} and cannot fit there!".format(ship_type, size))
+        self.board(grid=grid).place_fleet({ship_type: mask})
 
     def update_ship_loc_values(self, ship_type, row_int, col_int, grid=1, remove=False):
-        """Updates the values of locations within loc_ships_1 or loc_ships_2.
-            If a ship has been hit, the remove arg should be set to True.
+        """Updates the ship locations of grid 1 or grid 2, held within the boards fleet masks.
+            If a ship has been hit, the remove arg should be set to True once the cell has
+            been destroyed, to verify that the cell belonged to a ship.
         Args: 
             ship_type (str): the type of ship, as a string.
             row_int (int): The row of the grid cell as an integer.
@@ -217,47 +437,22 @@ class Game(ndb.Model):
         Raises:
             ValueError: incorrect co-ordinates, grid or ship type.
         """
+        if grid != 1 and grid != 2:
+            # raise error if grid is anything other than 1 or 2.
+            raise ValueError("The grid must be 1 or 2.")
+        board = self.board(grid=grid)
+
         if not remove:
-            if grid == 1:
-                # append the cell co-ordinate to the relevant key of the loc dict.
-                self.loc_ships_1[ship_type].append((row_int, col_int))
-                return
-            elif grid == 2:
-                self.loc_ships_2[ship_type].append((row_int, col_int))
-                return
-            else:
-                # raise error if grid is anything other than 1 or 2.
-                raise ValueError("The grid must be 1 or 2.")
-
-        if remove:
-            # if ship type is unknown, search the ship loc dict and find co-ordinates.
-            if grid == 1 and ship_type == 'unknown':
-                found = False
-                for ship, locations in self.loc_ships_1.iteritems():
-                    if (row_int, col_int) in locations:
-                        self.loc_ships_1[ship].remove((row_int, col_int))
-                        if len(self.loc_ships_1[ship]) == 0:
-                            # update the ships dict to indicate destruction of the ship.
-                            self.ships_1[ship] -= 1
-                        return
-                if not found:
-                    raise ValueError("Those co-ordinates are not in the ship loc 1 dict!")
-
-            elif grid == 2 and ship_type == 'unknown':
-                found = False
-                for ship, locations in self.loc_ships_2.iteritems():
-                    if (row_int, col_int) in locations:
-                        found = True
-                        self.loc_ships_2[ship].remove((row_int, col_int))
-                        if len(self.loc_ships_2[ship]) == 0:
-                            # update the ships dict to indicate destruction of the ship.
-                            self.ships_2[ship] -= 1
-                        return
-                if not found:
-                    raise ValueError("Those co-ordinates are not in the ship loc 2 dict!")
-
-            else:
-                raise ValueError("The ship type is always 'unknown' during removal.")
+            # record the cell within the fleet mask of the ship type.
+            board.place(row_int, col_int, ship_type=ship_type)
+            return
+
+        if ship_type != 'unknown':
+            raise ValueError("The ship type is always 'unknown' during removal.")
+        # find the ship that occupies the cell from the board's fleet masks. The ships
+        # dict is derived from the board, so a sunk ship is no longer counted.
+        if board.ship_at(row_int, col_int) is None:
+            raise ValueError("Those co-ordinates are not in the ship loc {0} dict!".format(grid))
 
     def update_cell(self, row_int, col_int, status="ship", grid=1):
         """Update a cell at the chosen co-ordinates on the grid with either a 
@@ -273,39 +468,17 @@ class Game(ndb.Model):
         Raises:
             ValueError: grid already destroyed, incorrect status or incorrect grid.
         """
-        if grid == 1:
-            if status == "ship":
-                # add a '+' to the selected cell.
-                self.grid_1[row_int][col_int] = '+'
-                return
-            elif status == "destroy":
-                # ensure the selected cell is not already destroyed, and update to 'X'
-                if self.return_grid_status(row_int, col_int, grid=grid) != 'X':
-                    self.grid_1[row_int][col_int] = 'X'
-                    return
-                # if the cell is already destroyed, raise ValueError notifying the user.
-                else:
-                    raise ValueError("The selected grid cell is already destroyed!")
-            else:
-                raise ValueError("The status argument must be either 'ship' or 'destroy'.")
-
-        elif grid == 2:
-            if status == "ship":
-                self.grid_2[row_int][col_int] = '+'
-                return
-            elif status == "destroy":
-                # ensure the selected cell is not already destroyed, and update to 'X'
-                if self.return_grid_status(row_int, col_int, grid=grid) != 'X':
-                    self.grid_2[row_int][col_int] = 'X'
-                    return
-                # if the cell is already destroyed, raise ValueError notifying the user.
-                else:
-                    raise ValueError("The selected grid cell is already destroyed!")
-            else:
-                raise ValueError("The status argument must be either 'ship' or 'destroy'.")
-
-        else:
+        if grid != 1 and grid != 2:
             raise ValueError("The selected grid must be either 1 or 2!")
+        board = self.board(grid=grid)
+        if status == "ship":
+            # mark the selected cell as a ship ('+').
+            board.place(row_int, col_int)
+        elif status == "destroy":
+            # raises ValueError if the cell is already destroyed, else marks it as 'X'.
+            board.shoot(row_int, col_int)
+        else:
+            raise ValueError("The status argument must be either 'ship' or 'destroy'.")
 
     def destroy_cell(self, row_int, col_int, grid=1):
         """Destroys a selected grid cell, by inserting an "X". Returns True if a ship
@@ -319,25 +492,18 @@ class Game(ndb.Model):
         Raises:
             ValueError: chosen cell already destroyed.
         """
-        retval = False
-        status = self.return_grid_status(row_int, col_int, grid=grid)
-        if status == '+':
-            # set the retval to True, indicating the attack as a successful hit.
-            retval = True
-            # Update the cell to display an 'X' using update_cell() method.
-            self.update_cell(row_int, col_int, status="destroy", grid=grid)
-            # Update the ship location dictionary, removing the relevant co-ordinates.
-            self.update_ship_loc_values('unknown', row_int, col_int, grid=grid, remove=True)
-            return retval
-
-        if status == '-':
-            self.update_cell(row_int, col_int, status="destroy", grid=grid)
-            return retval
-
+        board = self.board(grid=grid)
         # raise exception if grid cell is already destroyed.
-        if status == 'X':
+        if board.status(row_int, col_int) == 'X':
             raise ValueError('The chosen cell is already destroyed!')
 
+        # mark the cell as destroyed, which reports whether a ship occupied it.
+        retval = board.shoot(row_int, col_int)
+        if retval:
+            # Verify the hit cell belongs to a ship within the board's fleet masks.
+            self.update_ship_loc_values('unknown', row_int, col_int, grid=grid, remove=True)
+        return retval
+
     def return_grid_status(self, row_int, col_int, grid=1):
         """Return the status of a chosen grid cell as either unoccupied, destroyed or
             occupied by a ship.
@@ -349,10 +515,7 @@ class Game(ndb.Model):
             '+' if the cell is occupied by a ship, and 'X' if a cell is destroyed, and
             '-' if a cell is unoccupied.
         """
-        if grid is 1:
-            return self.grid_1[row_int][col_int]
-        else:
-            return self.grid_2[row_int][col_int]
+        return self.board(grid=grid).status(row_int, col_int)
 
     def check_winner(self):
         """Check both battle grids. If there is a winner, report that user_win as True.
@@ -365,29 +528,24 @@ class Game(ndb.Model):
         Example:
             If user 1 had won the game, the function would return: (True, False)
         """
-        # Check both grids total ship cells remaining.
-        ship_cells_1 = self.total_ship_cells(grid=1)
-        ship_cells_2 = self.total_ship_cells(grid=2)
-
-        # set both users to False by default.
-        user_1_win, user_2_win = False, False
-
-        if ship_cells_1 == 0:
-            # user 1 has lost the game. Report user 2 as winner by returning user_2 = True.
-            user_1_win = True
-
-        if ship_cells_2 == 0:
-            # user 2 has lost the game. Report user 1 as winner by returning user_1 = True.
-            user_2_win = True
+        # a grid has no ship cells remaining once its intact ship mask is empty.
+        user_1_win = not self.board(grid=1).intact
+        user_2_win = not self.board(grid=2).intact
 
         return user_1_win, user_2_win
 
-    def to_form(self):
+    def to_form(self, names=None):
         """Returns a GameForm representation of the Game.
+        Args:
+            names: An optional dict of User key to name, as returned by
+                User.names_by_key, containing the games users. If not given the names
+                are fetched with a single batch get.
         Returns:
             A GameForm message that contains all of the game entities properties 
             in a suitable format for an outbound message.
         """
+        if names is None:
+            names = self.player_names() or User.names_by_key(self.player_keys())
         form = GameForm(urlsafe_key=self.key.urlsafe(),
                         grid_1=str(self.grid_1),
                         grid_2=str(self.grid_2),
@@ -395,31 +553,232 @@ class Game(ndb.Model):
                         ships_2=str(self.ships_2),
                         loc_ships_1=str(self.loc_ships_1),
                         loc_ships_2=str(self.loc_ships_2),
-                        user_1=self.user_1.get().name,
-                        user_2=self.user_2.get().name,
-                        next_move=self.next_move.get().name,
-                        game_over=self.game_over)
+                        user_1=names[self.user_1],
+                        user_2=names[self.user_2],
+                        next_move=names[self.next_move],
+                        game_over=self.game_over,
+                        version=self.version)
         if self.winner:
-            form.winner = self.winner.get().name
+            form.winner = names[self.winner]
         return form
 
+    @classmethod
+    def to_forms(cls, games):
+        """Returns a GameForms message for a sequence of Game entities. Games created
+            before user names were stored have their names resolved with a single batch
+            get.
+        Args:
+            games: An iterable of Game entities.
+        Returns:
+            A GameForms message containing a GameForm for each game.
+        """
+        games = list(games)
+        names = User.names_by_key(key for game in games if game.player_names() is None
+                                  for key in game.player_keys())
+        return GameForms(items=[game.to_form(game.player_names() or names)
+                                for game in games])
+
+    def ships_remaining(self, names=None):
+        """Returns the number of ships each user has remaining, in the format:
+            {'user_1': name, 'ships_1': int, 'user_2': name, 'ships_2': int}
+        Args:
+            names: An optional dict of User key to name, as returned by
+                User.names_by_key, used for games created before names were stored.
+        """
+        names = self.player_names() or names or User.names_by_key(self.player_keys())
+        return {'user_1': names[self.user_1], 'ships_1': self.total_ships(grid=1),
+                'user_2': names[self.user_2], 'ships_2': self.total_ships(grid=2)}
+
+    def cache_ships_remaining(self):
+        """Writes the ships remaining of the game to its memcache entry, or removes the
+            entry once the game is over. Called whenever a move changes the ships
+            remaining, so entries never need to be rebuilt for every game at once.
+        """
+        self.cache_ships_remaining_async().check_success()
+
+    def cache_ships_remaining_async(self):
+        """Asynchronous version of cache_ships_remaining, returning a Future."""
+        cache_key = MEMCACHE_SHIPS_REMAINING.format(self.key.urlsafe())
+        if self.game_over:
+            return ndb.get_context().memcache_delete(cache_key)
+        return ndb.get_context().memcache_set(cache_key, self.ships_remaining())
+
+    def move_count_entry(self):
+        """Returns the (move count, game over) tuple cached for the game, which is
+            written whenever the game is saved."""
+        return self.get_state().move_count, self.game_over
+
+    @classmethod
+    def wait_for_moves(cls, urlsafe_key, since, timeout):
+        """Waits until a game has more than since moves or is over, checking only its
+            memcache move count entry rather than reading the game. Returns early if
+            the entry is missing, so the caller reads the game instead.
+        Args:
+            urlsafe_key: The urlsafe key of the Game.
+            since (int): The number of moves the caller already has.
+            timeout: The maximum number of seconds to wait for.
+        Returns:
+            False if the move count entry was missing, else True.
+        """
+        cache_key = MEMCACHE_MOVE_COUNT.format(urlsafe_key)
+        deadline = time.time() + timeout
+        while True:
+            entry = memcache.get(cache_key)
+            if entry is None:
+                return False
+            remaining = deadline - time.time()
+            if entry[0] > since or entry[1] or remaining <= 0:
+                return True
+            time.sleep(min(MOVE_POLL_INTERVAL, remaining))
+
+    def cache_move_count(self):
+        """Adds the move count entry of the game to memcache if it is missing. Entries
+            written as the game is saved are never overwritten."""
+        memcache.add(MEMCACHE_MOVE_COUNT.format(self.key.urlsafe()), self.move_count_entry())
+
+    def to_move_forms(self, since=0):
+        """Returns a MoveForms of the moves made after the first since moves.
+        Args:
+            since (int): The sequence number of the last move the caller already has.
+        """
+        log = self.get_state().move_log(since, self.get_moves(since))
+        # grid 1 is attacked by user 2, and grid 2 by user 1.
+        attackers = dict((grid, self.user_name(self.user_2 if grid == 1 else self.user_1))
+                         for grid in set(move[1] for move in log))
+        items = [MoveForm(seq=seq, user=attackers[grid], grid=grid, row=row, col=col,
+                          result=result)
+                 for seq, grid, row, col, result in log]
+        move_count, game_over = self.move_count_entry()
+        return MoveForms(items=items, last_seq=move_count, game_over=game_over,
+                         next_move=None if game_over else self.user_name(self.next_move))
+
+    @classmethod
+    def ships_remaining_forms(cls, game_keys):
+        """Returns a ShipsRemainingForm for each game in progress in a sequence of keys.
+            Cached entries are read with a single memcache batch get; games without an
+            entry, eg those started since memcache was last flushed, are fetched with a
+            single batch get and their entries are written back.
+        Args:
+            game_keys: A list of Game keys, eg a page of the games in progress.
+        Returns:
+            A list of ShipsRemainingForm messages, in the order of the keys.
+        """
+        cache_keys = dict((key, MEMCACHE_SHIPS_REMAINING.format(key.urlsafe()))
+                          for key in game_keys)
+        entries = memcache.get_multi(cache_keys.values())
+        missing = [key for key in game_keys if cache_keys[key] not in entries]
+        games = [game for game in ndb.get_multi(missing)
+                 if game is not None and not game.game_over]
+        names = User.names_by_key(key for game in games if game.player_names() is None
+                                  for key in game.player_keys())
+        new_entries = dict((cache_keys[game.key], game.ships_remaining(names))
+                           for game in games)
+        memcache.set_multi(new_entries)
+        entries.update(new_entries)
+        return [ShipsRemainingForm(urlsafe_key=key.urlsafe(), **entries[cache_keys[key]])
+                for key in game_keys if cache_keys[key] in entries]
+
+    def player_keys(self):
+        """Returns the User keys of user 1 and user 2. The next_move and winner keys are
+            always one of these."""
+        return [self.user_1, self.user_2]
+
+    def player_names(self):
+        """Returns a dict of the user 1 and user 2 keys to their stored names, or None if
+            the names have not been stored yet."""
+        if self.user_1_name is None or self.user_2_name is None:
+            return None
+        return {self.user_1: self.user_1_name, self.user_2: self.user_2_name}
+
+    def set_player_names(self, names):
+        """Updates the stored user 1 and user 2 names.
+        Args:
+            names: A dict of User key to name, as returned by User.names_by_key. Users
+                missing from the dict keep their stored name.
+        Returns:
+            True if either stored name was changed, else False.
+        """
+        user_1_name = names.get(self.user_1, self.user_1_name)
+        user_2_name = names.get(self.user_2, self.user_2_name)
+        changed = (user_1_name, user_2_name) != (self.user_1_name, self.user_2_name)
+        self.user_1_name, self.user_2_name = user_1_name, user_2_name
+        return changed
+
+    def user_name(self, user_key):
+        """Returns the name of user 1 or user 2 from their User key, using the stored
+            name, or fetching the User for games created before names were stored.
+        Args:
+            user_key: The User key of user 1 or user 2, eg the next_move or winner key.
+        Returns:
+            The name of the user, as a string.
+        """
+        name = self.user_1_name if user_key == self.user_1 else self.user_2_name
+        return name if name is not None else user_key.get().name
+
     def end_game(self, winner):
         """Ends the game using the winners username (str) as an argument. Sets the 
-        current games property game_over to True, to indicate the game is over.
+        current games property game_over to True, to indicate the game is over. Both
+        users and a stats shard of each are read with one batch get. The game, its new
+        Score and both shards are then written with a batch put, which ndb sends as two
+        Put RPCs made together, within a single cross-group transaction, joining the
+        current transaction if there is one.
         Args:
             winner (str): The username of the winner.
         """
+        self._end_game(winner)
+
+    @tasks.transactional(xg=True)
+    def _end_game(self, winner):
         self.winner = winner
         self.game_over = True
-        self.put()
         loser = self.user_2 if winner == self.user_1 else self.user_1
+
+        # Read both users, along with a randomly chosen stats shard of each.
+        shard_keys = [UserStatsShard.random_key(winner), UserStatsShard.random_key(loser)]
+        winner_user, loser_user, winner_shard, loser_shard = \
+            ndb.get_multi([winner, loser] + shard_keys)
+        winner_shard = winner_shard or UserStatsShard(key=shard_keys[0], user=winner)
+        loser_shard = loser_shard or UserStatsShard(key=shard_keys[1], user=loser)
+
         # Add the game to the score 'board'
-        score = Score(date=date.today(), winner=winner, loser=loser)
-        score.put()
+        names = self.player_names() or {winner: winner_user.name, loser: loser_user.name}
+        score = Score(date=date.today(), winner=winner, loser=loser,
+                      winner_name=names[winner], loser_name=names[loser])
+
+        # Record each users result in their stats shard, rating each user against the
+        # others rating as of their last fold.
+        winner_user.add_win(loser_user.rating, shard=winner_shard)
+        loser_user.add_loss(winner_user.rating, shard=loser_shard)
+
+        # Write every entity once, and schedule the results to be folded into both users,
+        # waiting on the batch put and both task adds together.
+        futures = ndb.put_multi_async([self, score, winner_shard, loser_shard])
+        futures += [tasks.schedule_fold_stats_async(winner),
+                    tasks.schedule_fold_stats_async(loser)]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+
+        # update the cache once the results are stored.
+        ndb.get_context().call_on_commit(self.cache_ships_remaining)
+
+
+class MoveChunk(ndb.Model):
+    """An archived chunk of a Game's move log, stored as a child of the Game. Chunks are
+    numbered from 1, and each holds game_state.MOVE_CHUNK_SIZE moves.
+    Attributes:
+        moves: The moves of the chunk, encoded by game_state.encode_moves.
+    """
+    moves = ndb.BlobProperty(required=True)
 
-        # Update the user models
-        winner.get().add_win()
-        loser.get().add_loss()
+    @classmethod
+    def chunk_key(cls, game_key, number):
+        """Returns the key of a chunk of a Game's move log.
+        Args:
+            game_key: The key of the Game.
+            number (int): The number of the chunk, counting from 1.
+        """
+        return ndb.Key(cls, number, parent=game_key)
 
 
 class GameForm(messages.Message):
@@ -437,6 +796,7 @@ class GameForm(messages.Message):
         next_move: The name of the next player to take a turn, as a string.
         game_over: True if the game is over, else False.
         winner: The name of the winner, if the game is over.
+        version: The version of the game, incremented each time it is saved.
     """
     urlsafe_key = messages.StringField(1, required=True)
     grid_1 = messages.StringField(2, required=True)
@@ -450,14 +810,78 @@ class GameForm(messages.Message):
     next_move = messages.StringField(10, required=True)
     game_over = messages.BooleanField(11, required=True)
     winner = messages.StringField(12)
+    version = messages.IntegerField(13)
 
 
 class GameForms(messages.Message):
     """Container for multiple GameForm.
     Attributes:
         items: The GameForm messages, as a repeated property.
+        next_page_token: The token to request the next page of results with, if the
+            results are paginated and there are more results.
     """
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+
+
+class ShipsRemainingForm(messages.Message):
+    """ShipsRemainingForm for the number of ships each user has in a game in progress.
+    Attributes:
+        urlsafe_key: A urlsafe string representation of the Game entity key.
+        user_1: The name of user 1.
+        ships_1: The number of ships user 1 has remaining, as an int.
+        user_2: The name of user 2.
+        ships_2: The number of ships user 2 has remaining, as an int.
+    """
+    urlsafe_key = messages.StringField(1, required=True)
+    user_1 = messages.StringField(2, required=True)
+    ships_1 = messages.IntegerField(3, required=True)
+    user_2 = messages.StringField(4, required=True)
+    ships_2 = messages.IntegerField(5, required=True)
+
+
+class ShipsRemainingForms(messages.Message):
+    """Container for multiple ShipsRemainingForm.
+    Attributes:
+        items: The ShipsRemainingForm messages, as a repeated property.
+        next_page_token: The token to request the next page of results with, if there
+            are more results.
+    """
+    items = messages.MessageField(ShipsRemainingForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+
+
+class MoveForm(messages.Message):
+    """MoveForm for a single move in a game's move log.
+    Attributes:
+        seq: The sequence number of the move, counting the moves of the game from 1.
+        user: The name of the user who made the move.
+        grid: The grid attacked, 1 or 2.
+        row: The row of the attacked cell.
+        col: The column of the attacked cell.
+        result: Whether the move hit a ship, as a hit or miss message.
+    """
+    seq = messages.IntegerField(1, required=True)
+    user = messages.StringField(2)
+    grid = messages.IntegerField(3, required=True)
+    row = messages.IntegerField(4, required=True)
+    col = messages.IntegerField(5, required=True)
+    result = messages.StringField(6, required=True)
+
+
+class MoveForms(messages.Message):
+    """Container for the moves of a game made after a sequence number.
+    Attributes:
+        items: The MoveForm messages, in the order they were made, as a repeated property.
+        last_seq: The sequence number of the last move made in the game, to pass as
+            since in the next request.
+        game_over: True if the game is over, else False.
+        next_move: The name of the next player to take a turn, if the game is not over.
+    """
+    items = messages.MessageField(MoveForm, 1, repeated=True)
+    last_seq = messages.IntegerField(2, required=True)
+    game_over = messages.BooleanField(3, required=True)
+    next_move = messages.StringField(4)
 
 
 class NewGameForm(messages.Message):
@@ -468,3 +892,17 @@ class NewGameForm(messages.Message):
     """
     user_1 = messages.StringField(1, required=True)
     user_2 = messages.StringField(2, required=True)
+
+
+class SetupGameForm(messages.Message):
+    """Used to create a new game with both users ships inserted in a single request.
+    Attributes:
+        user_1: The selected username for user 1 as a string.
+        user_2: The selected username for user 2 as a string.
+        user_1_ships: The InsertShipsForms of user 1's ships, or a random fleet.
+        user_2_ships: The InsertShipsForms of user 2's ships, or a random fleet.
+    """
+    user_1 = messages.StringField(1, required=True)
+    user_2 = messages.StringField(2, required=True)
+    user_1_ships = messages.MessageField(InsertShipsForms, 3, required=True)
+    user_2_ships = messages.MessageField(InsertShipsForms, 4, required=True)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# This contains the GameState class, which holds both players boards, fleets and the
+# move log of a game, along with its compact versioned binary encoding used by the
+# Game model.
+import struct
+
+from board import Board, CODE_SHIPS, GRID_SIZE, MASK_BYTES, SHIP_CODES, \
+    pack_mask, unpack_mask
+
+# Version 2 layout, all integers big-endian:
+#   version (B)
+#   for board 1 then board 2:
+#       ships mask (13s), shots mask (13s), fleet size (B),
+#       then per ship: ship code (c), ship mask (13s)
+#   archived move count (H)
+#   move count (H), then one byte per move: (grid - 1) << 7 | (row * 10 + col)
+# Version 1 has no archived move count, as every move was held in the state.
+STATE_VERSION = 2
+VERSION = struct.Struct('>B')
+BOARD = struct.Struct('>{0}s{0}sB'.format(MASK_BYTES))
+SHIP = struct.Struct('>c{0}s'.format(MASK_BYTES))
+MOVE_COUNT = struct.Struct('>H')
+
+# Number of moves in each archived chunk of the move log.
+MOVE_CHUNK_SIZE = 16
+
+HIT_MSG = 'Ship hit!'
+MISS_MSG = 'No ship hit!'
+
+# Lookup tables between a (grid, row, col) move tuple and its single byte encoding.
+MOVE_TUPLES = [((move >> 7) + 1,) + divmod(move & 0x7f, GRID_SIZE) for move in range(256)]
+MOVE_BYTES = dict((move, byte) for byte, move in enumerate(MOVE_TUPLES)
+                  if move[1] < GRID_SIZE)
+
+
+def encode_moves(moves):
+    """Returns a list of (grid, row, col) moves encoded as one byte per move."""
+    return str(bytearray(MOVE_BYTES[move] for move in moves))
+
+
+def decode_moves(data):
+    """Returns the list of (grid, row, col) moves from a string created by encode_moves."""
+    return [MOVE_TUPLES[move] for move in bytearray(data)]
+
+
+class GameState(object):
+    """The board state and move log of a single game.
+    Attributes:
+        board_1: The board.Board for user 1's grid.
+        board_2: The board.Board for user 2's grid.
+        moves: A list of (grid, row, col) tuples for every attack in the order they
+            were made, where grid is the grid that was attacked, after the archived
+            moves.
+        archived: The number of moves at the start of the move log which have been
+            moved out of the state into chunks of MOVE_CHUNK_SIZE moves. The boards
+            always include every move, so only the move log is archived.
+    """
+
+    def __init__(self, board_1=None, board_2=None, moves=None, archived=0):
+        self.board_1 = board_1 or Board()
+        self.board_2 = board_2 or Board()
+        self.moves = moves or []
+        self.archived = archived
+
+    def __eq__(self, other):
+        return (isinstance(other, GameState) and self.board_1 == other.board_1 and
+                self.board_2 == other.board_2 and self.moves == other.moves and
+                self.archived == other.archived)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def board(self, grid=1):
+        """Returns the board.Board for the selected grid, either 1 or 2."""
+        return self.board_1 if grid == 1 else self.board_2
+
+    def record_move(self, grid, row_int, col_int):
+        """Appends an attack on the selected grid to the move log."""
+        self.moves.append((grid, row_int, col_int))
+
+    @property
+    def move_count(self):
+        """The number of moves made, including those archived."""
+        return self.archived + len(self.moves)
+
+    def archive_moves(self):
+        """Removes every complete chunk of MOVE_CHUNK_SIZE moves from the start of the
+            move log, so the moves held in the state never exceed one chunk.
+        Returns:
+            A list of (chunk number, moves) tuples of the removed chunks, where chunk
+            number counts the chunks of the game from 1.
+        """
+        chunks = []
+        while len(self.moves) >= MOVE_CHUNK_SIZE:
+            chunks.append((self.archived // MOVE_CHUNK_SIZE + 1, self.moves[:MOVE_CHUNK_SIZE]))
+            self.moves = self.moves[MOVE_CHUNK_SIZE:]
+            self.archived += MOVE_CHUNK_SIZE
+        return chunks
+
+    def _moves_after(self, since, moves):
+        """Returns the moves made after the first since moves, from the moves given or,
+            if None, from those held in the state."""
+        if moves is not None:
+            return moves
+        if since < self.archived:
+            raise ValueError('The moves after {0} have been archived'.format(since))
+        return self.moves[since - self.archived:]
+
+    def ships(self, grid=1):
+        """Returns a dict of ship type to the number of those ships still afloat on the
+            selected grid, in the format: {'aircraft carrier': 1, 'battleship': 0, ..}
+        """
+        board = self.board(grid)
+        return dict((ship_type, 0 if board.sunk(ship_type) else 1)
+                    for ship_type in SHIP_CODES)
+
+    def history(self, moves=None):
+        """Returns the move history as a dict with keys grid_1 and grid_2, each holding
+            the attacks made on that grid in the format: [(row, col, hit or miss), ..]
+        Args:
+            moves: The full move log, required once moves have been archived.
+        """
+        history = {'grid_1': [], 'grid_2': []}
+        for grid, row, col in self._moves_after(0, moves):
+            hit = self.board(grid).ships & (1 << (row * GRID_SIZE + col))
+            history['grid_{0}'.format(grid)].append((row, col, HIT_MSG if hit else MISS_MSG))
+        return history
+
+    def move_log(self, since=0, moves=None):
+        """Returns the moves made after the first since moves, each numbered by its
+            sequence number, in the format: [(seq, grid, row, col, hit or miss), ..]
+            where seq counts the moves of the game from 1.
+        Args:
+            since (int): The number of moves to skip.
+            moves: The moves made after the first since moves, required if any of them
+                have been archived.
+        """
+        log = []
+        for seq, (grid, row, col) in enumerate(self._moves_after(since, moves), since + 1):
+            hit = self.board(grid).ships & (1 << (row * GRID_SIZE + col))
+            log.append((seq, grid, row, col, HIT_MSG if hit else MISS_MSG))
+        return log
+
+    def encode(self):
+        """Returns the state as a version 2 byte string."""
+        parts = [VERSION.pack(STATE_VERSION)]
+        for board in (self.board_1, self.board_2):
+            parts.append(BOARD.pack(pack_mask(board.ships), pack_mask(board.shots),
+                                    len(board.fleet)))
+            for ship_type, mask in sorted(board.fleet.iteritems()):
+                parts.append(SHIP.pack(SHIP_CODES[ship_type], pack_mask(mask)))
+        parts.append(MOVE_COUNT.pack(self.archived))
+        parts.append(MOVE_COUNT.pack(len(self.moves)))
+        parts.append(encode_moves(self.moves))
+        return ''.join(parts)
+
+    @classmethod
+    def decode(cls, data):
+        """Returns a GameState from a byte string created by GameState.encode().
+        Raises:
+            ValueError: the data was encoded with an unknown version.
+        """
+        version, = VERSION.unpack_from(data)
+        if version not in (1, STATE_VERSION):
+            raise ValueError('Unknown game state version {0}'.format(version))
+        offset = VERSION.size
+        boards = []
+        for _ in range(2):
+            ships, shots, fleet_size = BOARD.unpack_from(data, offset)
+            offset += BOARD.size
+            fleet = {}
+            for _ in range(fleet_size):
+                code, mask = SHIP.unpack_from(data, offset)
+                offset += SHIP.size
+                fleet[CODE_SHIPS[code]] = unpack_mask(mask)
+            boards.append(Board(ships=unpack_mask(ships), shots=unpack_mask(shots),
+                                fleet=fleet))
+        archived = 0
+        if version > 1:
+            archived, = MOVE_COUNT.unpack_from(data, offset)
+            offset += MOVE_COUNT.size
+        num_moves, = MOVE_COUNT.unpack_from(data, offset)
+        offset += MOVE_COUNT.size
+        moves = decode_moves(data[offset:offset + num_moves])
+        return cls(board_1=boards[0], board_2=boards[1], moves=moves, archived=archived)
+
+    @classmethod
+    def from_legacy(cls, history, grids=(None, None), boards=(None, None),
+                    loc_ships=(None, None)):
+        """Builds a GameState from the properties stored by earlier versions of the Game
+            model, which held each grid as a pickled 2-D list or a packed board.Board,
+            with pickled ship location and history dicts.
+        Args:
+            history: The legacy history dict, with keys grid_1 and grid_2.
+            grids: A tuple of the legacy 2-D list grids for grid 1 and 2, if stored.
+            boards: A tuple of the legacy packed boards for grid 1 and 2, if stored.
+            loc_ships: A tuple of the legacy ship location dicts for grid 1 and 2, if
+                stored.
+        Returns:
+            The equivalent GameState object.
+        """
+        state = cls()
+        for grid in (1, 2):
+            attacks = history['grid_{0}'.format(grid)]
+            board = boards[grid - 1]
+            if board is None:
+                # a ship hit and a miss are both stored as an 'X', so take hits from history.
+                hits = [(row, col) for row, col, msg in attacks if msg == HIT_MSG]
+                board = Board.from_grid(grids[grid - 1], hits)
+            # destroyed cells were removed from the dict, but are already in the shots mask.
+            for ship_type, locations in (loc_ships[grid - 1] or {}).iteritems():
+                for row, col in locations:
+                    board.place(row, col, ship_type=ship_type)
+            setattr(state, 'board_{0}'.format(grid), board)
+
+        # user 1 always moves first and users alternate, so user 1's attacks on grid 2
+        # interleave with user 2's attacks on grid 1.
+        attacks_2, attacks_1 = history['grid_2'], history['grid_1']
+        for move_num in range(max(len(attacks_1), len(attacks_2))):
+            if move_num < len(attacks_2):
+                state.record_move(2, attacks_2[move_num][0], attacks_2[move_num][1])
+            if move_num < len(attacks_1):
+                state.record_move(1, attacks_1[move_num][0], attacks_1[move_num][1])
+        return state
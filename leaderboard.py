@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# This contains the memcache leaderboard snapshot of the top ranked users, kept up to
+# date incrementally as games finish so the leaderboard is served with one cache read.
+from google.appengine.api import memcache
+
+from models import User, UserForm
+
+MEMCACHE_LEADERBOARD = 'LEADERBOARD'
+# Number of users shown on the leaderboard.
+LEADERBOARD_SIZE = 50
+# Number of users held in the snapshot. Users beyond LEADERBOARD_SIZE are kept so the
+# leaderboard stays full as the users above them fall down the rankings.
+SNAPSHOT_SIZE = 2 * LEADERBOARD_SIZE
+# Seconds before a snapshot is rebuilt from the datastore, bounding how long any update
+# missed by the snapshot can be shown for.
+SNAPSHOT_EXPIRY = 600
+CAS_RETRIES = 3
+
+FORM_FIELDS = ('name', 'email', 'wins', 'total_played', 'win_percentage', 'rating')
+
+
+def ranked_users():
+    """Returns the query of users who have played a game, ordered by win percentage and
+        then by key, the order used by get_user_rankings and the leaderboard.
+    """
+    return User.query(User.has_played == True).order(-User.win_percentage, User.key)
+
+
+def _entry(user):
+    """Returns the snapshot entry for a user, a dict of its key and UserForm fields."""
+    entry = dict((field, getattr(user, field)) for field in FORM_FIELDS)
+    entry['key'] = user.key
+    return entry
+
+
+def _rank(entry):
+    """Returns the sort key of a snapshot entry, matching the order of ranked_users()."""
+    return -entry['win_percentage'], entry['key'].pairs()
+
+
+def _build_snapshot():
+    """Returns a snapshot of the top SNAPSHOT_SIZE ranked users, read from the datastore.
+        The snapshot is a dict holding the ranked entries, and complete, which is True if
+        every ranked user is held.
+    """
+    users = ranked_users().fetch(SNAPSHOT_SIZE)
+    return {'entries': [_entry(user) for user in users],
+            'complete': len(users) < SNAPSHOT_SIZE}
+
+
+def _merge(snapshot, users):
+    """Merges the current stats of updated users into a snapshot. The snapshot holds
+        the exact top ranked users, so an updated user can only be placed if it ranks
+        above the last user held; users falling below it are dropped, as users outside
+        the snapshot may rank above them.
+    Args:
+        snapshot: The snapshot dict, as returned by _build_snapshot.
+        users: The User entities whose stats have changed.
+    Returns:
+        The updated snapshot, or None if it no longer holds enough users to fill the
+        leaderboard and must be rebuilt.
+    """
+    entries = snapshot['entries']
+    updated = dict((user.key, _entry(user)) for user in users if user.has_played)
+    lowest = _rank(entries[-1]) if entries else None
+    entries = [entry for entry in entries if entry['key'] not in updated] + \
+        [entry for entry in updated.itervalues()
+         if snapshot['complete'] or _rank(entry) < lowest]
+    entries.sort(key=_rank)
+    complete = snapshot['complete'] and len(entries) < SNAPSHOT_SIZE
+    if len(entries) < LEADERBOARD_SIZE and not complete:
+        return None
+    return {'entries': entries[:SNAPSHOT_SIZE], 'complete': complete}
+
+
+def get_leaderboard(limit=LEADERBOARD_SIZE):
+    """Returns the top ranked users from the memcache snapshot, rebuilding the snapshot
+        from the datastore if it is not cached.
+    Args:
+        limit: The number of users to return, at most LEADERBOARD_SIZE.
+    Returns:
+        A list of UserForm messages, in ranked order.
+    """
+    snapshot = memcache.get(MEMCACHE_LEADERBOARD)
+    if snapshot is None:
+        snapshot = _build_snapshot()
+        memcache.add(MEMCACHE_LEADERBOARD, snapshot, time=SNAPSHOT_EXPIRY)
+    return [UserForm(**dict((field, entry[field]) for field in FORM_FIELDS))
+            for entry in snapshot['entries'][:min(limit, LEADERBOARD_SIZE)]]
+
+
+def update_leaderboard(users):
+    """Updates the cached snapshot with the current stats of users whose results have
+        changed, eg the winner and loser of a finished game. Concurrent updates are
+        resolved with compare-and-set; if they cannot be, or the snapshot can no longer
+        fill the leaderboard, it is deleted and rebuilt on the next read.
+    Args:
+        users: The updated User entities.
+    """
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        snapshot = client.gets(MEMCACHE_LEADERBOARD)
+        if snapshot is None:
+            return
+        snapshot = _merge(snapshot, users)
+        if snapshot is None:
+            break
+        if client.cas(MEMCACHE_LEADERBOARD, snapshot, time=SNAPSHOT_EXPIRY):
+            return
+    client.delete(MEMCACHE_LEADERBOARD)
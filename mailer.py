@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# This contains the outbound mail delivery used by the Battleships API. Mail is sent
+# through the App Engine mail API, or recorded in a local outbox instead when the
+# MAIL_BACKEND environment variable is set to 'outbox', so notifications can be
+# inspected without sending any email.
+import logging
+import os
+
+from google.appengine.api import app_identity, mail
+
+# Value of the MAIL_BACKEND environment variable selecting the local outbox.
+OUTBOX_BACKEND = 'outbox'
+
+# The messages recorded by the outbox backend in this instance, as
+# (sender, to, subject, body) tuples.
+outbox = []
+
+
+def sender():
+    """Returns the noreply address of the application, which all mail is sent from."""
+    return 'noreply@{}.appspotmail.com'.format(app_identity.get_application_id())
+
+
+def send_mail(to, subject, body):
+    """Sends an email from the applications noreply address. Errors from the mail API
+        are not caught, so a task sending mail fails and is retried with the backoff
+        of its queue.
+    Args:
+        to: The email address of the recipient.
+        subject: The subject of the email.
+        body: The plain text body of the email.
+    """
+    logging.debug(body)
+    if os.environ.get('MAIL_BACKEND') == OUTBOX_BACKEND:
+        outbox.append((sender(), to, subject, body))
+    else:
+        mail.send_mail(sender(), to, subject, body)
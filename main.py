@@ -14,72 +14,369 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import logging
+import time
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from api import BattleshipsAPI
-from utils import get_by_urlsafe
+import game_cache
+import mailer
+import metrics
+import tasks
 
-from models import User
+from models import User, UserStatsShard, Score
+from leaderboard import update_leaderboard
 from game_models import Game
 
+# Number of Game entities re-saved by each migration task.
+MIGRATION_BATCH_SIZE = 100
+# Number of User entities re-keyed by each user migration task. Each user may also
+# require their games and scores to be updated, so batches are kept small.
+USER_MIGRATION_BATCH_SIZE = 20
+# Number of players emailed by each send_reminders task.
+REMINDER_BATCH_SIZE = 50
+# Number of games fetched by each RPC of the reminder scan.
+REMINDER_SCAN_BATCH_SIZE = 500
+# Maximum number of game keys listed in a single reminder email.
+REMINDER_MAX_GAMES = 50
+# Seconds the reminder scan runs for before chaining a task to continue it, well
+# within the 10 minute deadline of cron and task requests.
+REMINDER_TIME_LIMIT = 300
+# Maximum number of games listed in a single turn email.
+MOVE_EMAIL_MAX_GAMES = 50
+
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @metrics.instrument('/crons/send_reminder')
     def get(self):
         """Send a reminder email to each User with an email who has
         games in progress. Email body includes a count of active games and their
-        urlsafe keys
+        urlsafe keys.
+        The games in progress are scanned once, projecting Game.players in player
+        order, which returns each game once per player, so the games of each player
+        are consecutive and only one player's games are held at a time. Every
+        REMINDER_BATCH_SIZE players are handed to a send_reminders task, which emails
+        them. Once REMINDER_TIME_LIMIT is reached, the scan chains a task continuing
+        from the first game of the current player. Tasks are named after the run and
+        batch number, so a retried scan does not email a batch twice.
         Called every 12 hours using a cron job"""
-        users = User.query(User.email != None)
+        start = time.time()
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        run = self.request.get('run') or str(int(start))
+        batch_num = int(self.request.get('batch') or 0)
+        query = Game.query(Game.game_over == False).order(Game.players)
+        games = query.iter(projection=[Game.players], start_cursor=cursor,
+                           produce_cursors=True, batch_size=REMINDER_SCAN_BATCH_SIZE)
 
-        for user in users:
-            games = Game.query(ndb.OR(Game.user_1 == user.key,
-                                      Game.user_2 == user.key)). \
-                filter(Game.game_over == False)
-            if games.count() > 0:
-                subject = 'This is a reminder!'
-                body = 'Hello {}, you have {} games in progress. Their' \
-                       ' keys are: {}'. \
-                    format(user.name,
-                           games.count(),
-                           ', '.join(game.key.urlsafe() for game in games))
-                logging.debug(body)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.
-                               format(app_identity.get_application_id()),
-                               user.email,
-                               subject,
-                               body)
+        batch, player, num_games, game_keys = [], None, 0, []
+        for game in games:
+            if game.players[0] != player:
+                if player is not None:
+                    batch.append((player, num_games, game_keys))
+                if len(batch) >= REMINDER_BATCH_SIZE:
+                    self._add_reminder_task(run, batch_num, batch)
+                    batch_num, batch = batch_num + 1, []
+                if time.time() - start >= REMINDER_TIME_LIMIT:
+                    self._add_reminder_task(run, batch_num, batch)
+                    self._add_task(taskqueue.Task(
+                        url='/crons/send_reminder', method='GET',
+                        name='reminder-scan-{0}-{1}'.format(run, batch_num + 1),
+                        params=dict(cursor=games.cursor_before().urlsafe(), run=run,
+                                    batch=batch_num + 1)))
+                    return
+                player, num_games, game_keys = game.players[0], 0, []
+            num_games += 1
+            if len(game_keys) < REMINDER_MAX_GAMES:
+                game_keys.append(game.key.urlsafe())
+        if player is not None:
+            batch.append((player, num_games, game_keys))
+        self._add_reminder_task(run, batch_num, batch)
+
+    def _add_reminder_task(self, run, batch_num, batch):
+        """Enqueue a send_reminders task for a batch of (user key, number of games,
+        game keys) tuples, unless the batch is empty."""
+        if batch:
+            payload = json.dumps([dict(user_key=user_key.urlsafe(), num_games=num_games,
+                                       game_keys=game_keys)
+                                  for user_key, num_games, game_keys in batch])
+            self._add_task(taskqueue.Task(
+                url='/tasks/send_reminders', payload=payload,
+                name='reminders-{0}-{1}'.format(run, batch_num)), tasks.MAIL_QUEUE)
+
+    @staticmethod
+    def _add_task(task, queue_name='default'):
+        try:
+            task.add(queue_name=queue_name)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # added by an earlier attempt at this request.
+            pass
+
+
+class SendReminders(webapp2.RequestHandler):
+    @metrics.instrument('/tasks/send_reminders')
+    def post(self):
+        """Send a reminder email to each of a batch of users, reading every user of the
+        batch with one batch get. Runs on the mail queue. The JSON payload is a list of dicts with keys
+        user_key, num_games and game_keys, as built by SendReminderEmail."""
+        reminders = json.loads(self.request.body)
+        users = ndb.get_multi([ndb.Key(urlsafe=reminder['user_key'])
+                               for reminder in reminders])
+        for user, reminder in zip(users, reminders):
+            if not user or not user.email:
+                continue
+            game_keys = ', '.join(reminder['game_keys'])
+            if reminder['num_games'] > len(reminder['game_keys']):
+                game_keys += ' and {} more'.format(
+                    reminder['num_games'] - len(reminder['game_keys']))
+            subject = 'This is a reminder!'
+            body = 'Hello {}, you have {} games in progress. Their' \
+                   ' keys are: {}'.format(user.name, reminder['num_games'], game_keys)
+            mailer.send_mail(user.email, subject, body)
+        self.response.set_status(204)
 
 
 class UpdateGameShipsRemaining(webapp2.RequestHandler):
+    @metrics.instrument('/tasks/cache_ships_remaining')
     def post(self):
-        """Update the ships remaining for users with current games in progress."""
-        BattleshipsAPI._cache_ships_remaining()
+        """Ships remaining are now cached per game as each move is made, so there is
+        nothing to update. Kept so that tasks enqueued before the change complete
+        rather than being retried."""
         self.response.set_status(204)
 
 
 class SendMoveEmail(webapp2.RequestHandler):
+    @metrics.instrument('/tasks/send_move_email')
+    def post(self):
+        """Send a User one email listing every game in which it is their turn, so the
+        turns of all their games within the coalescing window are merged into a single
+        email. The task releases its coalescing key before reading the games, so a move
+        made from then on schedules a new email, and reads the game of every move
+        coalesced into it by key. No email is sent if the user has already moved in
+        every game. Runs on the mail queue, which bounds the rate and concurrency of
+        sends and retries failed sends with backoff."""
+        user_key = ndb.Key(urlsafe=self.request.get('user_key'))
+        game_keys = tasks.release_move_email(
+            user_key, self.request.headers.get('X-AppEngine-TaskName'))
+        if self.request.get('game_key'):
+            game_key = ndb.Key(urlsafe=self.request.get('game_key'))
+            if game_key not in game_keys:
+                game_keys.insert(0, game_key)
+        user = user_key.get()
+        if not user or not user.email:
+            self.response.set_status(204)
+            return
+        games = [game for game in ndb.get_multi(game_keys[:MOVE_EMAIL_MAX_GAMES])
+                 if game and not game.game_over and game.next_move == user.key]
+        if len(games) == 1:
+            subject = 'It\'s your turn!'
+            body = '{}, It\'s your turn to play Battleships! The game key is: {}'. \
+                format(user.name, games[0].key.urlsafe())
+        elif games:
+            subject = 'It\'s your turn in {} games!'.format(len(games))
+            body = '{}, It\'s your turn to play Battleships in {} games! The game keys ' \
+                   'are: {}'.format(user.name, len(games),
+                                    ', '.join(game.key.urlsafe() for game in games))
+        else:
+            self.response.set_status(204)
+            return
+        mailer.send_mail(user.email, subject, body)
+        self.response.set_status(204)
+
+
+class TaskStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the counts of background tasks enqueued and suppressed by coalescing
+        for each task name, as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(tasks.stats()))
+
+
+class GameCacheStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the hits, misses, bypasses and evictions of the game cache, as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(game_cache.stats()))
+
+
+class Metrics(webapp2.RequestHandler):
+    def get(self):
+        """Return the latency percentiles and mean RPCs, memcache hits and misses, tasks
+        enqueued and entity bytes per request of each sampled endpoint and handler, with
+        the task and game cache counters, as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'requests': metrics.stats(),
+                                        'tasks': tasks.stats(),
+                                        'game_cache': game_cache.stats()}))
+
+
+class FoldUserStats(webapp2.RequestHandler):
+    @metrics.instrument('/tasks/fold_user_stats')
     def post(self):
-        """Send an email to a User that it is their turn"""
-        user = get_by_urlsafe(self.request.get('user_key'), User)
-        game = get_by_urlsafe(self.request.get('game_key'), Game)
-        subject = 'It\'s your turn!'
-        body = '{}, It\'s your turn to play Battleships! The game key is: {}'. \
-            format(user.name, game.key.urlsafe())
-        logging.debug(body)
-        mail.send_mail('noreply@{}.appspotmail.com'.
-                       format(app_identity.get_application_id()),
-                       user.email,
-                       subject,
-                       body)
+        """Fold the results held in the stats shards of a user into their User entity,
+        and update the user within the leaderboard snapshot. The task releases its
+        coalescing key first, so games finished from then on schedule a new fold."""
+        user_key = ndb.Key(urlsafe=self.request.get('user_key'))
+        tasks.release_fold_stats(user_key, self.request.headers.get('X-AppEngine-TaskName'))
+        user = User.fold_stats(user_key)
+        if user:
+            update_leaderboard([user])
+        self.response.set_status(204)
+
+
+class FoldAllUserStats(webapp2.RequestHandler):
+    @metrics.instrument('/crons/fold_user_stats')
+    def get(self):
+        """Schedule a fold for every user with results still held in stats shards, eg
+        if a fold task was lost. Shards are deleted once folded, so every shard found
+        is pending. Each request handles one batch and chains a task for the next
+        batch using the query cursor.
+        Called every hour using a cron job"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        shards, next_cursor, more = UserStatsShard.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        for user_key in set(shard.user for shard in shards):
+            tasks.schedule_fold_stats(user_key)
+        if more and next_cursor:
+            taskqueue.add(url='/crons/fold_user_stats', method='GET',
+                          params=dict(cursor=next_cursor.urlsafe()))
+
+
+class MigrateGames(webapp2.RequestHandler):
+    @metrics.instrument('/tasks/migrate_games')
+    def post(self):
+        """Re-save a batch of Game entities so that any stored in a legacy format are
+        written back in the current one. Each task handles one batch and then chains
+        a task for the next batch using the query cursor, so the migration can be
+        resumed from the last completed batch."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(MIGRATION_BATCH_SIZE,
+                                                           start_cursor=cursor)
+        ndb.put_multi(games)
+        logging.info('Migrated {} games.'.format(len(games)))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_games',
+                          params=dict(cursor=next_cursor.urlsafe()))
+        self.response.set_status(204)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    @metrics.instrument('/tasks/migrate_users')
+    def post(self):
+        """Re-key a batch of User entities created before users were keyed by their
+        name. A copy of each user is stored under a key named after the user, the Game
+        and Score entities referring to the old key are pointed at the new key, and the
+        old user is deleted. Users already keyed by their name are re-saved, so that
+        their computed ranking properties are stored. Each task chains a task for the
+        next batch using the query cursor, so the backfill can be resumed from the last
+        completed batch."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(USER_MIGRATION_BATCH_SIZE,
+                                                           start_cursor=cursor)
+        migrated, keyed_users = 0, []
+        for user in users:
+            if user.key.string_id() == user.name:
+                keyed_users.append(user)
+                continue
+            new_key = ndb.Key(User, user.name)
+            if new_key.get():
+                logging.warning('Cannot re-key user {}, the name {} is already '
+                                'taken.'.format(user.key.id(), user.name))
+                continue
+            self._rekey_user(user, new_key)
+            migrated += 1
+        ndb.put_multi(keyed_users)
+        logging.info('Re-keyed {} of {} users.'.format(migrated, len(users)))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params=dict(cursor=next_cursor.urlsafe()))
+        self.response.set_status(204)
+
+    @staticmethod
+    def _rekey_user(user, new_key):
+        """Store a copy of the user under new_key, point every Game and Score entity
+        at the new key and then delete the old user."""
+        old_key = user.key
+        # fold any pending results first, as stats shards are keyed by the user key.
+        user = User.fold_stats(old_key) or user
+        User(key=new_key, **user.to_dict(exclude=['win_percentage', 'has_played'])).put()
+
+        def replace(key):
+            return new_key if key == old_key else key
+
+        games = Game.query(ndb.OR(Game.user_1 == old_key,
+                                  Game.user_2 == old_key)).fetch()
+        for game in games:
+            game.user_1, game.user_2 = replace(game.user_1), replace(game.user_2)
+            game.next_move, game.winner = replace(game.next_move), replace(game.winner)
+        scores = Score.query(ndb.OR(Score.winner == old_key,
+                                    Score.loser == old_key)).fetch()
+        for score in scores:
+            score.winner, score.loser = replace(score.winner), replace(score.loser)
+        ndb.put_multi(games + scores)
+        old_key.delete()
+
+
+class RepairPlayerNames(webapp2.RequestHandler):
+    @metrics.instrument('/tasks/repair_player_names')
+    def post(self):
+        """Update the player names stored on a batch of Game entities, and then Score
+        entities, from the current names of their users. This backfills the names of
+        games and scores created before names were stored, and if a user_key parameter
+        is given, repairs only the games and scores of that user, eg after a change of
+        name. Each task chains a task for the next batch using the query cursor, moving
+        on from games to scores once every game has been processed, so the job can be
+        resumed from the last completed batch."""
+        kind = self.request.get('kind') or 'Game'
+        user_key = self.request.get('user_key')
+        model = Game if kind == 'Game' else Score
+        query = model.query()
+        if user_key:
+            user_key = ndb.Key(urlsafe=user_key)
+            if model is Game:
+                query = query.filter(ndb.OR(Game.user_1 == user_key,
+                                            Game.user_2 == user_key))
+            else:
+                query = query.filter(ndb.OR(Score.winner == user_key,
+                                            Score.loser == user_key))
+            # OR queries are only paged by cursor when given a total sort order.
+            query = query.order(model.key)
+
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        entities, next_cursor, more = query.fetch_page(MIGRATION_BATCH_SIZE,
+                                                       start_cursor=cursor)
+        names = User.names_by_key(key for entity in entities
+                                  for key in entity.player_keys())
+        changed = [entity for entity in entities if entity.set_player_names(names)]
+        ndb.put_multi(changed)
+        logging.info('Updated player names of {} of {} {} entities.'.
+                     format(len(changed), len(entities), kind))
+
+        params = dict(kind=kind)
+        if user_key:
+            params['user_key'] = user_key.urlsafe()
+        if more and next_cursor:
+            params['cursor'] = next_cursor.urlsafe()
+            taskqueue.add(url='/tasks/repair_player_names', params=params)
+        elif model is Game:
+            params['kind'] = 'Score'
+            taskqueue.add(url='/tasks/repair_player_names', params=params)
+        self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminders),
     ('/tasks/cache_ships_remaining', UpdateGameShipsRemaining),
     ('/tasks/send_move_email', SendMoveEmail),
+    ('/tasks/stats', TaskStats),
+    ('/tasks/game_cache_stats', GameCacheStats),
+    ('/tasks/metrics', Metrics),
+    ('/tasks/fold_user_stats', FoldUserStats),
+    ('/crons/fold_user_stats', FoldAllUserStats),
+    ('/tasks/migrate_games', MigrateGames),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/tasks/repair_player_names', RepairPlayerNames),
 ], debug=True)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# This contains the request instrumentation of the API endpoints and task handlers. A
+# sample of requests record their wall time, datastore gets, puts and queries, memcache
+# hits and misses, tasks enqueued and the bytes of entities read and written, counted by
+# hooks on every RPC made while the request runs. Samples are added to rolling windows of
+# counters and latency histograms held in memcache.
+import collections
+import functools
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+# Fraction of requests instrumented, from the METRICS_SAMPLE_RATE environment variable.
+# Requests which are not sampled only pay for a random number and a thread local lookup.
+SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 0.05))
+
+# Memcache key prefix of the counters, which are keyed by window, name and field.
+MEMCACHE_METRICS_PREFIX = 'METRICS:'
+WINDOW_SECONDS = 600
+# Number of windows returned by stats, covering the last hour.
+NUM_WINDOWS = 6
+# Upper bounds in milliseconds of the latency histogram buckets, followed by a bucket
+# for longer requests.
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+HISTOGRAM_FIELDS = tuple('latency_{0}'.format(bound) for bound in LATENCY_BUCKETS) + \
+    ('latency_inf',)
+# Counters recorded for each request, besides its latency.
+FIELDS = ('datastore_get', 'datastore_put', 'datastore_query', 'memcache_hit',
+          'memcache_miss', 'task_add', 'read_bytes', 'write_bytes', 'wall_ms')
+# Number of sampled requests counted by an instance before its counts are added to
+# memcache, or seconds since they were last added.
+FLUSH_REQUESTS = 20
+FLUSH_SECONDS = 10
+
+_names = []
+_local = threading.local()
+_lock = threading.Lock()
+_pending = collections.Counter()
+_pending_requests = [0]
+_last_flush = [time.time()]
+_hooked = [None]
+
+
+def _pre_call(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3':
+        if call == 'Get':
+            counts['datastore_get'] += 1
+        elif call == 'Put':
+            counts['datastore_put'] += 1
+            counts['write_bytes'] += request.ByteSize()
+        elif call == 'RunQuery':
+            counts['datastore_query'] += 1
+    elif service == 'taskqueue':
+        if call == 'Add':
+            counts['task_add'] += 1
+        elif call == 'BulkAdd':
+            counts['task_add'] += request.add_request_size()
+
+
+def _post_call(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3' and call in ('Get', 'RunQuery', 'Next'):
+        counts['read_bytes'] += response.ByteSize()
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counts['memcache_hit'] += hits
+        counts['memcache_miss'] += request.key_size() - hits
+
+
+def _install_hooks():
+    """Adds the RPC hooks to the current API proxy, which is replaced by eg a testbed."""
+    proxy = apiproxy_stub_map.apiproxy
+    if _hooked[0] is not proxy:
+        proxy.GetPreCallHooks().Append('metrics', _pre_call)
+        proxy.GetPostCallHooks().Append('metrics', _post_call)
+        _hooked[0] = proxy
+
+
+def _bucket(wall_ms):
+    """Returns the histogram field counting a request of the given latency."""
+    for field, bound in zip(HISTOGRAM_FIELDS, LATENCY_BUCKETS):
+        if wall_ms <= bound:
+            return field
+    return HISTOGRAM_FIELDS[-1]
+
+
+def _key(window, name, field):
+    return '{0}:{1}:{2}'.format(window, name, field)
+
+
+def _record(name, counts):
+    """Adds the counts of a sampled request to the pending counters of this instance,
+        and adds the pending counters to memcache when enough have been gathered."""
+    window = int(time.time() // WINDOW_SECONDS)
+    with _lock:
+        for field in FIELDS:
+            _pending[_key(window, name, field)] += int(counts[field])
+        _pending[_key(window, name, 'requests')] += 1
+        _pending[_key(window, name, _bucket(counts['wall_ms']))] += 1
+        _pending_requests[0] += 1
+        due = (_pending_requests[0] >= FLUSH_REQUESTS or
+               time.time() - _last_flush[0] >= FLUSH_SECONDS)
+    if due:
+        flush()
+
+
+def flush():
+    """Adds the counts gathered by this instance to the counters held in memcache."""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _pending_requests[0] = 0
+        _last_flush[0] = time.time()
+    if pending:
+        memcache.offset_multi(pending, key_prefix=MEMCACHE_METRICS_PREFIX, initial_value=0)
+
+
+def instrument(name=None):
+    """Decorator recording a sample of the calls of an endpoint method or handler method.
+    Args:
+        name: The name the calls are recorded under, the name of the function by default.
+    """
+    def decorator(func):
+        metric_name = name or func.__name__
+        _names.append(metric_name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # calls made within an instrumented call are counted by the outer call.
+            if random.random() >= SAMPLE_RATE or getattr(_local, 'counts', None) is not None:
+                return func(*args, **kwargs)
+            _install_hooks()
+            _local.counts = counts = collections.Counter()
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counts['wall_ms'] = (time.time() - start) * 1000
+                _local.counts = None
+                _record(metric_name, counts)
+        return wrapper
+    return decorator
+
+
+def _percentile(totals, pct):
+    """Returns the upper bound of the histogram bucket holding a percentile, or None if
+        it is in the unbounded bucket."""
+    rank = pct / 100.0 * totals['requests']
+    seen = 0
+    for field, bound in zip(HISTOGRAM_FIELDS, LATENCY_BUCKETS):
+        seen += totals[field]
+        if seen >= rank:
+            return bound
+    return None
+
+
+def stats(num_windows=NUM_WINDOWS):
+    """Returns the metrics of every instrumented endpoint and handler over the last
+        num_windows windows, read with a single memcache batch get, in the format:
+        {'name': {'requests': int, 'mean_ms': float, 'p50_ms': int, 'p95_ms': int,
+                  'p99_ms': int, 'datastore_get': float, ..}, ..}
+        where requests is the number of sampled requests, the percentiles are the upper
+        bounds of their histogram buckets, or None if unbounded, and every other field
+        is the mean per sampled request.
+    """
+    flush()
+    window = int(time.time() // WINDOW_SECONDS)
+    windows = range(window - num_windows + 1, window + 1)
+    fields = FIELDS + ('requests',) + HISTOGRAM_FIELDS
+    keys = [_key(w, name, field) for w in windows for name in _names for field in fields]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_METRICS_PREFIX)
+
+    result = {}
+    for name in _names:
+        totals = collections.Counter()
+        for w in windows:
+            for field in fields:
+                totals[field] += int(values.get(_key(w, name, field), 0))
+        requests = totals['requests']
+        if not requests:
+            continue
+        entry = dict((field, round(float(totals[field]) / requests, 2))
+                     for field in FIELDS if field != 'wall_ms')
+        entry.update(requests=requests, mean_ms=round(totals['wall_ms'] / float(requests), 1),
+                     p50_ms=_percentile(totals, 50), p95_ms=_percentile(totals, 95),
+                     p99_ms=_percentile(totals, 99))
+        result[name] = entry
+    return result
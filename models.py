@@ -1,55 +1,267 @@
+import random
+
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+# Rating given to new users, and the largest change to a rating from a single game.
+INITIAL_RATING = 1000.0
+RATING_K_FACTOR = 32
+
+# Number of UserStatsShard entities the pending results of each user are spread over.
+NUM_STATS_SHARDS = 5
+# Memcache key of the aggregated stats of a user, formatted with the urlsafe user key.
+MEMCACHE_USER_STATS = 'USER_STATS:{0}'
+# Seconds before the cached stats of a user are aggregated again, bounding how long a
+# value read while the user's results were being folded can be served for.
+USER_STATS_EXPIRY = 600
+
 
 class User(ndb.Model):
-    """User profile to store the details of each user registered.
+    """User profile to store the details of each user registered. Users are keyed by
+    their name, so a user is fetched with a single get by key rather than a query.
     Attributes:
         name: The name of the user (str).
         email: The email address of the user (str).
         wins: The total games the user has won (int).
         total_played: The total games played by the user (int).
+        win_percentage: The win / total_played ratio (float). Stored and indexed so
+            users can be ranked by a datastore query.
+        has_played: True if the user has played at least 1 game. Stored and indexed so
+            rankings can be limited to users who have played with an equality filter.
+        rating: The users Elo rating (float), adjusted after each game by the result
+            and the rating of the opponent.
+    The results of finished games are first recorded in UserStatsShard entities, so
+    a user finishing many games at once does not contend on writes to the User, and
+    are periodically folded into wins, total_played and rating by fold_stats.
     """
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
     wins = ndb.IntegerProperty(default=0)
     total_played = ndb.IntegerProperty(default=0)
+    rating = ndb.FloatProperty(default=INITIAL_RATING)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with the given name, using a get by key.
+        Args:
+            name: The name of the user (str).
+        Returns:
+            The User entity, or None if no user with that name exists.
+        """
+        return cls.get_by_name_async(name).get_result()
 
-    @property
-    def win_percentage(self):
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Asynchronous version of get_by_name, returning a Future of the User, so
+        several users can be looked up at once."""
+        if not name:
+            raise ndb.Return(None)
+        user = yield cls.get_by_id_async(name)
+        if user is None:
+            # users created before names were used as keys are found by query until
+            # they have been re-keyed by the /tasks/migrate_users backfill.
+            user = yield cls.query(cls.name == name).get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    def names_by_key(cls, keys):
+        """Resolves a collection of User keys to their names with a single batch get.
+        Args:
+            keys: An iterable of User keys. None values and duplicates are ignored.
+        Returns:
+            A dict mapping each User key to the name of that user.
+        """
+        keys = list(set(key for key in keys if key is not None))
+        return dict((key, user.name) for key, user in zip(keys, ndb.get_multi(keys))
+                    if user is not None)
+
+    @classmethod
+    @ndb.transactional
+    def create(cls, name, email):
+        """Creates and stores a User keyed by its name. The existence check and put are
+        carried out within a single transaction, so two requests for the same name
+        cannot both succeed.
+        Args:
+            name: The name of the user (str).
+            email: The email address of the user (str).
+        Returns:
+            The created User, or None if a user with that name already exists.
+        """
+        if cls.get_by_id(name):
+            return None
+        user = cls(id=name, name=name, email=email)
+        user.put()
+        return user
+
+    def _win_percentage(self):
         """Returns the users win percentage calculated using wins and total_played.
         Returns:
             the win / total_played ratio as a float if a user has played at least 1 game,
-            else returns 0.
+            else returns 0.0.
         """
         if self.total_played > 0:
             return float(self.wins) / float(self.total_played)
         else:
-            return 0
+            return 0.0
+
+    win_percentage = ndb.ComputedProperty(_win_percentage)
+    has_played = ndb.ComputedProperty(lambda self: self.total_played > 0)
 
     def to_form(self):
         """Returns the user entity object as a UserForm message object suitable for 
         outbound messages.
         Returns:
-            UserForm message containing the User entities name, email, wins, total played 
-            and win percentage.
+            UserForm message containing the User entities name, email, wins, total played,
+            win percentage and rating.
         """
         return UserForm(name=self.name,
                         email=self.email,
                         wins=self.wins,
                         total_played=self.total_played,
-                        win_percentage=self.win_percentage)
+                        win_percentage=self.win_percentage,
+                        rating=self.rating)
+
+    def _rating_change(self, opponent_rating, result):
+        """Returns the change to the users Elo rating from a game.
+        Args:
+            opponent_rating: The rating of the opponent before the game (float), or None
+                to rate the opponent equal to this user.
+            result: 1 for a win, 0 for a loss.
+        """
+        if opponent_rating is None:
+            opponent_rating = self.rating
+        expected = 1.0 / (1.0 + 10 ** ((opponent_rating - self.rating) / 400.0))
+        return RATING_K_FACTOR * (result - expected)
+
+    def add_win(self, opponent_rating=None, shard=None):
+        """Add a win to the users pending results, and raise their rating.
+        Args:
+            opponent_rating: The rating of the losing user before the game.
+            shard: An optional UserStatsShard of the user to add the result to, which
+                the caller must store. If not given a shard is chosen and stored.
+        """
+        self._add_result(1, self._rating_change(opponent_rating, 1), shard)
+
+    def add_loss(self, opponent_rating=None, shard=None):
+        """Add a loss to the users pending results, by only incrementing total_played,
+        and lower their rating.
+        Args:
+            opponent_rating: The rating of the winning user before the game.
+            shard: An optional UserStatsShard of the user to add the result to, which
+                the caller must store. If not given a shard is chosen and stored.
+        """
+        self._add_result(0, self._rating_change(opponent_rating, 0), shard)
+
+    def _add_result(self, wins, rating_change, shard=None):
+        """Adds a game result to a stats shard of the user, and clears the users cached
+        stats once the current transaction, if any, commits."""
+        if shard is None:
+            self._store_result(wins, rating_change)
+            return
+        shard.wins += wins
+        shard.total_played += 1
+        shard.rating += rating_change
+        cache_key = MEMCACHE_USER_STATS.format(self.key.urlsafe())
+        ndb.get_context().call_on_commit(lambda: memcache.delete(cache_key))
+
+    @ndb.transactional(xg=True)
+    def _store_result(self, wins, rating_change):
+        """Records a game result in a randomly chosen stats shard of the user. Joins the
+        current transaction if there is one."""
+        shard_key = UserStatsShard.random_key(self.key)
+        shard = shard_key.get() or UserStatsShard(key=shard_key, user=self.key)
+        self._add_result(wins, rating_change, shard)
+        shard.put()
+
+    def stats(self):
+        """Returns the users current wins, total_played and rating, including the
+        results not yet folded into the User, in the format:
+            {'wins': int, 'total_played': int, 'rating': float}
+        The aggregate is cached in memcache until the user next finishes a game, or
+        for at most USER_STATS_EXPIRY seconds.
+        """
+        cache_key = MEMCACHE_USER_STATS.format(self.key.urlsafe())
+        stats = memcache.get(cache_key)
+        if stats is None:
+            stats = {'wins': self.wins, 'total_played': self.total_played,
+                     'rating': self.rating}
+            for shard in ndb.get_multi(UserStatsShard.shard_keys(self.key)):
+                if shard is not None:
+                    stats['wins'] += shard.wins
+                    stats['total_played'] += shard.total_played
+                    stats['rating'] += shard.rating
+            memcache.add(cache_key, stats, time=USER_STATS_EXPIRY)
+        return stats
+
+    def to_stats_form(self):
+        """Returns a UserForm of the user with its current stats, including the results
+        not yet folded into the User."""
+        stats = self.stats()
+        wins, total_played = stats['wins'], stats['total_played']
+        return UserForm(name=self.name,
+                        email=self.email,
+                        wins=wins,
+                        total_played=total_played,
+                        win_percentage=float(wins) / total_played if total_played else 0.0,
+                        rating=stats['rating'])
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def fold_stats(cls, user_key):
+        """Adds the results held in the stats shards of a user to their wins,
+        total_played and rating, and deletes the shards, within a single transaction.
+        The aggregated stats, and so their cached value, are unchanged.
+        Args:
+            user_key: The key of the User.
+        Returns:
+            The updated User, or None if the user does not exist.
+        """
+        user = user_key.get()
+        if user is None:
+            return None
+        shards = [shard for shard in ndb.get_multi(UserStatsShard.shard_keys(user_key))
+                  if shard is not None]
+        if shards:
+            for shard in shards:
+                user.wins += shard.wins
+                user.total_played += shard.total_played
+                user.rating += shard.rating
+            user.put()
+            ndb.delete_multi([shard.key for shard in shards])
+        return user
+
+
+class UserStatsShard(ndb.Model):
+    """A shard of the results of a users finished games that have not yet been folded
+    into their User entity. Each user has up to NUM_STATS_SHARDS shards, each in its own
+    entity group, and each result is added to one chosen at random.
+    Attributes:
+        user: The key of the User the results belong to.
+        wins: The number of wins held in the shard (int).
+        total_played: The number of games held in the shard (int).
+        rating: The total change to the users rating held in the shard (float).
+    """
+    user = ndb.KeyProperty(kind='User', required=True)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    total_played = ndb.IntegerProperty(default=0, indexed=False)
+    rating = ndb.FloatProperty(default=0.0, indexed=False)
+
+    @classmethod
+    def random_key(cls, user_key):
+        """Returns the key of a randomly chosen stats shard of a user."""
+        return cls.shard_key(user_key, random.randrange(NUM_STATS_SHARDS))
 
-    def add_win(self):
-        """Add a to the users win property."""
-        self.wins += 1
-        self.total_played += 1
-        self.put()
+    @classmethod
+    def shard_key(cls, user_key, index):
+        """Returns the key of a stats shard of a user."""
+        return ndb.Key(cls, '{0}:{1}'.format(user_key.urlsafe(), index))
 
-    def add_loss(self):
-        """Add a loss to the user, by only incrementing total_played property."""
-        self.total_played += 1
-        self.put()
+    @classmethod
+    def shard_keys(cls, user_key):
+        """Returns the keys of every stats shard of a user."""
+        return [cls.shard_key(user_key, index) for index in range(NUM_STATS_SHARDS)]
 
 
 class Score(ndb.Model):
@@ -58,21 +270,74 @@ class Score(ndb.Model):
         date: The date of the game when it ended.
         winner: The username of the winner of the game.
         loser: The username of the looser of the game.
+        winner_name: The name of the winner, stored when the score is created so it
+            can be displayed without fetching the User.
+        loser_name: The name of the loser, stored when the score is created.
     """
     date = ndb.DateProperty(required=True)
     winner = ndb.KeyProperty(required=True)
     loser = ndb.KeyProperty(required=True)
+    winner_name = ndb.StringProperty(indexed=False)
+    loser_name = ndb.StringProperty(indexed=False)
 
-    def to_form(self):
+    def player_keys(self):
+        """Returns the User keys of the winner and loser."""
+        return [self.winner, self.loser]
+
+    def player_names(self):
+        """Returns a dict of the winner and loser keys to their stored names, or None
+        if the names have not been stored yet."""
+        if self.winner_name is None or self.loser_name is None:
+            return None
+        return {self.winner: self.winner_name, self.loser: self.loser_name}
+
+    def set_player_names(self, names):
+        """Updates the stored winner and loser names.
+        Args:
+            names: A dict of User key to name, as returned by User.names_by_key. Users
+                missing from the dict keep their stored name.
+        Returns:
+            True if either stored name was changed, else False.
+        """
+        winner_name = names.get(self.winner, self.winner_name)
+        loser_name = names.get(self.loser, self.loser_name)
+        changed = (winner_name, loser_name) != (self.winner_name, self.loser_name)
+        self.winner_name, self.loser_name = winner_name, loser_name
+        return changed
+
+    def to_form(self, names=None):
         """Returns the score entity as a ScoreForm message object suitable for 
         outbound messages.
+        Args:
+            names: An optional dict of User key to name, as returned by
+                User.names_by_key, containing the winner and loser. If not given the
+                stored names are used, or fetched with a single batch get for scores
+                created before names were stored.
         Returns:
             ScoreForm message containing the Score entity date, winner and loser 
             properties.
         """
+        if names is None:
+            names = self.player_names() or User.names_by_key(self.player_keys())
         return ScoreForm(date=str(self.date),
-                         winner=self.winner.get().name,
-                         loser=self.loser.get().name)
+                         winner=names[self.winner],
+                         loser=names[self.loser])
+
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns a ScoreForms message for a sequence of Score entities. Scores created
+        before names were stored have their winner and loser names resolved with a
+        single batch get.
+        Args:
+            scores: An iterable of Score entities.
+        Returns:
+            A ScoreForms message containing a ScoreForm for each score.
+        """
+        scores = list(scores)
+        names = User.names_by_key(key for score in scores if score.player_names() is None
+                                  for key in score.player_keys())
+        return ScoreForms(items=[score.to_form(score.player_names() or names)
+                                 for score in scores])
 
 
 class InsertShipsForm(messages.Message):
@@ -90,8 +355,14 @@ class InsertShipsForm(messages.Message):
 
 
 class InsertShipsForms(messages.Message):
-    """Used for multiple insertships forms during ship insert"""
+    """Used for multiple insertships forms during ship insert.
+    Attributes:
+        ships: The InsertShipsForm of each ship to be inserted.
+        random_fleet: Optional. True to insert a randomly placed fleet instead, in which
+            case no ships may be given.
+    """
     ships = messages.MessageField(InsertShipsForm, 1, repeated=True)
+    random_fleet = messages.BooleanField(2, default=False)
 
 
 class MakeMoveForm(messages.Message):
@@ -100,10 +371,13 @@ class MakeMoveForm(messages.Message):
         user_name: The users name who is making a game move.
         target_row: The chosen target row, as an int between 0-9.
         target_col: The chosen target column, as an int between 0-9.
+        version: Optional. The version of the game the move was chosen against, as
+            returned within a GameForm. The move is rejected if the game has changed.
     """
     user_name = messages.StringField(1, required=True)
     target_row = messages.IntegerField(2, required=True)
     target_col = messages.IntegerField(3, required=True)
+    version = messages.IntegerField(4)
 
 
 class ScoreForm(messages.Message):
@@ -122,8 +396,11 @@ class ScoreForms(messages.Message):
     """Return multiple ScoreForm messages.
     Attributes:
         items: The ScoreForm messages, as a repeated property.
+        next_page_token: The token to request the next page of results with, if the
+            results are paginated and there are more results.
     """
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -142,17 +419,22 @@ class UserForm(messages.Message):
         wins: User wins, as an int.
         total_played: User total played games, as an int.
         win_percentage: Users win percentage, as a float.
+        rating: Users Elo rating, as a float.
     """
     name = messages.StringField(1, required=True)
     email = messages.StringField(2)
     wins = messages.IntegerField(3, required=True)
     total_played = messages.IntegerField(4, required=True)
     win_percentage = messages.FloatField(5, required=True)
+    rating = messages.FloatField(6)
 
 
 class UserForms(messages.Message):
     """Container for multiple User Form messages.
     Attributes:
         items: The UserForm messages, as a repeated property.
+        next_page_token: The token to request the next page of results with, if there
+            are more results.
     """
     items = messages.MessageField(UserForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
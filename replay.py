@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# This contains the replay engine, which rebuilds the boards of a game as they stood
+# after any of its moves, from the ships placed on each board and the game's move log.
+# The shots made on each board are checkpointed every CHECKPOINT_INTERVAL moves, so the
+# state after any move is rebuilt from the nearest checkpoint before it.
+import collections
+
+from board import Board, GRID_SIZE
+from game_state import GameState, HIT_MSG, MISS_MSG
+
+# Number of moves between checkpoints of the shots made on each board.
+CHECKPOINT_INTERVAL = 16
+
+# The outcome of a single move, as returned by Replay.audit.
+MoveAudit = collections.namedtuple(
+    'MoveAudit', ['seq', 'grid', 'row', 'col', 'result', 'ship_type', 'sunk',
+                  'fleet_destroyed'])
+
+
+class Replay(object):
+    """The replay of a single game, built in one pass over its move log. The ships of
+        each board are as placed before the first move, and every move is checked
+        against the rules applied by Game.destroy_cell and make_move: users alternate
+        turns with user 1 attacking grid 2 first, and no cell is attacked twice.
+    Attributes:
+        moves: The full move log of the game, as a list of (grid, row, col) tuples.
+    """
+
+    def __init__(self, state, moves):
+        """Builds the replay of a game.
+        Args:
+            state: The current game_state.GameState of the game.
+            moves: The full move log of the game, including any archived moves.
+        Raises:
+            ValueError: the move log breaks the rules, or does not match the boards.
+        """
+        if len(moves) != state.move_count:
+            raise ValueError('Expected {0} moves, got {1}'.format(state.move_count,
+                                                                 len(moves)))
+        self.moves = moves
+        self._boards = (state.board_1, state.board_2)
+        shots = [0, 0]
+        checkpoints = []
+        expected_grid = 2
+        for num, (grid, row, col) in enumerate(moves):
+            if num % CHECKPOINT_INTERVAL == 0:
+                checkpoints.append(tuple(shots))
+            if grid != expected_grid:
+                raise ValueError('Move {0} was made out of turn'.format(num + 1))
+            bit = 1 << (row * GRID_SIZE + col)
+            if shots[grid - 1] & bit:
+                raise ValueError('Move {0} attacks a destroyed cell'.format(num + 1))
+            shots[grid - 1] |= bit
+            expected_grid = 3 - grid
+        if len(moves) % CHECKPOINT_INTERVAL == 0:
+            checkpoints.append(tuple(shots))
+        self._checkpoints = checkpoints
+
+        # cells destroyed without a logged move, eg by games converted from the legacy
+        # format, are treated as destroyed before the first move.
+        self._unlogged = []
+        for board, logged in zip(self._boards, shots):
+            if logged & ~board.shots:
+                raise ValueError('The move log does not match the boards')
+            self._unlogged.append(board.shots & ~logged)
+
+    def __len__(self):
+        return len(self.moves)
+
+    def _shots_at(self, move):
+        if not 0 <= move <= len(self.moves):
+            raise ValueError('The move must be between 0 and {0}'.format(len(self.moves)))
+        first = move // CHECKPOINT_INTERVAL * CHECKPOINT_INTERVAL
+        shots = list(self._checkpoints[move // CHECKPOINT_INTERVAL])
+        for grid, row, col in self.moves[first:move]:
+            shots[grid - 1] |= 1 << (row * GRID_SIZE + col)
+        return [unlogged | logged for unlogged, logged in zip(self._unlogged, shots)]
+
+    def board_at(self, move, grid=1):
+        """Returns the board.Board of the selected grid as it stood after the first move
+            moves, where move 0 is the board as placed.
+        Raises:
+            ValueError: the move is outside of the game.
+        """
+        board = self._boards[grid - 1]
+        return Board(ships=board.ships, shots=self._shots_at(move)[grid - 1],
+                     fleet=board.fleet)
+
+    def state_at(self, move):
+        """Returns the game_state.GameState of the game as it stood after the first move
+            moves, holding both boards and the move log up to that move.
+        Raises:
+            ValueError: the move is outside of the game.
+        """
+        shots = self._shots_at(move)
+        board_1, board_2 = [Board(ships=board.ships, shots=board_shots, fleet=board.fleet)
+                            for board, board_shots in zip(self._boards, shots)]
+        return GameState(board_1=board_1, board_2=board_2, moves=self.moves[:move])
+
+    def audit(self, seq):
+        """Returns the outcome of a single move, for checking a disputed move.
+        Args:
+            seq (int): The sequence number of the move, counting from 1.
+        Returns:
+            A MoveAudit of the move, giving the ship type hit, if any, whether it sank,
+            and whether every ship on the attacked grid was destroyed by the move. The
+            ship type is None, and sunk False, for hits on boards without fleet masks.
+        Raises:
+            ValueError: there is no move with that sequence number.
+        """
+        if not 1 <= seq <= len(self.moves):
+            raise ValueError('The move must be between 1 and {0}'.format(len(self.moves)))
+        grid, row, col = self.moves[seq - 1]
+        board = self.board_at(seq, grid)
+        hit = bool(board.ships & (1 << (row * GRID_SIZE + col)))
+        # games converted from the legacy format have no fleet masks, so their hits are
+        # audited without the ship type.
+        ship_type = board.ship_at(row, col) if hit else None
+        return MoveAudit(seq=seq, grid=grid, row=row, col=col,
+                         result=HIT_MSG if hit else MISS_MSG, ship_type=ship_type,
+                         sunk=bool(ship_type) and board.sunk(ship_type),
+                         fleet_destroyed=not board.intact)
+
+
+def replay_games(games):
+    """Builds the replay of each of a batch of games.
+    Args:
+        games: An iterable of (state, moves) tuples, of each game's current GameState and
+            full move log.
+    Returns:
+        A list of Replay objects, in the order of the games.
+    """
+    return [Replay(state, moves) for state, moves in games]
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# This contains the background task scheduling used by the Battleships API. Tasks are
+# coalesced by key, so repeated requests for the same work within a time window enqueue
+# a single task, and are added transactionally with the datastore write they follow.
+import functools
+import threading
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+# Memcache key of the marker recording that a task was enqueued for a coalescing key.
+MEMCACHE_TASK_MARKER = 'TASK:{0}'
+# Memcache key of the values a running task has taken from its marker, formatted with the
+# task name, so they are not lost if the task is retried.
+MEMCACHE_TASK_TAKEN = 'TASK_TAKEN:{0}'
+# Memcache key of the counters of tasks enqueued and suppressed for each task name.
+MEMCACHE_TASK_COUNTER = 'TASK_COUNT:{0}:{1}'
+# Value of a marker whose task has started, which no longer suppresses tasks.
+RELEASED = 'released'
+RELEASED_EXPIRY = 60
+TAKEN_EXPIRY = 24 * 60 * 60
+CAS_RETRIES = 5
+SCHEDULED = 'scheduled'
+SUPPRESSED = 'suppressed'
+
+# Default number of seconds after which a coalescing key is released if its task never
+# starts.
+DEFAULT_WINDOW = 60
+# The tasks scheduled through this module, by name.
+TASK_NAMES = ('send_move_email', 'fold_user_stats')
+# Seconds during which the results of a user's finished games are gathered in their
+# stats shards before being folded into the User.
+FOLD_STATS_DELAY = 60
+# Seconds during which the turn notifications of a user's games are merged into a
+# single email.
+MOVE_EMAIL_WINDOW = 60
+# Seconds after which a user's turn email marker is released if its task never starts,
+# well beyond the delay of the rate limited mail queue, as the marker holds the games
+# the email lists.
+MOVE_EMAIL_MARKER_EXPIRY = 60 * 60
+# The queue that outbound email is sent from, configured in queue.yaml.
+MAIL_QUEUE = 'mail'
+
+# The coalescing markers claimed within the current tasks.transactional call.
+_claims = threading.local()
+
+
+def schedule(task_name, coalesce_key, params=None, window=DEFAULT_WINDOW, countdown=None,
+             queue_name='default', collect=None):
+    """Enqueues the task at /tasks/<task_name>, unless a task with the same coalescing
+        key is already pending. The key is claimed with an atomic memcache add before the
+        task is enqueued, so of concurrent requests only one enqueues a task, and it is
+        released by the task when it starts, through release(). When called within a
+        transaction the task is added transactionally, so it is only enqueued if the
+        transaction commits. Transactions should be run with tasks.transactional, which
+        releases the keys claimed by an attempt that rolls back.
+    Args:
+        task_name: The name of the task, which is also its url under /tasks/.
+        coalesce_key: A string identifying the work the task carries out, eg the user a
+            turn email is for. At most one task is pending per key.
+        params: An optional dict of the task parameters.
+        window: The number of seconds after which the key is released if the task never
+            starts.
+        countdown: An optional number of seconds to delay the task by. A delayed task
+            carries out the work of every request coalesced into it.
+        queue_name: The name of the queue to add the task to.
+        collect: An optional value passed to the pending task, which receives the values
+            of every request coalesced into it from release().
+    Returns:
+        True if the task was enqueued, or False if it was suppressed.
+    """
+    return schedule_async(task_name, coalesce_key, params, window, countdown,
+                          queue_name, collect).get_result()
+
+
+@ndb.tasklet
+def _claim(marker, value, window):
+    """Returns a Future of True if the marker was claimed with the given value, or False
+        if the value was added to the values of the pending task holding the marker."""
+    ctx = ndb.get_context()
+    for _ in range(CAS_RETRIES):
+        claimed = yield ctx.memcache_add(marker, value, time=window)
+        if claimed:
+            raise ndb.Return(True)
+        entry = yield ctx.memcache_gets(marker)
+        if entry is None:
+            continue
+        if entry == RELEASED:
+            new_entry = value
+        else:
+            new_entry = entry + [item for item in value if item not in entry]
+        if new_entry == entry:
+            raise ndb.Return(False)
+        stored = yield ctx.memcache_cas(marker, new_entry, time=window)
+        if stored:
+            raise ndb.Return(entry == RELEASED)
+    # an extra task is better than one which misses the work of this request.
+    raise ndb.Return(True)
+
+
+@ndb.tasklet
+def schedule_async(task_name, coalesce_key, params=None, window=DEFAULT_WINDOW,
+                   countdown=None, queue_name='default', collect=None):
+    """Asynchronous version of schedule, returning a Future of whether the task was
+        enqueued. Within a transaction, the Future must be waited on before the
+        transaction function returns."""
+    marker = MEMCACHE_TASK_MARKER.format(coalesce_key)
+    value = [] if collect is None else [collect]
+    ctx = ndb.get_context()
+    claimed = yield _claim(marker, value, window)
+    if not claimed:
+        yield ctx.memcache_incr(MEMCACHE_TASK_COUNTER.format(task_name, SUPPRESSED),
+                                initial_value=0)
+        raise ndb.Return(False)
+    task = taskqueue.Task(url='/tasks/{0}'.format(task_name), params=params,
+                          countdown=countdown)
+    try:
+        yield task.add_async(queue_name=queue_name, transactional=ndb.in_transaction())
+    except Exception:
+        yield ctx.memcache_delete(marker)
+        raise
+
+    claims = getattr(_claims, 'markers', None)
+    claim = (marker, value, window, functools.partial(
+        taskqueue.add, url=task.url, params=params, countdown=countdown,
+        queue_name=queue_name))
+    if ndb.in_transaction() and claims is not None:
+        claims.append(claim)
+
+    def on_commit():
+        if claims is not None and claim in claims:
+            claims.remove(claim)
+        memcache.incr(MEMCACHE_TASK_COUNTER.format(task_name, SCHEDULED), initial_value=0)
+    # called immediately when not within a transaction.
+    ctx.call_on_commit(on_commit)
+    raise ndb.Return(True)
+
+
+def _release_claims():
+    """Releases the coalescing markers claimed by transaction attempts that did not
+        commit, so the tasks they suppress are enqueued by later requests. If other
+        requests have been coalesced into a claim since, its task is enqueued outside
+        of the transaction instead, so their work is still carried out."""
+    claims = getattr(_claims, 'markers', None)
+    if not claims:
+        return
+    client = memcache.Client()
+    for marker, value, window, enqueue in claims:
+        entry = client.gets(marker)
+        if entry is None or entry == RELEASED:
+            continue
+        if entry != value or not client.cas(marker, RELEASED, time=window):
+            enqueue()
+    del claims[:]
+
+
+def release(coalesce_key, task_name=None):
+    """Releases the coalescing key of a task, called by the task as it starts, so
+        requests made from then on enqueue a new task rather than being coalesced into
+        one which has already read its work.
+    Args:
+        coalesce_key: The coalescing key the task was scheduled with.
+        task_name: The name of the running task, from its X-AppEngine-TaskName header.
+            The values are kept for the task's retries.
+    Returns:
+        The values collected from every request coalesced into the task, as a list.
+    """
+    client = memcache.Client()
+    taken_key = MEMCACHE_TASK_TAKEN.format(task_name) if task_name else None
+    if taken_key:
+        taken = client.get(taken_key)
+        if taken is not None:
+            return taken
+    marker = MEMCACHE_TASK_MARKER.format(coalesce_key)
+    values = []
+    for _ in range(CAS_RETRIES):
+        entry = client.gets(marker)
+        if entry is None or entry == RELEASED:
+            break
+        if client.cas(marker, RELEASED, time=RELEASED_EXPIRY):
+            values = entry
+            break
+    else:
+        # a concurrent release may have marked the entry released, leaving no values.
+        entry = client.get(marker)
+        values = entry if isinstance(entry, list) else []
+        client.delete(marker)
+    if taken_key:
+        client.set(taken_key, values, time=TAKEN_EXPIRY)
+    return values
+
+
+def transactional(**options):
+    """Decorator running a function in a transaction, as ndb.transactional does with the
+        same options, which releases the coalescing markers claimed by schedule_async
+        within any attempt that rolls back, whether it is retried or fails.
+    """
+    def decorator(func):
+        def attempt(*args, **kwargs):
+            # markers are still held from an earlier attempt only if its commit failed.
+            _release_claims()
+            return func(*args, **kwargs)
+        transaction = ndb.transactional(**options)(attempt)
+        joined = ndb.transactional(**options)(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_claims, 'markers', None) is not None:
+                # the enclosing tasks.transactional call releases the markers.
+                return joined(*args, **kwargs)
+            _claims.markers = []
+            try:
+                return transaction(*args, **kwargs)
+            finally:
+                _release_claims()
+                _claims.markers = None
+        return wrapper
+    return decorator
+
+
+def schedule_fold_stats(user_key):
+    """Schedules the stats shards of a user to be folded into the User once the current
+        coalescing window ends, so a user finishing many games is folded once per window.
+    Args:
+        user_key: The key of the User.
+    Returns:
+        True if the task was enqueued, or False if a fold is already scheduled.
+    """
+    return schedule_fold_stats_async(user_key).get_result()
+
+
+def schedule_fold_stats_async(user_key):
+    """Asynchronous version of schedule_fold_stats, returning a Future."""
+    return schedule_async('fold_user_stats', 'fold_user_stats:{0}'.format(user_key.urlsafe()),
+                          params=dict(user_key=user_key.urlsafe()), window=FOLD_STATS_DELAY,
+                          countdown=FOLD_STATS_DELAY)
+
+
+def release_fold_stats(user_key, task_name=None):
+    """Releases the coalescing key of a user's fold task, called as the task starts."""
+    release('fold_user_stats:{0}'.format(user_key.urlsafe()), task_name)
+
+
+def schedule_move_email_async(user_key, game_key):
+    """Schedules a turn email to a user once the current coalescing window ends, on the
+        mail queue, returning a Future of whether the task was enqueued. The keys of the
+        games of every move coalesced into the task are passed to it, so the turns of
+        all their games within the window are merged into one email.
+    Args:
+        user_key: The key of the User whose turn it is.
+        game_key: The key of the Game the move was made in.
+    """
+    return schedule_async('send_move_email', 'send_move_email:{0}'.format(user_key.urlsafe()),
+                          params=dict(user_key=user_key.urlsafe(), game_key=game_key.urlsafe()),
+                          window=MOVE_EMAIL_MARKER_EXPIRY, countdown=MOVE_EMAIL_WINDOW,
+                          queue_name=MAIL_QUEUE, collect=game_key.urlsafe())
+
+
+def release_move_email(user_key, task_name=None):
+    """Releases the coalescing key of a user's turn email task, called as the task
+        starts, so later moves schedule a new email.
+    Args:
+        user_key: The key of the User the email is for.
+        task_name: The name of the running task, from its X-AppEngine-TaskName header.
+    Returns:
+        The keys of the games of every move coalesced into the task, as ndb.Keys.
+    """
+    return [ndb.Key(urlsafe=urlsafe)
+            for urlsafe in release('send_move_email:{0}'.format(user_key.urlsafe()),
+                                   task_name)]
+
+
+def stats():
+    """Returns the counts of tasks enqueued and suppressed since memcache was last
+        flushed, in the format: {'task_name': {'scheduled': int, 'suppressed': int}, ..}
+    """
+    keys = dict(((task_name, outcome), MEMCACHE_TASK_COUNTER.format(task_name, outcome))
+                for task_name in TASK_NAMES for outcome in (SCHEDULED, SUPPRESSED))
+    counts = memcache.get_multi(keys.values())
+    result = dict((task_name, {}) for task_name in TASK_NAMES)
+    for (task_name, outcome), key in keys.iteritems():
+        result[task_name][outcome] = int(counts.get(key, 0))
+    return result
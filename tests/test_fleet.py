@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# Tests of the fleet placement table and random fleets. Run from the repository root with:
+#     python -m unittest tests.test_fleet
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from fleet import SHIP_SIZES, fleet_masks, random_fleets
+
+
+class RandomFleetTest(unittest.TestCase):
+
+    def test_random_fleets_are_legal(self):
+        for ships in random_fleets(500, seed=0):
+            masks = fleet_masks(ships)
+            self.assertEqual(sorted(masks), sorted(SHIP_SIZES))
+            self.assertEqual(sum(bin(mask).count('1') for mask in masks.values()),
+                             sum(SHIP_SIZES.values()))
+
+    def test_random_fleets_repeat_with_seed(self):
+        self.assertEqual(random_fleets(20, seed=1), random_fleets(20, seed=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
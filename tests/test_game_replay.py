@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Tests of setting up games, and of replaying them through the get_game_replay endpoint,
+# against the App Engine SDK's local service stubs. Requires the App Engine Python SDK,
+# found through the APPENGINE_SDK environment variable. Run from the repository root with:
+#     APPENGINE_SDK=/path/to/google_appengine python -m unittest tests.test_game_replay
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.environ.get('APPENGINE_SDK', ''))
+sys.path.insert(0, ROOT)
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+import endpoints
+
+import api
+from game_models import Game
+from models import InsertShipsForms
+
+USER_NAMES = ('replay user 1', 'replay user 2')
+# (user, target row, target col) of each move, user 1 attacking first.
+MOVES = [(0, 0, 0), (1, 0, 0), (0, 5, 5), (1, 5, 5)]
+
+
+class GameReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        ndb.get_context().set_cache_policy(False)
+        self.api = api.BattleshipsAPI()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def call(self, name, container, **fields):
+        return getattr(self.api, name)(container.combined_message_class(**fields))
+
+    def create_users(self):
+        for name in USER_NAMES:
+            self.call('create_user', api.USER_REQUEST, user_name=name,
+                      email='{0}@example.com'.format(name.replace(' ', '.')))
+
+    def test_setup_without_fleet_is_rejected(self):
+        self.create_users()
+        with self.assertRaises(endpoints.BadRequestException):
+            self.call('setup_game', api.SETUP_GAME_REQUEST,
+                      user_1=USER_NAMES[0], user_2=USER_NAMES[1],
+                      user_1_ships=InsertShipsForms(random_fleet=True),
+                      user_2_ships=InsertShipsForms())
+        self.assertEqual(Game.query().count(), 0)
+
+    def test_replay_of_saved_game(self):
+        self.create_users()
+        game_key = self.call('setup_game', api.SETUP_GAME_REQUEST,
+                             user_1=USER_NAMES[0], user_2=USER_NAMES[1],
+                             user_1_ships=InsertShipsForms(random_fleet=True),
+                             user_2_ships=InsertShipsForms(random_fleet=True)).urlsafe_key
+
+        forms = [self.call('get_game', api.GET_GAME_REQUEST, urlsafe_game_key=game_key)]
+        for user, row, col in MOVES:
+            self.call('make_move', api.MAKE_MOVE_REQUEST, urlsafe_game_key=game_key,
+                      user_name=USER_NAMES[user], target_row=row, target_col=col)
+            forms.append(self.call('get_game', api.GET_GAME_REQUEST,
+                                   urlsafe_game_key=game_key))
+
+        for move, form in enumerate(forms):
+            replayed = self.call('get_game_replay', api.REPLAY_REQUEST,
+                                 urlsafe_game_key=game_key, move=move)
+            self.assertEqual((replayed.grid_1, replayed.grid_2, replayed.next_move),
+                             (form.grid_1, form.grid_2, form.next_move))
+
+
+if __name__ == '__main__':
+    unittest.main()
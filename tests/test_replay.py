@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Tests of the replay engine. Run from the repository root with:
+#     python -m unittest tests.test_replay
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from board import GRID_SIZE
+from game_state import GameState, HIT_MSG, MISS_MSG
+from replay import Replay
+
+
+def legacy_grid(ships=(), shots=()):
+    grid = [['-'] * GRID_SIZE for _ in range(GRID_SIZE)]
+    for row, col in ships:
+        grid[row][col] = '+'
+    for row, col in shots:
+        grid[row][col] = 'X'
+    return grid
+
+
+class ReplayAuditTest(unittest.TestCase):
+
+    def test_audit_of_legacy_game_without_fleet_masks(self):
+        # user 1 misses grid 2 at (9, 9), then user 2 hits grid 1 at (0, 0).
+        history = {'grid_1': [(0, 0, HIT_MSG)], 'grid_2': [(9, 9, MISS_MSG)]}
+        grids = (legacy_grid(ships=[(0, 1)], shots=[(0, 0)]),
+                 legacy_grid(ships=[(5, 5), (5, 6)], shots=[(9, 9)]))
+        state = GameState.from_legacy(history, grids=grids)
+        replay = Replay(state, list(state.moves))
+
+        miss, hit = replay.audit(1), replay.audit(2)
+        self.assertEqual((miss.grid, miss.result, miss.ship_type), (2, MISS_MSG, None))
+        self.assertEqual((hit.grid, hit.row, hit.col, hit.result), (1, 0, 0, HIT_MSG))
+        self.assertEqual((hit.ship_type, hit.sunk), (None, False))
+        self.assertEqual([entry[2] for entry in state.history()['grid_1']], [HIT_MSG])
+
+    def test_audit_of_game_with_fleet_masks(self):
+        state = GameState()
+        for col in (0, 1):
+            state.board(1).place(0, col, ship_type='patrol boat')
+        state.board(2).place(5, 5, ship_type='patrol boat')
+        for grid, row, col in [(2, 9, 9), (1, 0, 0), (2, 8, 8), (1, 0, 1)]:
+            state.board(grid).shoot(row, col)
+            state.record_move(grid, row, col)
+        replay = Replay(state, list(state.moves))
+
+        first, sinking = replay.audit(2), replay.audit(4)
+        self.assertEqual((first.result, first.ship_type, first.sunk),
+                         (HIT_MSG, 'patrol boat', False))
+        self.assertEqual((sinking.result, sinking.sunk, sinking.fleet_destroyed),
+                         (HIT_MSG, True, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
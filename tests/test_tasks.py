@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# Tests of coalesced task scheduling, against the App Engine SDK's local service stubs.
+# Requires the App Engine Python SDK, found through the APPENGINE_SDK environment
+# variable. Run from the repository root with:
+#     APPENGINE_SDK=/path/to/google_appengine python -m unittest tests.test_tasks
+import os
+import sys
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.environ.get('APPENGINE_SDK', ''))
+sys.path.insert(0, ROOT)
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb, testbed
+
+import tasks
+from models import User
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().set_cache_policy(False)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def queued(self):
+        return len(self.taskqueue.get_filtered_tasks())
+
+    def test_concurrent_requests_enqueue_one_task(self):
+        # each request thread has its own ndb context, as concurrent requests would.
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(tasks.schedule('fold_user_stats', 'key')))
+            for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [False, False, True])
+        self.assertEqual(self.queued(), 1)
+        self.assertEqual(tasks.stats()['fold_user_stats'],
+                         {'scheduled': 1, 'suppressed': 2})
+
+    def test_rolled_back_transaction_releases_its_marker(self):
+        @tasks.transactional()
+        def fail():
+            User(name='user', email='user@example.com').put()
+            self.assertTrue(tasks.schedule('fold_user_stats', 'key'))
+            raise ValueError('rolled back')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.queued(), 0)
+        self.assertTrue(tasks.schedule('fold_user_stats', 'key'))
+        self.assertEqual(self.queued(), 1)
+
+    def test_committed_transaction_keeps_its_marker(self):
+        @tasks.transactional()
+        def commit():
+            User(name='user', email='user@example.com').put()
+            return tasks.schedule('fold_user_stats', 'key')
+
+        self.assertTrue(commit())
+        self.assertFalse(tasks.schedule('fold_user_stats', 'key'))
+        self.assertEqual(self.queued(), 1)
+
+    def test_coalesced_values_are_passed_to_the_task(self):
+        self.assertTrue(tasks.schedule('send_move_email', 'key', collect='game 1'))
+        self.assertFalse(tasks.schedule('send_move_email', 'key', collect='game 2'))
+        self.assertFalse(tasks.schedule('send_move_email', 'key', collect='game 1'))
+        self.assertEqual(tasks.release('key', 'task-1'), ['game 1', 'game 2'])
+        # a retry of the task gets the same values.
+        self.assertEqual(tasks.release('key', 'task-1'), ['game 1', 'game 2'])
+        # requests made once the task has started schedule a new task.
+        self.assertTrue(tasks.schedule('send_move_email', 'key', collect='game 3'))
+        self.assertEqual(tasks.release('key', 'task-2'), ['game 3'])
+        self.assertEqual(self.queued(), 2)
+
+    def test_rolled_back_claim_enqueues_the_work_coalesced_into_it(self):
+        @tasks.transactional()
+        def fail():
+            User(name='user', email='user@example.com').put()
+            self.assertTrue(tasks.schedule('send_move_email', 'key', collect='game 1'))
+            # a concurrent request is coalesced into the claim before the rollback.
+            self.assertFalse(tasks.schedule_async('send_move_email', 'key',
+                                                  collect='game 2').get_result())
+            raise ValueError('rolled back')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.queued(), 1)
+        self.assertEqual(tasks.release('key'), ['game 1', 'game 2'])
+
+    def test_release_after_a_concurrent_release_takes_no_values(self):
+        self.assertTrue(tasks.schedule('send_move_email', 'key', collect='game 1'))
+        marker = tasks.MEMCACHE_TASK_MARKER.format('key')
+        cas = memcache.Client.cas
+        attempts = []
+
+        def concurrent_release(client, key, value, *args, **kwargs):
+            # every cas loses to other writers, the last to another run of the task
+            # releasing the marker.
+            attempts.append(key)
+            if len(attempts) == tasks.CAS_RETRIES:
+                memcache.set(marker, tasks.RELEASED)
+            return False
+
+        memcache.Client.cas = concurrent_release
+        try:
+            self.assertEqual(tasks.release('key', 'task-1'), [])
+        finally:
+            memcache.Client.cas = cas
+        # a retry of the task gets the same, empty, values.
+        self.assertEqual(tasks.release('key', 'task-1'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+# Number of results returned by a paginated endpoint when no limit is requested.
+DEFAULT_PAGE_SIZE = 20
+# Maximum number of results returned by a paginated endpoint in a single page.
+MAX_PAGE_SIZE = 100
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -14,6 +22,13 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
+    """Asynchronous version of get_by_urlsafe, returning a Future of the entity, so
+        the lookup can overlap with other RPCs."""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -24,9 +39,53 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+    # models with their own cache, such as Game, are read through it.
+    get_cached_async = getattr(model, 'get_cached_async', None)
+    if get_cached_async and key.kind() == model._get_kind():
+        entity = yield get_cached_async(key)
+    else:
+        entity = yield key.get_async()
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity
\ No newline at end of file
+    raise ndb.Return(entity)
+
+
+def fetch_page(query, limit=None, page_token=None, keys_only=False):
+    """Fetches a single page of results from a query, starting from the query cursor
+        held in a page token returned by a previous call. The query must have a stable
+        sort order, ending in the entity key, for pages to neither skip nor repeat
+        results.
+    Args:
+        query: The ndb.Query to fetch results from.
+        limit: The requested page size. DEFAULT_PAGE_SIZE if not given, and capped at
+            MAX_PAGE_SIZE.
+        page_token: The next_page_token returned with the previous page, or None for
+            the first page.
+        keys_only: If True, the entity keys are returned instead of the entities.
+    Returns:
+        A tuple of the list of results, and the page token for the next page or None if
+        there are no more results.
+    Raises:
+        endpoints.BadRequestException: the limit or page token is invalid."""
+    return fetch_page_async(query, limit, page_token, keys_only).get_result()
+
+
+@ndb.tasklet
+def fetch_page_async(query, limit=None, page_token=None, keys_only=False):
+    """Asynchronous version of fetch_page, returning a Future of the page and the next
+        page token, so the query can overlap with other RPCs."""
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise endpoints.BadRequestException('The limit must be at least 1')
+    try:
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid page token')
+
+    results, next_cursor, more = yield query.fetch_page_async(min(limit, MAX_PAGE_SIZE),
+                                                              start_cursor=cursor,
+                                                              keys_only=keys_only)
+    raise ndb.Return((results, next_cursor.urlsafe() if more and next_cursor else None))